@@ -35,6 +35,9 @@ plugin_path = None
 def pytest_configure(config):
     global plugin_path
     plugin_path = config.getoption('qgis_plugins')
+    # Allow tests to import plugin modules
+    if plugin_path:
+        sys.path.append(plugin_path)
 
 
 def pytest_sessionstart(session):
@@ -116,6 +119,8 @@ def client(request):
 
             # Activate debug headers
             os.environ['QGIS_WMTS_CACHE_DEBUG_HEADERS'] = 'true'
+            # Cache WMS documents
+            os.environ['QGIS_WMTS_CACHE_DOCUMENTS'] = 'WMTS,WMS'
 
             self.datapath = request.config.rootdir.join('data')
             self.server = QgsServer()
@@ -153,6 +158,12 @@ def client(request):
         def delete(self, *args, **kwargs) -> OWSResponse:
             return self.request(QgsServerRequest.DeleteMethod, *args, **kwargs)
 
+        def head(self, *args, **kwargs) -> OWSResponse:
+            return self.request(QgsServerRequest.HeadMethod, *args, **kwargs)
+
+        def post(self, *args, **kwargs) -> OWSResponse:
+            return self.request(QgsServerRequest.PostMethod, *args, **kwargs)
+
     return _Client()
 
 
@@ -228,7 +239,6 @@ def load_plugins(serverIface: 'QgsServerInterface') -> None:
         return
 
     LOGGER.info("Initializing plugins from %s", plugin_path)
-    sys.path.append(plugin_path)
 
     for plugin in find_plugins(plugin_path):
         try:
@@ -0,0 +1,87 @@
+import time
+
+from pathlib import Path
+
+from wmtsCacheServer.accesslog import (
+    AccessLog,
+    log_segments,
+    read_segment,
+    top_tiles,
+)
+
+PROJECT = '/data/france_parts.qgs'
+
+
+def tile(row: int, col: int, layer: str='france_parts') -> dict:
+    return {
+        'SERVICE': 'WMTS',
+        'REQUEST': 'GetTile',
+        'LAYER': layer,
+        'TILEMATRIXSET': 'EPSG:3857',
+        'TILEMATRIX': '5',
+        'TILEROW': str(row),
+        'TILECOL': str(col),
+        'FORMAT': 'image/png',
+    }
+
+
+def test_wmts_accesslog_top_tiles(tmp_path: Path):
+    """ Test counting requested tiles
+    """
+    log = AccessLog(tmp_path)
+    for _ in range(3):
+        log.log(PROJECT, tile(1, 1))
+    log.log(PROJECT, tile(1, 2))
+    log.log(PROJECT, tile(1, 2, layer='other'))
+    log.log('/data/other.qgs', tile(1, 2))
+    # Equivalent requests
+    log.log(PROJECT, dict(tile(1, 2), STYLE='default', FORMAT='image/PNG; mode=8bit'))
+    log.log(PROJECT, {'LAYER': 'france_parts', 'TILEROW': 'x', 'TILECOL': '1'})
+    log.flush()
+
+    tiles = top_tiles(tmp_path, 2, project=PROJECT)
+    assert tiles == [
+        (((PROJECT, 'france_parts', '', 'EPSG:3857', '5', 'image/png'), 1, 1), 3),
+        (((PROJECT, 'france_parts', '', 'EPSG:3857', '5', 'image/png'), 1, 2), 2),
+    ]
+    assert len(top_tiles(tmp_path)) == 4
+    assert top_tiles(tmp_path, since=time.time() + 60) == []
+
+    # Truncated records are ignored
+    segment = log_segments(tmp_path)[0]
+    data = segment.read_bytes()
+    segment.write_bytes(data[:-3])
+    assert len(list(read_segment(segment))) == 6
+
+
+def test_wmts_accesslog_invalid(tmp_path: Path):
+    """ Test that invalid requests do not drop buffered records
+    """
+    log = AccessLog(tmp_path)
+    log.log(PROJECT, tile(1, 1))
+    log.log(PROJECT, tile(2**32, 1))
+    log.log(PROJECT, tile(1, -1))
+    log.log(PROJECT, tile(1, 1, layer='x' * 0x10000))
+    log.log(PROJECT, tile(1, 2))
+    log.flush()
+
+    assert [(row, col) for _, _, row, col in read_segment(log_segments(tmp_path)[0])] == [(1, 1), (1, 2)]
+
+
+def test_wmts_accesslog_rotate(tmp_path: Path):
+    """ Test log segments rotation
+    """
+    log = AccessLog(tmp_path, max_size=1024, segments=4)
+    for i in range(200):
+        log.log(PROJECT, tile(i, 0))
+        log.flush()
+
+    segments = log_segments(tmp_path)
+    assert len(segments) > 1
+    assert sum(p.stat().st_size for p in segments) <= 1024
+    # Segments are self contained
+    assert all(list(read_segment(p)) for p in segments)
+    # Oldest requests are removed
+    rows = [row for (_, row, _), _ in top_tiles(tmp_path)]
+    assert 0 not in rows
+    assert max(rows) >= 190
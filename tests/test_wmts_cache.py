@@ -1,3 +1,4 @@
+import gzip
 import logging
 import os
 import shutil
@@ -200,3 +201,179 @@ def test_wmts_document_tile(client):
     cached_content = rv.content
 
     assert original_content == cached_content
+
+
+def test_wmts_tile_early_hit(client):
+    """  Test that cached tiles are served without loading the project
+    """
+    plugin = client.getplugin('wmtsCacheServer')
+    assert plugin is not None
+
+    # Create a filter
+    cachefilter = plugin.create_filter()
+
+    # Copy project
+    shutil.copy(
+        client.getprojectpath("france_parts.qgs"),
+        client.getprojectpath("france_parts_early.qgs")
+    )
+
+    project = QgsProject()
+    project.setFileName(client.getprojectpath("france_parts_early.qgs").strpath)
+
+    cachefilter.deleteCachedImages(project)
+
+    parameters = {
+        "MAP": project.fileName(),
+        "SERVICE": "WMTS",
+        "VERSION": "1.0.0",
+        "REQUEST": "GetTile",
+        "LAYER": "france_parts",
+        "STYLE": "",
+        "TILEMATRIXSET": "EPSG:4326",
+        "TILEMATRIX": "0",
+        "TILEROW": "0",
+        "TILECOL": "0",
+        "FORMAT": "image/png"
+    }
+
+    tilepath = cachefilter._cache.get_tile_cache(
+        project.fileName(), parameters
+    ).as_posix()
+
+    qs = "?" + "&".join("%s=%s" % item for item in parameters.items())
+    rv = client.get(qs, project.fileName())
+    assert rv.status_code == 200
+    assert os.path.exists(tilepath)
+
+    original_content = rv.content
+
+    # Break the project: hits must not load it
+    Path(project.fileName()).write_text("invalid project")
+
+    rv = client.get(qs, project.fileName())
+    assert rv.status_code == 200
+    assert rv.headers.get('Content-Type') == 'image/png'
+    assert rv.headers.get('X-Qgis-Debug-Cache-Path') == tilepath
+    assert rv.content == original_content
+
+    # Cached tile service cannot be requested directly
+    rv = client.get("?SERVICE=WMTSCACHE&REQUEST=GetTile")
+    assert rv.status_code == 400
+
+    # Clean files after testing
+    cachefilter.deleteCachedImages(project)
+    Path(project.fileName()).unlink()
+
+
+def test_wmts_tile_not_modified(client):
+    """  Test conditional requests on cached tiles
+    """
+    plugin = client.getplugin('wmtsCacheServer')
+    assert plugin is not None
+
+    project = QgsProject()
+    project.setFileName(client.getprojectpath("france_parts.qgs").strpath)
+
+    parameters = {
+        "MAP": project.fileName(),
+        "SERVICE": "WMTS",
+        "VERSION": "1.0.0",
+        "REQUEST": "GetTile",
+        "LAYER": "france_parts",
+        "STYLE": "",
+        "TILEMATRIXSET": "EPSG:4326",
+        "TILEMATRIX": "0",
+        "TILEROW": "0",
+        "TILECOL": "0",
+        "FORMAT": "image/png"
+    }
+
+    qs = "?" + "&".join("%s=%s" % item for item in parameters.items())
+    rv = client.get(qs, project.fileName())
+    assert rv.status_code == 200
+
+    rv = client.get(qs, project.fileName())
+    assert rv.status_code == 200
+    etag = rv.headers.get('ETag')
+    assert etag
+    assert rv.headers.get('Last-Modified')
+
+    rv = client.get(qs, project.fileName(), headers={'If-None-Match': etag})
+    assert rv.status_code == 304
+    assert rv.content == b''
+
+
+def test_wmts_document_compressed(client):
+    """  Test compressed getcapabilities response
+    """
+    plugin = client.getplugin('wmtsCacheServer')
+    assert plugin is not None
+
+    project = QgsProject()
+    project.setFileName(client.getprojectpath("france_parts.qgs").strpath)
+
+    parameters = {
+        'MAP': project.fileName(),
+        'REQUEST': 'GetCapabilities',
+        'SERVICE': 'WMTS'
+    }
+
+    qs = "?" + "&".join("%s=%s" % item for item in parameters.items())
+    rv = client.get(qs, project.fileName())
+    assert rv.status_code == 200
+
+    original_content = rv.content
+
+    rv = client.get(qs, project.fileName(), headers={'Accept-Encoding': 'gzip'})
+    assert rv.status_code == 200
+    assert rv.headers.get('Content-Encoding') == 'gzip'
+    assert rv.headers.get('Vary') == 'Accept-Encoding'
+    assert gzip.decompress(rv.content) == original_content
+
+    etag = rv.headers.get('ETag')
+    rv = client.get(qs, project.fileName(), headers={'Accept-Encoding': 'gzip', 'If-None-Match': etag})
+    assert rv.status_code == 304
+    assert rv.content == b''
+
+
+def test_wms_document_cache(client):
+    """  Test WMS getcapabilities cache
+    """
+    plugin = client.getplugin('wmtsCacheServer')
+    assert plugin is not None
+
+    cachefilter = plugin.create_filter()
+
+    project = QgsProject()
+    project.setFileName(client.getprojectpath("france_parts.qgs").strpath)
+
+    cachefilter.deleteCachedDocuments(project)
+
+    parameters = {
+        'MAP': project.fileName(),
+        'REQUEST': 'GetCapabilities',
+        'SERVICE': 'WMS'
+    }
+
+    docpath = cachefilter._cache.get_document_cache(
+        project.fileName(), parameters, '.xml'
+    ).as_posix()
+
+    qs = "?" + "&".join("%s=%s" % item for item in parameters.items())
+    rv = client.get(qs, project.fileName())
+    assert rv.status_code == 200
+    assert os.path.exists(docpath)
+
+    original_content = rv.content
+
+    # Cache busting parameters are ignored
+    rv = client.get(qs + "&_=1234", project.fileName())
+    assert rv.status_code == 200
+    assert rv.headers.get('X-Qgis-Debug-Cache-Path') == docpath
+    assert rv.content == original_content
+
+    # WFS documents are not cached
+    rv = client.get(qs.replace('WMS', 'WFS'), project.fileName())
+    assert rv.status_code == 200
+    assert rv.headers.get('X-Qgis-Debug-Cache-Path') is None
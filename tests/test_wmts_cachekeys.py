@@ -0,0 +1,107 @@
+from pathlib import Path
+
+from wmtsCacheServer.cachekeys import KeyStats, canonical_key, canonical_params
+from wmtsCacheServer.helper import CacheHelper
+
+PROJECT = '/data/france_parts.qgs'
+
+
+def test_wmts_canonical_params():
+    """ Test normalization of request parameters
+    """
+    params = canonical_params({
+        'map': PROJECT,
+        'Service': 'wmts',
+        'REQUEST': 'GetCapabilities',
+        'VERSION': ' 1.0.0',
+        '_': '1234',
+        'SECTIONS': '',
+    })
+    assert params == {'SERVICE': 'WMTS', 'REQUEST': 'GETCAPABILITIES', 'VERSION': '1.0.0'}
+    assert canonical_key(params) == 'REQUEST=GETCAPABILITIES&SERVICE=WMTS&VERSION=1.0.0'
+
+    params = canonical_params({
+        'SERVICE': 'WMTS',
+        'REQUEST': 'gettile',
+        'LAYER': 'france_parts',
+        'STYLE': 'default',
+        'TILEMATRIXSET': 'EPSG:4326',
+        'TILEMATRIX': '0',
+        'TILEROW': '00',
+        'TILECOL': '0',
+        'FORMAT': 'image/PNG; mode=8bit',
+    })
+    assert params['FORMAT'] == 'image/png'
+    assert params['TILEROW'] == '0'
+    assert 'STYLE' not in params
+
+    # Non ASCII digits are kept as is
+    params = canonical_params({'SERVICE': 'WMTS', 'REQUEST': 'GetTile', 'TILEROW': '\u00b2'})
+    assert params['TILEROW'] == '\u00b2'
+
+    # Other requests keep all parameters
+    params = canonical_params({'MAP': PROJECT, 'SERVICE': 'WMS', 'REQUEST': 'GetMap', 'LAYERS': 'a'})
+    assert params == {'SERVICE': 'WMS', 'REQUEST': 'GETMAP', 'LAYERS': 'a'}
+
+
+def test_wmts_canonical_cache(tmp_path: Path):
+    """ Test that equivalent requests share cached content
+    """
+    helper = CacheHelper(tmp_path, 'tc')
+
+    tile = {
+        'SERVICE': 'WMTS',
+        'REQUEST': 'GetTile',
+        'LAYER': 'france_parts',
+        'STYLE': '',
+        'TILEMATRIXSET': 'EPSG:4326',
+        'TILEMATRIX': '0',
+        'TILEROW': '0',
+        'TILECOL': '0',
+        'FORMAT': 'image/png',
+    }
+    p = helper.get_tile_cache(PROJECT, tile)
+    assert helper.get_tile_cache(PROJECT, dict(tile, STYLE='default')) == p
+    assert helper.get_tile_cache(PROJECT, dict(tile, FORMAT='image/png; mode=8bit')) == p
+    assert helper.get_tile_cache(PROJECT, dict(tile, STYLE='other')) != p
+
+    doc = {'MAP': PROJECT, 'SERVICE': 'WMTS', 'REQUEST': 'GetCapabilities'}
+    p = helper.get_document_cache(PROJECT, doc)
+    assert helper.get_document_cache(PROJECT, dict(doc, _='1234')) == p
+    assert helper.get_document_cache(PROJECT, dict(doc, REQUEST='getcapabilities')) == p
+
+
+def test_wmts_keystats():
+    """ Test counting raw requests collapsed on canonical keys
+    """
+    stats = KeyStats()
+    doc = {'MAP': PROJECT, 'SERVICE': 'WMTS', 'REQUEST': 'GetCapabilities'}
+    for raw in (doc, dict(doc, _='1234'), dict(doc, REQUEST='getcapabilities'), doc,
+                {'SERVICE': 'WMS', 'REQUEST': 'GetCapabilities'}):
+        stats.record(raw, canonical_key(canonical_params(raw)))
+
+    result = stats.stats()
+    assert result['canonical_keys'] == 2
+    assert result['raw_keys'] == 4
+    assert result['collapsed'] == 2
+    assert result['top'][0]['raw_keys'] == 3
+
+
+def test_wmts_keystats_bound():
+    """ Test that least recently requested keys are evicted
+    """
+    stats = KeyStats(maxkeys=3)
+    stats.record({'_': '0'}, 'a')
+    stats.record({'_': '0'}, 'b')
+    stats.record({'_': '1'}, 'b')
+    stats.record({'_': '0'}, 'a')
+    stats.record({'_': '0'}, 'c')
+    assert stats.collapsed('b') == 0
+    assert (stats.collapsed('a'), stats.collapsed('c')) == (1, 1)
+    assert stats.evicted == 1
+
+    # A single key is bounded
+    for i in range(5):
+        stats.record({'_': str(i)}, 'd')
+    assert stats.collapsed('d') == 3
+    assert stats.stats()['raw_keys'] == 3
@@ -1,6 +1,7 @@
 import json
 import logging
 import os
+import time
 
 from shutil import rmtree
 
@@ -11,6 +12,24 @@ from qgis.core import QgsProject
 LOGGER = logging.getLogger('server')
 
 
+def wait_job(client, rv, timeout: float=10):
+    """ Wait for the job of an accepted request
+    """
+    job = json.loads(rv.content)['job']
+    assert rv.headers.get('Location') == job['href']
+    qs = "/wmtscache/jobs/{}".format(job['id'])
+    start = time.time()
+    while time.time() - start < timeout:
+        rv = client.get(qs)
+        assert rv.status_code == 200
+        json_content = json.loads(rv.content)
+        if json_content['state'] not in ('queued', 'running'):
+            assert json_content['state'] == 'done'
+            return json_content
+        time.sleep(0.1)
+    raise AssertionError("Job %s not finished" % job['id'])
+
+
 def test_wmts_cachemngrapi_empty_cache(client):
     """ Test the API with empty cache
         /wmtscache
@@ -421,7 +440,8 @@ def test_wmts_cachemngrapi_delete_layer(client):
     # Delete layer tiles
     qs = "/wmtscache/collections/{}/layers/{}".format(collection['id'], layer['id'])
     rv = client.delete(qs)
-    assert rv.status_code == 200
+    assert rv.status_code == 202
+    wait_job(client, rv)
 
     # Get layer tiles info
     qs = "/wmtscache/collections/{}/layers/{}".format(collection['id'], layer['id'])
@@ -532,7 +552,8 @@ def test_wmts_cachemngrapi_delete_layers(client):
     # Delete layers tiles
     qs = "/wmtscache/collections/{}/layers".format(collection['id'])
     rv = client.delete(qs)
-    assert rv.status_code == 200
+    assert rv.status_code == 202
+    wait_job(client, rv)
 
     # Get layers info
     qs = "/wmtscache/collections/{}/layers".format(collection['id'])
@@ -680,7 +701,8 @@ def test_wmts_cachemngrapi_delete_collection(client):
     # Delete collection documents and layers tiles
     qs = "/wmtscache/collections/{}".format(collection['id'])
     rv = client.delete(qs)
-    assert rv.status_code == 200
+    assert rv.status_code == 202
+    wait_job(client, rv)
 
     # Get docs info
     qs = "/wmtscache/collections/{}/docs".format(collection['id'])
@@ -850,3 +872,80 @@ def test_wmts_cachemngrapi_collectionid_error(client):
     assert 'error' in json_content
     assert json_content['error'].get('message') == "Collection 'foobar' not found"
 
+
+def test_wmts_cachemngrapi_tiles(client):
+    """ Test the API to check cached tiles
+        /wmtscache/collection/(?<collectionId>[^/]+?)/layers/(?<layerId>[^/]+?)/tiles/...
+        /wmtscache/collection/(?<collectionId>[^/]+?)/tiles
+    """
+    plugin = client.getplugin('wmtsCacheServer')
+    assert plugin is not None
+
+    cachefilter = plugin.create_filter()
+
+    project = QgsProject()
+    project.setFileName(client.getprojectpath("france_parts.qgs").strpath)
+    cachefilter.deleteCachedImages(project)
+
+    parameters = {
+        "MAP": project.fileName(),
+        "SERVICE": "WMTS",
+        "VERSION": "1.0.0",
+        "REQUEST": "GetTile",
+        "LAYER": "france_parts",
+        "STYLE": "",
+        "TILEMATRIXSET": "EPSG:4326",
+        "TILEMATRIX": "0",
+        "TILEROW": "0",
+        "TILECOL": "0",
+        "FORMAT": "image/png"
+    }
+
+    qs = "?" + "&".join("%s=%s" % item for item in parameters.items())
+    rv = client.get(qs, project.fileName())
+    assert rv.status_code == 200
+    original_content = rv.content
+
+    rv = client.get("/wmtscache/collections")
+    collection = json.loads(rv.content)['collections'][0]
+
+    # Cached tile content
+    qs = "/wmtscache/collections/{}/layers/france_parts/tiles/EPSG:4326/0/0/0.png".format(collection['id'])
+    rv = client.get(qs)
+    assert rv.status_code == 200
+    assert rv.headers.get('Content-Type') == 'image/png'
+    assert rv.headers.get('ETag')
+    assert rv.content == original_content
+
+    rv = client.head(qs)
+    assert rv.status_code == 200
+    assert rv.headers.get('Content-Length') == str(len(original_content))
+
+    # Cached tile metadata
+    rv = client.get(qs + "?f=json")
+    assert rv.status_code == 200
+    json_content = json.loads(rv.content)
+    assert json_content['size'] == len(original_content)
+    assert json_content['etag'] == rv.headers.get('ETag')
+
+    # Not cached tiles are not rendered
+    qs = "/wmtscache/collections/{}/layers/france_parts/tiles/EPSG:4326/0/0/1.png".format(collection['id'])
+    rv = client.get(qs)
+    assert rv.status_code == 404
+
+    # Batch
+    qs = "/wmtscache/collections/{}/tiles".format(collection['id'])
+    body = {
+        'layer': 'france_parts',
+        'tilematrixset': 'EPSG:4326',
+        'tiles': [
+            {'tilematrix': '0', 'tilerow': 0, 'tilecol': 0},
+            {'tilematrix': '0', 'tilerow': 0, 'tilecol': 1},
+        ],
+    }
+    rv = client.post(qs, data=json.dumps(body).encode())
+    assert rv.status_code == 200
+    json_content = json.loads(rv.content)
+    assert json_content['cached'] == 1
+    assert [t['cached'] for t in json_content['tiles']] == [True, False]
+    assert json_content['tiles'][0]['size'] == len(original_content)
@@ -0,0 +1,46 @@
+import gzip
+import os
+
+from pathlib import Path
+
+from wmtsCacheServer.compression import (
+    accepted_encodings,
+    negotiate,
+    remove_variants,
+    variant_path,
+    write_variants,
+)
+
+
+def test_wmts_accepted_encodings():
+    """ Test parsing Accept-Encoding header
+    """
+    assert accepted_encodings(None) == {}
+    assert accepted_encodings('gzip, deflate;q=0.5, br;q=0') == {'gzip': 1.0, 'deflate': 0.5, 'br': 0.}
+
+
+def test_wmts_compressed_variants(tmp_path: Path):
+    """ Test writing and negotiating compressed variants
+    """
+    doc = tmp_path / 'doc.xml'
+    data = b'<Capabilities>' + b'<Layer/>' * 1000 + b'</Capabilities>'
+    doc.write_bytes(data)
+
+    write_variants(doc, data, [('gzip', 6), ('unknown', 1)])
+    gz = variant_path(doc, 'gzip')
+    assert gz.name == 'doc.xml.gz'
+    assert gzip.decompress(gz.read_bytes()) == data
+
+    assert negotiate(doc, None) is None
+    assert negotiate(doc, 'identity') is None
+    assert negotiate(doc, 'gzip;q=0') is None
+    assert negotiate(doc, 'deflate, gzip') == ('gzip', gz)
+    assert negotiate(doc, '*') == ('gzip', gz)
+
+    # Outdated variants are ignored
+    st = doc.stat()
+    os.utime(gz, ns=(st.st_atime_ns, st.st_mtime_ns - 10**9))
+    assert negotiate(doc, 'gzip') is None
+
+    remove_variants(doc)
+    assert not gz.exists()
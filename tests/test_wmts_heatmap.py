@@ -0,0 +1,70 @@
+import struct
+import zlib
+
+from hashlib import md5
+from pathlib import Path
+
+from wmtsCacheServer.heatmap import (
+    GRID_SIZE,
+    HeatGrid,
+    HeatMap,
+    heatmap_path,
+    heatmap_tilematrixsets,
+)
+
+PROJECT = '/data/france_parts.qgs'
+
+
+def test_wmts_heatmap_grid():
+    """ Test counting tiles by blocks
+    """
+    grid = HeatGrid()
+    grid.add({(0, 0): 2, (3, 5): 1})
+    assert (grid.shift, grid.width, grid.height) == (0, 6, 4)
+    assert grid.get(3, 5) == 1
+
+    # Blocks are merged when tiles do not fit in the grid
+    grid.add({(GRID_SIZE, 2 * GRID_SIZE - 1): 4})
+    assert grid.shift == 1
+    assert grid.width <= GRID_SIZE and grid.height <= GRID_SIZE
+    assert list(grid.blocks()) == [(0, 0, 2), (2, 4, 1), (GRID_SIZE, 2 * GRID_SIZE - 2, 4)]
+
+    grid = HeatGrid.loads(grid.dumps())
+    assert sum(n for _, _, n in grid.blocks()) == 7
+
+
+def test_wmts_heatmap_png():
+    """ Test density image
+    """
+    grid = HeatGrid()
+    grid.add({(0, 0): 1, (1, 1): 100})
+    data = grid.png()
+    assert data.startswith(b'\x89PNG\r\n\x1a\n')
+    width, height = struct.unpack('>II', data[16:24])
+    assert (width, height) == (2, 2)
+    idat = data.index(b'IDAT')
+    size = struct.unpack('>I', data[idat-4:idat])[0]
+    raw = zlib.decompress(data[idat+4:idat+4+size])
+    assert len(raw) == height * (1 + 4 * width)
+    # Empty blocks are transparent
+    assert raw[1+4:1+8] == b'\0\0\0\0'
+
+    assert HeatGrid().png().startswith(b'\x89PNG')
+
+
+def test_wmts_heatmap_flush(tmp_path: Path):
+    """ Test storing counts
+    """
+    heatmap = HeatMap(tmp_path, interval=3600)
+    params = {'LAYER': 'france_parts', 'TILEMATRIXSET': 'EPSG:3857', 'TILEMATRIX': '5'}
+    for _ in range(3):
+        heatmap.record(PROJECT, dict(params, TILEROW='10', TILECOL='12'))
+    heatmap.record(PROJECT, dict(params, TILEROW='x', TILECOL='12'))
+    heatmap.flush()
+    heatmap.record(PROJECT, dict(params, TILEROW='10', TILECOL='12'))
+    heatmap.flush()
+
+    projecthash = md5(PROJECT.encode()).hexdigest()
+    assert heatmap_tilematrixsets(tmp_path, projecthash, 'france_parts') == ['EPSG:3857']
+    grid = HeatGrid.load(heatmap_path(tmp_path, projecthash, 'france_parts', 'EPSG:3857', '5'))
+    assert list(grid.blocks()) == [(10, 12, 4)]
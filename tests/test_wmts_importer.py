@@ -0,0 +1,115 @@
+import io
+import sqlite3
+import tarfile
+
+from pathlib import Path
+
+from wmtsCacheServer.helper import CacheHelper
+from wmtsCacheServer.importer import TileImporter, iter_source, tile_ref
+from wmtsCacheServer.policy import PolicyConfig
+from wmtsCacheServer.tiers import TieredStorage
+
+PROJECT = '/data/france_parts.qgs'
+
+OPTIONS = {'layer': 'france_parts', 'tilematrixset': 'EPSG:3857'}
+
+
+def tile_path(cache: CacheHelper, row: int, col: int, tilematrix: str='1',
+              tilematrixset: str='EPSG:3857', fmt: str='image/png') -> Path:
+    return cache.get_tile_cache(PROJECT, {
+        'LAYER': 'france_parts',
+        'TILEMATRIXSET': tilematrixset,
+        'TILEMATRIX': tilematrix,
+        'TILEROW': str(row),
+        'TILECOL': str(col),
+        'FORMAT': fmt,
+    })
+
+
+def test_wmts_importer_tile_ref():
+    """ Test tile names
+    """
+    tile = tile_ref('france_parts/default/EPSG:4326/3/1/2.png', {})
+    assert tile.params()['LAYER'] == 'france_parts'
+    assert tile.style == ''
+    assert (tile.tilematrixset, tile.tilematrix, tile.tilerow, tile.tilecol) == ('EPSG:4326', '3', 1, 2)
+
+    tile = tile_ref('./3/1/2.jpg', OPTIONS)
+    assert (tile.layer, tile.tilematrixset, tile.format) == ('france_parts', 'EPSG:3857', 'image/jpeg')
+
+    assert tile_ref('3/1/2.png', {}) is None
+    assert tile_ref('3/1/2.txt', OPTIONS) is None
+    assert tile_ref('3/a/2.png', OPTIONS) is None
+
+
+def test_wmts_importer_dir(tmp_path: Path):
+    """ Test importing a directory
+    """
+    src = tmp_path / 'src'
+    for row in range(2):
+        for col in range(2):
+            p = src / 'france_parts' / 'default' / 'EPSG:3857' / '1' / str(row) / ('%d.png' % col)
+            p.parent.mkdir(parents=True, exist_ok=True)
+            p.write_bytes(b'tile %d %d' % (row, col))
+    (src / 'README').write_text('not a tile')
+
+    rootdir = tmp_path / 'root'
+    rootdir.mkdir()
+    storage = TieredStorage(rootdir)
+    cache = CacheHelper(rootdir, 'tc', storage.shards)
+
+    importer = TileImporter(storage, cache, PolicyConfig(), PROJECT, workers=2)
+    stats = importer.run(iter_source(src, {}))
+    assert stats == {'imported': 4, 'skipped': 0}
+    assert tile_path(cache, 1, 0).read_bytes() == b'tile 1 0'
+
+    # Tiles excluded by the policy are skipped
+    policy = PolicyConfig({'default': {'maxzoom': 0}})
+    stats = TileImporter(storage, cache, policy, PROJECT).run(iter_source(src, {}))
+    assert stats == {'imported': 0, 'skipped': 4}
+
+
+def test_wmts_importer_tar(tmp_path: Path):
+    """ Test importing a tar archive
+    """
+    archive = tmp_path / 'tiles.tar.gz'
+    with tarfile.open(archive.as_posix(), 'w:gz') as tar:
+        for col in range(3):
+            data = b'tile %d' % col
+            info = tarfile.TarInfo('1/0/%d.png' % col)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+
+    rootdir = tmp_path / 'root'
+    rootdir.mkdir()
+    storage = TieredStorage(rootdir)
+    cache = CacheHelper(rootdir, 'tc', storage.shards)
+
+    stats = TileImporter(storage, cache, PolicyConfig(), PROJECT).run(iter_source(archive, OPTIONS))
+    assert stats['imported'] == 3
+    assert tile_path(cache, 0, 2).read_bytes() == b'tile 2'
+
+
+def test_wmts_importer_mbtiles(tmp_path: Path):
+    """ Test importing a MBTiles file
+    """
+    mbtiles = tmp_path / 'tiles.mbtiles'
+    conn = sqlite3.connect(mbtiles.as_posix())
+    conn.execute("CREATE TABLE metadata (name text, value text)")
+    conn.execute("CREATE TABLE tiles (zoom_level integer, tile_column integer, tile_row integer, tile_data blob)")
+    conn.execute("INSERT INTO metadata VALUES ('format', 'jpg')")
+    # TMS row 0 is the bottom row
+    conn.execute("INSERT INTO tiles VALUES (1, 1, 0, ?)", (b'bottom',))
+    conn.execute("INSERT INTO tiles VALUES (1, 1, 1, ?)", (b'top',))
+    conn.commit()
+    conn.close()
+
+    rootdir = tmp_path / 'root'
+    rootdir.mkdir()
+    storage = TieredStorage(rootdir)
+    cache = CacheHelper(rootdir, 'tc', storage.shards)
+
+    stats = TileImporter(storage, cache, PolicyConfig(), PROJECT).run(iter_source(mbtiles, OPTIONS))
+    assert stats['imported'] == 2
+    assert tile_path(cache, 0, 1, fmt='image/jpeg').read_bytes() == b'top'
+    assert tile_path(cache, 1, 1, fmt='image/jpeg').read_bytes() == b'bottom'
@@ -0,0 +1,157 @@
+import threading
+import time
+
+from pathlib import Path
+
+from wmtsCacheServer.helper import CacheHelper
+from wmtsCacheServer.jobs import (
+    CANCELLED,
+    DONE,
+    FAILED,
+    QUEUED,
+    RUNNING,
+    JobQueue,
+    delete_tiles,
+)
+from wmtsCacheServer.tiers import TieredStorage
+
+PROJECT = '/data/france_parts.qgs'
+
+
+def wait(queue: JobQueue, jobid: str, timeout: float=5) -> dict:
+    start = time.time()
+    while time.time() - start < timeout:
+        job = queue.get(jobid)
+        if job['state'] not in (QUEUED, RUNNING):
+            return job
+        time.sleep(0.05)
+    raise AssertionError("Job %s not finished" % jobid)
+
+
+def test_wmts_jobs_run(tmp_path: Path):
+    """ Test running jobs
+    """
+    queue = JobQueue(tmp_path, poll=0.1)
+
+    def count(job, params):
+        for i in range(params['count']):
+            job.progress(i + 1, params['count'])
+
+    def fail(job, params):
+        raise ValueError('failed')
+
+    queue.register('count', count)
+    queue.register('fail', fail)
+    queue.start()
+
+    job = wait(queue, queue.submit('count', {'count': 10})['id'])
+    assert job['state'] == DONE
+    assert job['done'] == job['total'] == 10
+    assert job['runs'] == 1
+
+    job = wait(queue, queue.submit('fail', {})['id'])
+    assert job['state'] == FAILED
+    assert job['error'] == 'failed'
+
+    assert [j['kind'] for j in queue.jobs()] == ['count', 'fail']
+    assert queue.get('../../etc/passwd') is None
+
+
+def test_wmts_jobs_cancel(tmp_path: Path):
+    """ Test cancelling queued and running jobs
+    """
+    queue = JobQueue(tmp_path, poll=0.1)
+    started = threading.Event()
+
+    def loop(job, params):
+        started.set()
+        while not job.cancelled():
+            time.sleep(0.05)
+
+    queue.register('loop', loop)
+
+    # Queued job
+    jobid = queue.submit('loop', {})['id']
+    assert queue.cancel(jobid)['state'] == CANCELLED
+
+    queue.start()
+    jobid = queue.submit('loop', {})['id']
+    assert started.wait(5)
+    assert queue.cancel(jobid)['state'] == RUNNING
+    assert wait(queue, jobid)['state'] == CANCELLED
+
+
+def test_wmts_jobs_restart(tmp_path: Path):
+    """ Test that jobs survive restarts
+    """
+    queue = JobQueue(tmp_path, poll=0.1)
+    record = queue.submit('count', {})
+    # Left running by a stopped process
+    record['state'] = RUNNING
+    record['runs'] = 1
+    queue.save(record)
+
+    queue = JobQueue(tmp_path, poll=0.1)
+    queue.register('count', lambda job, params: job.progress(1, 1))
+    queue.start()
+    job = wait(queue, record['id'])
+    assert job['state'] == DONE
+    assert job['runs'] == 2
+
+
+def test_wmts_jobs_schedule(tmp_path: Path):
+    """ Test purging tiles retired before a restart
+    """
+    (tmp_path / 'cache').mkdir()
+    storage = TieredStorage(tmp_path / 'cache', grace=3600)
+    cache = CacheHelper(storage.rootdir, 'tc', storage.shards)
+    tiles = cache.get_tiles_root(PROJECT)
+    tiles.mkdir(parents=True)
+    (tiles / 'tile.png').write_bytes(b'data')
+    assert storage.retire(tiles)
+    retired = storage.rootdir / '.retired'
+    assert any(retired.iterdir())
+
+    # The grace period timer is lost on restart
+    queue = JobQueue(tmp_path, poll=0.1)
+    runs = []
+    queue.schedule(lambda: runs.append(storage.purge_retired(grace=0)), 3600)
+    queue.start()
+    start = time.time()
+    while not runs and time.time() - start < 5:
+        time.sleep(0.05)
+    assert runs == [1]
+    assert not any(retired.iterdir())
+
+    # Not run again before the interval
+    time.sleep(0.3)
+    assert runs == [1]
+
+
+def test_wmts_jobs_delete_tiles(tmp_path: Path):
+    """ Test removing tiles with progress
+    """
+    rootdir = tmp_path / 'root'
+    rootdir.mkdir()
+    storage = TieredStorage(rootdir)
+    cache = CacheHelper(rootdir, 'tc', storage.shards)
+    for col in range(4):
+        params = {
+            'LAYER': 'france_parts',
+            'TILEMATRIXSET': 'EPSG:4326',
+            'TILEMATRIX': '1',
+            'TILEROW': '0',
+            'TILECOL': str(col),
+        }
+        storage.write(cache.get_tile_cache(PROJECT, params, create_dir=True), b'data', dedup=True)
+
+    tiledir = cache.get_tiles_root(PROJECT)
+    assert storage.count_files(tiledir) == 4
+
+    queue = JobQueue(rootdir, poll=0.1)
+    queue.register('delete', lambda job, params: delete_tiles(storage, job, params))
+    queue.start()
+    job = wait(queue, queue.submit('delete', {'paths': [str(tiledir)]})['id'])
+    assert job['state'] == DONE
+    assert job['done'] == job['total'] == 4
+    assert not tiledir.exists()
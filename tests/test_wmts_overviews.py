@@ -0,0 +1,155 @@
+import io
+
+from pathlib import Path
+from typing import Optional
+
+import pytest
+
+from wmtsCacheServer.helper import CacheHelper
+from wmtsCacheServer.overviews import (
+    build_overviews,
+    build_tile,
+    overview_levels,
+)
+from wmtsCacheServer.policy import PolicyConfig
+from wmtsCacheServer.seeder import tile_params
+from wmtsCacheServer.tiers import TieredStorage
+from wmtsCacheServer.tilematrix import (
+    TileMatrix,
+    TileMatrixInfos,
+    TileMatrixSet,
+)
+
+numpy = pytest.importorskip('numpy')
+Image = pytest.importorskip('PIL.Image')
+
+PROJECT = '/data/france_parts.qgs'
+
+ORIGIN = 20037508.3427892
+
+SIZE = 16
+
+
+def tilematrix_infos(levels: int=3, limits: Optional[dict]=None) -> TileMatrixInfos:
+    matrices = {}
+    for z in range(levels):
+        matrices[str(z)] = TileMatrix(str(z), 559082264.0287178 / (1 << z), (-ORIGIN, ORIGIN),
+                                      SIZE, SIZE, 1 << z, 1 << z)
+    tms = TileMatrixSet('EPSG:3857', 'EPSG:3857', matrices)
+    limits = {'france_parts': {'EPSG:3857': limits}} if limits else {}
+    return TileMatrixInfos({'EPSG:3857': tms}, limits, 0)
+
+
+def png(color: tuple) -> bytes:
+    buf = io.BytesIO()
+    Image.new('RGBA', (SIZE, SIZE), color).save(buf, 'PNG')
+    return buf.getvalue()
+
+
+def test_wmts_overviews_levels():
+    """ Test checking tile matrices alignment
+    """
+    matrices = list(tilematrix_infos().tilematrixsets['EPSG:3857'].matrices.values())
+    levels = overview_levels(matrices, '2')
+    assert [(lv.target.identifier, lv.source.identifier, lv.ratio) for lv in levels] == \
+        [('1', '2', 2), ('0', '1', 2)]
+    assert len(overview_levels(matrices, '2', '1')) == 1
+
+    with pytest.raises(ValueError):
+        overview_levels(matrices, '0')
+
+    matrices[1] = matrices[1]._replace(scale_denominator=matrices[1].scale_denominator * 1.5)
+    with pytest.raises(ValueError):
+        overview_levels(matrices, '2')
+
+
+def test_wmts_overviews_build_tile(tmp_path: Path):
+    """ Test mosaicking and downsampling children tiles
+    """
+    red = tmp_path / 'red.png'
+    red.write_bytes(png((255, 0, 0, 255)))
+    blue = tmp_path / 'blue.png'
+    blue.write_bytes(png((0, 0, 255, 128)))
+
+    data = build_tile([red.as_posix(), None, None, blue.as_posix()], 2, SIZE, SIZE, 'image/png')
+    pixels = numpy.asarray(Image.open(io.BytesIO(data)))
+    assert pixels.shape == (SIZE, SIZE, 4)
+    assert tuple(pixels[0, 0]) == (255, 0, 0, 255)
+    assert tuple(pixels[0, -1]) == (0, 0, 0, 0)
+    # Transparent pixels do not darken colors
+    assert tuple(pixels[-1, -1]) == (0, 0, 255, 128)
+
+    data = build_tile([red.as_posix(), None, None, None], 2, SIZE, SIZE, 'image/jpeg')
+    pixels = numpy.asarray(Image.open(io.BytesIO(data)), dtype=int)
+    assert pixels.shape == (SIZE, SIZE, 3)
+    assert numpy.abs(pixels[-4, -4] - (255, 255, 255)).max() < 8
+
+
+def test_wmts_overviews_build(tmp_path: Path):
+    """ Test building overviews from cached tiles
+    """
+    storage = TieredStorage(tmp_path)
+    cache = CacheHelper(tmp_path, 'tc', storage.shards)
+    infos = tilematrix_infos()
+
+    def tile_path(tm, row, col):
+        return cache.get_tile_cache(PROJECT, tile_params('france_parts', '', 'EPSG:3857', tm, row, col,
+                                                         'image/png'), create_dir=True)
+
+    for row, col in ((0, 0), (0, 1), (1, 0), (1, 1), (3, 3)):
+        storage.write(tile_path('2', row, col), png((0, 255, 0, 255)))
+
+    with pytest.raises(ValueError):
+        build_overviews(storage, cache, PolicyConfig(), PROJECT, infos, 'france_parts', 'EPSG:3857', '2')
+
+    policy = PolicyConfig({'default': {'overviews': True}})
+    stats = build_overviews(storage, cache, policy, PROJECT, infos, 'france_parts', 'EPSG:3857', '2',
+                            workers=2)
+    # Tiles with missing children are not built
+    assert stats == {'built': 1, 'skipped': 0, 'empty': 2, 'partial': 2}
+    assert storage.find(tile_path('1', 0, 0))[1] is not None
+    assert storage.find(tile_path('1', 1, 1))[1] is None
+    assert storage.find(tile_path('0', 0, 0))[1] is None
+
+    pixels = numpy.asarray(Image.open(storage.find(tile_path('1', 0, 0))[1]))
+    assert tuple(pixels[0, 0]) == tuple(pixels[-1, -1]) == (0, 255, 0, 255)
+
+    for row in range(4):
+        for col in range(4):
+            if not storage.find(tile_path('2', row, col))[1]:
+                storage.write(tile_path('2', row, col), png((0, 0, 255, 128)))
+
+    # Existing tiles are not built again
+    stats = build_overviews(storage, cache, policy, PROJECT, infos, 'france_parts', 'EPSG:3857', '2',
+                            workers=2)
+    assert stats == {'built': 4, 'skipped': 1, 'empty': 0, 'partial': 0}
+
+    pixels = numpy.asarray(Image.open(storage.find(tile_path('0', 0, 0))[1]))
+    assert tuple(pixels[0, 0]) == (0, 255, 0, 255)
+    assert tuple(pixels[-1, 0]) == (0, 0, 255, 128)
+
+
+def test_wmts_overviews_build_limits(tmp_path: Path):
+    """ Test building overviews of a layer with tile matrix limits
+    """
+    storage = TieredStorage(tmp_path)
+    cache = CacheHelper(tmp_path, 'tc', storage.shards)
+    infos = tilematrix_infos(4, {'3': (2, 5, 2, 5), '2': (1, 2, 1, 2), '1': (0, 1, 0, 1), '0': (0, 0, 0, 0)})
+
+    def tile_path(tm, row, col):
+        return cache.get_tile_cache(PROJECT, tile_params('france_parts', '', 'EPSG:3857', tm, row, col,
+                                                         'image/png'), create_dir=True)
+
+    for row in range(2, 6):
+        for col in range(2, 6):
+            storage.write(tile_path('3', row, col), png((0, 255, 0, 255)))
+
+    policy = PolicyConfig({'default': {'overviews': True}})
+    stats = build_overviews(storage, cache, policy, PROJECT, infos, 'france_parts', 'EPSG:3857', '3',
+                            workers=2)
+    # Tiles outside the layer limits are not missing
+    assert stats == {'built': 9, 'skipped': 0, 'empty': 0, 'partial': 0}
+
+    pixels = numpy.asarray(Image.open(storage.find(tile_path('0', 0, 0))[1]))
+    assert tuple(pixels[SIZE // 2, SIZE // 2]) == (0, 255, 0, 255)
+    assert tuple(pixels[0, 0]) == (0, 0, 0, 0)
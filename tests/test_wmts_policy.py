@@ -0,0 +1,130 @@
+import json
+
+from pathlib import Path
+
+import pytest
+
+from wmtsCacheServer.policy import PolicyConfig, load_policy
+from wmtsCacheServer.renderer import RenderHealth
+
+
+def test_wmts_policy_resolve(tmp_path: Path):
+    """ Test policy resolution for project and layers
+    """
+    config = {
+        'default': { 'ttl': 3600 },
+        'projects': [
+            {
+                'match': '*/france_*.qgs',
+                'maxzoom': 10,
+                'layers': {
+                    'osm*': { 'cache': False },
+                    '*': { 'layout': 'mp' },
+                },
+            },
+            {
+                'match': '*',
+                'minzoom': 2,
+            },
+        ],
+    }
+
+    policyfile = tmp_path / 'policy.json'
+    policyfile.write_text(json.dumps(config))
+
+    policy = load_policy(policyfile)
+
+    p = policy.resolve('/data/france_parts.qgs', 'osm_background')
+    assert not p.cache
+    assert p.ttl == 3600
+
+    p = policy.resolve('/data/france_parts.qgs', 'france_parts')
+    assert p.cache
+    assert p.layout == 'mp'
+    assert p.accept_zoom('10')
+    assert not p.accept_zoom('11')
+
+    p = policy.resolve('/data/other.qgs', 'france_parts')
+    assert p.layout is None
+    assert not p.accept_zoom('1')
+    assert p.accept_zoom('2')
+
+    # Resolved policies are cached
+    assert policy.project('/data/other.qgs') is policy.project('/data/other.qgs')
+
+
+def test_wmts_policy_globs():
+    """ Test first matching glob with several wildcards
+    """
+    policy = PolicyConfig({
+        'projects': [
+            {'match': '/data/a*b*c.qgs', 'ttl': 1},
+            {'match': '*/france_*.qgs', 'ttl': 2, 'layers': {'a*b*': {'ttl': 3}, '*_*': {'ttl': 4}}},
+        ],
+    })
+    assert policy.resolve('/data/axbxc.qgs', 'layer').ttl == 1
+    assert policy.resolve('/data/france_parts.qgs', 'layer').ttl == 2
+    assert policy.resolve('/data/france_parts.qgs', 'aabb_c').ttl == 3
+    assert policy.resolve('/data/france_parts.qgs', 'osm_roads').ttl == 4
+    assert policy.resolve('/data/other.qgs', 'layer').ttl is None
+
+
+def test_wmts_policy_dedup_ttl():
+    """ Test rejecting deduplication of expiring tiles
+    """
+    with pytest.raises(ValueError):
+        PolicyConfig({'default': {'dedup': True, 'ttl': 60}})
+    with pytest.raises(ValueError):
+        PolicyConfig({'default': {'ttl': 60}, 'projects': [{'match': '*', 'layers': {'*': {'dedup': True}}}]})
+
+
+def test_wmts_policy_default():
+    """ Test default policy
+    """
+    policy = PolicyConfig()
+    p = policy.resolve('/data/france_parts.qgs', 'france_parts')
+    assert p.cache
+    assert p.ttl is None
+    assert p.accept_zoom('0')
+
+
+def test_wmts_policy_tile_state():
+    """ Test tile states from time to live
+    """
+    policy = PolicyConfig({'default': {'ttl': 60, 'max_stale': 600}}).resolve('/data/project.qgs', 'layer')
+    assert policy.tile_state(30) == 'fresh'
+    assert policy.tile_state(120) == 'stale'
+    assert policy.tile_state(1200) == 'expired'
+
+    policy = PolicyConfig({'default': {'ttl': 60}}).resolve('/data/project.qgs', 'layer')
+    assert policy.tile_state(120) == 'expired'
+
+
+def test_wmts_policy_render_budget():
+    """ Test degraded layers from render budget
+    """
+    policy = PolicyConfig({'default': {'render_budget': 2}}).resolve('/data/project.qgs', 'layer')
+    assert policy.render_budget == 2.0
+
+    key = ('/data/project.qgs', 'layer')
+    health = RenderHealth(probe_delay=3600)
+    assert not health.degraded(key, policy.render_budget)
+    health.record(key, 1.0)
+    assert not health.degraded(key, policy.render_budget)
+
+    # Slow renders
+    health.record(key, 10.0)
+    assert health.render_time(key) == 0.3 * 10.0 + 0.7 * 1.0
+    assert health.degraded(key, policy.render_budget)
+
+    # Failed renders
+    health.record(key, 0.5)
+    health.record(key, 0.5)
+    health.record(key, 0.5)
+    assert not health.degraded(key, policy.render_budget)
+    health.record(key, None)
+    assert health.degraded(key, policy.render_budget)
+
+    # Probe render
+    health.probe_delay = 0
+    assert not health.degraded(key, policy.render_budget)
@@ -0,0 +1,83 @@
+import time
+
+from wmtsCacheServer.prefetch import Prefetcher, neighbour_tiles
+from wmtsCacheServer.tilematrix import (
+    TileMatrix,
+    TileMatrixInfos,
+    TileMatrixSet,
+)
+
+PROJECT = '/data/france_parts.qgs'
+
+ORIGIN = 20037508.3427892
+
+
+def tilematrix_infos() -> TileMatrixInfos:
+    matrices = {}
+    for z in range(4):
+        matrices[str(z)] = TileMatrix(str(z), 559082264.0287178 / (1 << z), (-ORIGIN, ORIGIN),
+                                      256, 256, 1 << z, 1 << z)
+    tms = TileMatrixSet('EPSG:3857', 'EPSG:3857', matrices)
+    limits = {'france_parts': {'EPSG:3857': {'3': (0, 7, 0, 4)}}}
+    return TileMatrixInfos({'EPSG:3857': tms}, limits, 0)
+
+
+def tile(z: int, row: int, col: int) -> dict:
+    return {
+        'SERVICE': 'WMTS',
+        'REQUEST': 'GetTile',
+        'LAYER': 'france_parts',
+        'TILEMATRIXSET': 'EPSG:3857',
+        'TILEMATRIX': str(z),
+        'TILEROW': str(row),
+        'TILECOL': str(col),
+        'FORMAT': 'image/png',
+    }
+
+
+def keys(tiles) -> set:
+    return {(int(t['TILEMATRIX']), int(t['TILEROW']), int(t['TILECOL'])) for t in tiles}
+
+
+def test_wmts_prefetch_neighbours():
+    """ Test neighbour tiles
+    """
+    infos = tilematrix_infos()
+    tiles = keys(neighbour_tiles(tile(2, 1, 1), infos))
+    ring = {(2, r, c) for r in range(3) for c in range(3)} - {(2, 1, 1)}
+    parent = {(1, 0, 0)}
+    children = {(3, 2, 2), (3, 2, 3), (3, 3, 2), (3, 3, 3)}
+    assert tiles == ring | parent | children
+
+    # Clipped to the tile matrix and the layer limits
+    tiles = keys(neighbour_tiles(tile(2, 0, 3), infos))
+    assert tiles == {(2, 0, 2), (2, 1, 2), (2, 1, 3), (1, 0, 1)}
+
+    # Without tile matrix infos
+    tiles = keys(neighbour_tiles(tile(2, 0, 0)))
+    assert tiles == {(2, 0, 1), (2, 1, 0), (2, 1, 1)}
+
+
+def test_wmts_prefetch_hits():
+    """ Test prefetch hit rate
+    """
+    prefetcher = Prefetcher('http://localhost/ows/', 'token')
+    prefetcher.renderer.render = lambda query: None
+
+    prefetcher.miss()
+    assert prefetcher.submit(PROJECT, tile(2, 1, 1))
+    assert prefetcher.submit(PROJECT, tile(2, 1, 2))
+
+    start = time.time()
+    while prefetcher.renderer.stats['rendered'] < 2 and time.time() - start < 5:
+        time.sleep(0.01)
+
+    prefetcher.hit(PROJECT, dict(tile(2, 1, 1), STYLE='default', MAP=PROJECT))
+    prefetcher.hit(PROJECT, tile(2, 1, 1))
+    prefetcher.hit(PROJECT, tile(3, 0, 0))
+
+    metrics = prefetcher.metrics()
+    assert metrics['misses'] == 1
+    assert metrics['rendered'] == 2
+    assert metrics['hits'] == 1
+    assert metrics['hit_rate'] == 0.5
@@ -0,0 +1,86 @@
+from hashlib import md5
+from pathlib import Path
+
+from wmtsCacheServer.helper import CacheHelper
+from wmtsCacheServer.nginxconf import nginx_config
+from wmtsCacheServer.shards import rebalance
+from wmtsCacheServer.tiers import TieredStorage
+
+PROJECT = '/data/france parts.qgs'
+
+PID = 'france%20parts-' + md5(PROJECT.encode()).hexdigest()[:8]
+
+PARAMS = {
+    'LAYER': 'france/parts',
+    'TILEMATRIXSET': 'EPSG:3857',
+    'STYLE': '',
+    'TILEMATRIX': '5',
+    'TILEROW': '12',
+    'TILECOL': '7',
+    'FORMAT': 'image/jpeg',
+}
+
+
+def test_wmts_readable_layout(tmp_path: Path):
+    """ Test readable tile paths
+    """
+    cache = CacheHelper(tmp_path, 'tc')
+
+    p = cache.get_tile_cache(PROJECT, PARAMS, create_dir=True, layout='readable')
+    assert p == tmp_path / PID / 'france%2Fparts' / 'EPSG%3A3857' / 'default' / '5' / '7' / '12.jpg'
+    assert cache.get_readable_root(PROJECT) == tmp_path / PID
+
+    # Projects with the same file name do not share their tiles
+    other = cache.get_tile_cache('/other/france parts.qgs', PARAMS, layout='readable')
+    assert other.relative_to(tmp_path).parts[0] != PID
+
+    p = cache.get_tile_cache(PROJECT, PARAMS, layout='readable', project_id='..')
+    assert p.relative_to(tmp_path).parts[0] == '%2E%2E'
+
+
+def test_wmts_readable_shards(tmp_path: Path):
+    """ Test readable tiles sharding
+    """
+    rootdir = tmp_path / 'root'
+    rootdir.mkdir()
+    shards = [tmp_path / 'shard1', tmp_path / 'shard2']
+
+    storage = TieredStorage(rootdir, shards=shards[:1])
+    cache = CacheHelper(rootdir, 'readable', storage.shards)
+
+    for i in range(10):
+        p = cache.get_tile_cache(PROJECT, dict(PARAMS, LAYER=f'layer{i}'), create_dir=True)
+        storage.write(p, b'data')
+
+    storage = TieredStorage(rootdir, shards=shards)
+    cache = CacheHelper(rootdir, 'readable', storage.shards)
+
+    moved = list(rebalance(shards))
+    assert moved
+
+    for i in range(10):
+        p = cache.get_tile_cache(PROJECT, dict(PARAMS, LAYER=f'layer{i}'))
+        assert p.exists()
+        assert storage.physical(storage.relative(p)) == p
+
+    layers = sorted(p.name for p in storage.iterdir(cache.get_readable_root(PROJECT)))
+    assert layers == [f'layer{i}' for i in range(10)]
+
+
+def test_wmts_nginx_config(tmp_path: Path):
+    """ Test nginx configuration
+    """
+    storage = TieredStorage(tmp_path)
+    cache = CacheHelper(tmp_path, 'readable')
+    p = cache.get_tile_cache(PROJECT, PARAMS, create_dir=True)
+    storage.write(p, b'data')
+
+    digest = cache.get_project_hash(PROJECT).hexdigest()
+
+    conf = nginx_config(tmp_path, storage, {digest: PROJECT}, '/ows/', 'http://localhost:8080')
+    assert '"/data/france parts.qgs" "%s";' % PID in conf
+    assert '"%%2Fdata%%2Ffrance%%20parts.qgs" "%s";' % PID in conf
+    assert '"EPSG:3857" "EPSG%3A3857";' in conf
+    assert '\\default "default";' in conf
+    assert 'try_files /$wmts_tile @wmts_upstream;' in conf
+    assert 'proxy_pass http://localhost:8080;' in conf
@@ -0,0 +1,152 @@
+import time
+
+from pathlib import Path
+
+import pytest
+
+from wmtsCacheServer.helper import CacheHelper
+from wmtsCacheServer.jobs import DONE, FAILED, QUEUED, RUNNING, JobQueue
+from wmtsCacheServer.policy import PolicyConfig
+from wmtsCacheServer.renderer import (
+    is_refresh,
+    read_refresh_token,
+    refresh_token,
+)
+from wmtsCacheServer.seeder import Seeder, seed_params, seed_ranges, seed_tiles
+from wmtsCacheServer.tiers import TieredStorage
+from wmtsCacheServer.tilematrix import (
+    TileMatrix,
+    TileMatrixInfos,
+    TileMatrixSet,
+)
+
+PROJECT = '/data/france_parts.qgs'
+
+ORIGIN = 20037508.3427892
+
+
+def tilematrix_infos() -> TileMatrixInfos:
+    matrices = {}
+    for z in range(3):
+        matrices[str(z)] = TileMatrix(str(z), 559082264.0287178 / (1 << z), (-ORIGIN, ORIGIN),
+                                      256, 256, 1 << z, 1 << z)
+    tms = TileMatrixSet('EPSG:3857', 'EPSG:3857', matrices)
+    limits = {'france_parts': {'EPSG:3857': {'2': (1, 1, 1, 3)}}}
+    return TileMatrixInfos({'EPSG:3857': tms}, limits, 0)
+
+
+class StubSeeder(Seeder):
+    """ Write tiles instead of requesting them
+    """
+
+    def __init__(self, storage: TieredStorage, cache: CacheHelper) -> None:
+        super().__init__('http://localhost/ows/', 'token')
+        self.storage = storage
+        self.cache = cache
+        self.rendered = []
+        # Tile matrices failing to render
+        self.failing = ()
+
+    def tilematrix_infos(self, cache: CacheHelper, project: str) -> TileMatrixInfos:
+        return tilematrix_infos()
+
+    def render(self, project: str, params: dict) -> None:
+        if params['TILEMATRIX'] in self.failing:
+            raise OSError("Connection refused")
+        self.rendered.append((params['TILEMATRIX'], params['TILEROW'], params['TILECOL']))
+        self.storage.write(self.cache.get_tile_cache(project, params, create_dir=True), b'tile')
+
+
+def test_wmts_seeder_params():
+    """ Test seeding parameters validation
+    """
+    params = seed_params({'tilematrixset': 'EPSG:3857', 'minzoom': 1, 'maxzoom': 2})
+    assert params['format'] == 'image/png'
+    assert params['bbox'] is None
+
+    for body in ({}, {'tilematrixset': 'EPSG:3857', 'minzoom': 3, 'maxzoom': 2},
+                 {'tilematrixset': 'EPSG:3857', 'minzoom': '1'},
+                 {'tilematrixset': 'EPSG:3857', 'bbox': [0, 0, 0, 1]},
+                 {'tilematrixset': 'EPSG:3857', 'format': 'text/plain'}):
+        with pytest.raises(ValueError):
+            seed_params(body)
+
+
+def test_wmts_seeder_ranges():
+    """ Test tile ranges from zoom levels and bbox
+    """
+    infos = tilematrix_infos()
+    assert seed_ranges(infos, 'other', 'EPSG:3857') == [
+        ('0', (0, 0, 0, 0)), ('1', (0, 1, 0, 1)), ('2', (0, 3, 0, 3)),
+    ]
+    # Layer limits
+    assert seed_ranges(infos, 'france_parts', 'EPSG:3857', minzoom=2) == [('2', (1, 1, 1, 3))]
+    # North east quarter
+    assert seed_ranges(infos, 'other', 'EPSG:3857', minzoom=1, bbox=(1000, 1000, ORIGIN, ORIGIN)) == [
+        ('1', (0, 0, 1, 1)), ('2', (0, 1, 2, 3)),
+    ]
+    with pytest.raises(ValueError):
+        seed_ranges(infos, 'other', 'EPSG:4326')
+
+
+def test_wmts_seeder_token(tmp_path: Path):
+    """ Test reading the refresh token of seeding requests
+    """
+    assert read_refresh_token(tmp_path) is None
+    assert not is_refresh(read_refresh_token(tmp_path), '')
+
+    token = refresh_token(tmp_path)
+    assert read_refresh_token(tmp_path) == token
+    assert is_refresh(read_refresh_token(tmp_path), token)
+    assert not is_refresh(read_refresh_token(tmp_path), token[::-1])
+
+
+def test_wmts_seeder_job(tmp_path: Path):
+    """ Test seeding job
+    """
+    rootdir = tmp_path / 'root'
+    rootdir.mkdir()
+    storage = TieredStorage(rootdir)
+    cache = CacheHelper(rootdir, 'tc', storage.shards)
+    seeder = StubSeeder(storage, cache)
+    policy = PolicyConfig()
+
+    queue = JobQueue(rootdir, poll=0.1)
+    queue.register('seed', lambda job, params: seed_tiles(seeder, storage, policy, rootdir, job, params))
+    queue.start()
+
+    def run(**kwargs):
+        params = seed_params(dict(tilematrixset='EPSG:3857', maxzoom=1, **kwargs))
+        params.update(project=PROJECT, layer='france_parts', layout='tc')
+        jobid = queue.submit('seed', params)['id']
+        start = time.time()
+        while time.time() - start < 5:
+            job = queue.get(jobid)
+            if job['state'] not in (QUEUED, RUNNING):
+                return job
+            time.sleep(0.05)
+        raise AssertionError("Job not finished")
+
+    job = run()
+    assert job['state'] == DONE
+    assert job['done'] == job['total'] == 5
+    assert job['rendered'] == 5
+    assert sorted(seeder.rendered) == [('0','0','0'), ('1','0','0'), ('1','0','1'), ('1','1','0'), ('1','1','1')]
+
+    # Fresh tiles are not rendered again
+    job = run()
+    assert (job['rendered'], job['skipped']) == (0, 5)
+    job = run(force=True)
+    assert (job['rendered'], job['skipped']) == (5, 0)
+
+    # Failed renders are reported
+    seeder.failing = ('1',)
+    job = run(force=True)
+    assert job['state'] == DONE
+    assert (job['rendered'], job['errors']) == (1, 4)
+    assert job['error'] == "4 renders failed: Connection refused"
+
+    seeder.failing = ('0', '1')
+    job = run(force=True)
+    assert job['state'] == FAILED
+    assert job['error'] == "All renders failed: Connection refused"
@@ -0,0 +1,57 @@
+from pathlib import Path
+
+from wmtsCacheServer.helper import CacheHelper
+from wmtsCacheServer.shards import rebalance, shard_for
+from wmtsCacheServer.tiers import TieredStorage
+
+
+def test_wmts_shards(tmp_path: Path):
+    """ Test tiles sharding
+    """
+    rootdir = tmp_path / 'root'
+    rootdir.mkdir()
+
+    shards = [tmp_path / 'shard1', tmp_path / 'shard2']
+
+    storage = TieredStorage(rootdir, shards=shards)
+    cache = CacheHelper(rootdir, 'tc', storage.shards)
+
+    project = '/data/france_parts.qgs'
+
+    layers = [f'layer{i}' for i in range(10)]
+    for layer in layers:
+        params = {
+            'LAYER': layer,
+            'TILEMATRIXSET': 'EPSG:3857',
+            'TILEMATRIX': '0',
+            'TILEROW': '0',
+            'TILECOL': '0',
+        }
+        p = cache.get_tile_cache(project, params, create_dir=True)
+        # Layout is '<shard>/<project>/tiles/<layer>/<digest>/zz/xxx/xxx/xxx/yyy/yyy/yyy.png'
+        digest = p.parents[6].name
+        assert shard_for(shards, digest) in p.parents
+        storage.write(p, b'data')
+
+    # Tiles are spread over shards
+    assert all(any(s.glob('**/*.png')) for s in shards)
+
+    # Shards are seen as one logical cache
+    tileroot = cache.get_tiles_root(project)
+    assert rootdir in tileroot.parents
+    assert sorted(p.name for p in storage.iterdir(tileroot)) == layers
+
+    # Add a shard
+    shards.append(tmp_path / 'shard3')
+    moved = list(rebalance(shards))
+    assert moved
+    for src, dst, count in moved:
+        assert not src.exists()
+        assert shards[2] in dst.parents
+        assert count == 1
+
+    storage = TieredStorage(rootdir, shards=shards)
+    assert sorted(p.name for p in storage.iterdir(tileroot)) == layers
+
+    assert storage.rmtree(tileroot)
+    assert not any(tmp_path.glob('**/*.png'))
@@ -0,0 +1,295 @@
+import os
+import threading
+import time
+
+from pathlib import Path
+
+from wmtsCacheServer.dedup import PayloadCache, dedup_stats
+from wmtsCacheServer.generation import Generations
+from wmtsCacheServer.helper import CacheHelper
+from wmtsCacheServer.throttle import MIN_RATE, parse_purge_rate
+from wmtsCacheServer.tiers import TieredStorage, parse_tiers
+from wmtsCacheServer.validators import cache_headers
+
+PROJECT = '/data/france_parts.qgs'
+
+
+def test_wmts_tiers_read_promote(tmp_path: Path):
+    """ Test reading tiles from tiers
+    """
+    rootdir = tmp_path / 'root'
+    rootdir.mkdir()
+
+    tiers = parse_tiers("%s:1M" % (tmp_path / 'hot'))
+    assert len(tiers) == 1
+    assert tiers[0].max_size == 1024*1024
+
+    storage = TieredStorage(rootdir, tiers)
+
+    tile = rootdir / 'project' / 'tiles' / 'layer' / '0.png'
+    hot  = tmp_path / 'hot' / 'project' / 'tiles' / 'layer' / '0.png'
+
+    # Write through
+    storage.write(tile, b'data')
+    assert tile.read_bytes() == b'data'
+    assert hot.read_bytes() == b'data'
+
+    index, found, _ = storage.find(tile)
+    assert (index, found) == (0, hot)
+
+    # Promote on hit
+    hot.unlink()
+    index, found, _ = storage.find(tile)
+    assert (index, found) == (1, tile)
+    storage.promote(index, tile, found.read_bytes())
+    assert hot.read_bytes() == b'data'
+
+    # Remove from all tiers
+    assert storage.rmtree(rootdir / 'project' / 'tiles' / 'layer')
+    assert not tile.exists()
+    assert not hot.exists()
+
+    # Status of the written location with a read only cache root
+    storage = TieredStorage(rootdir, parse_tiers("%s,%s:ro" % (tmp_path / 'hot', rootdir)))
+    st = storage.write(tile, b'new data')
+    assert st.st_size == len(b'new data')
+    assert hot.exists()
+    assert not tile.exists()
+
+
+def test_wmts_tiers_demote(tmp_path: Path):
+    """ Test demotion of least recently used tiles
+    """
+    rootdir = tmp_path / 'root'
+    rootdir.mkdir()
+
+    storage = TieredStorage(rootdir, parse_tiers("%s:10K" % (tmp_path / 'hot')))
+    hot = storage.tiers[0]
+
+    for i in range(30):
+        tile = rootdir / 'project' / 'tiles' / 'layer' / f'{i}.png'
+        storage.write(tile, b'x' * 1000)
+        atime = 1000000 + i * 60
+        os.utime(tmp_path / 'hot' / 'project' / 'tiles' / 'layer' / f'{i}.png', (atime, atime))
+
+    # Wait for demotions triggered by writes
+    for t in threading.enumerate():
+        if t.name == 'wmtscache-demote':
+            t.join()
+
+    size = storage.demote(hot)
+    assert size <= 10 * 1024
+
+    tiles = sorted(int(p.stem) for p in (tmp_path / 'hot').glob('**/*.png'))
+    assert tiles == list(range(30 - len(tiles), 30))
+
+    # Demoted tiles are still in the last tier
+    assert sum(1 for _ in rootdir.glob('**/*.png')) == 30
+
+
+def test_wmts_tiers_demote_chain(tmp_path: Path):
+    """ Test demotion through a bounded middle tier
+    """
+    rootdir = tmp_path / 'root'
+    rootdir.mkdir()
+
+    storage = TieredStorage(rootdir, parse_tiers("%s:5K,%s:3K" % (tmp_path / 'hot', tmp_path / 'mid')))
+    hot, mid = storage.tiers[:2]
+    mid.demoted(2500)
+
+    started = []
+    storage._start_demotion = started.append
+
+    layer = tmp_path / 'hot' / 'project' / 'tiles' / 'layer'
+    layer.mkdir(parents=True)
+    for i in range(10):
+        tile = layer / f'{i}.png'
+        tile.write_bytes(b'x' * 1000)
+        atime = 1000000 + i * 60
+        os.utime(tile, (atime, atime))
+
+    storage.demote(hot)
+    # The first demoted tile exceeds the middle tier bound
+    assert started == [mid]
+    assert mid._demoting
+
+    assert storage.demote(mid) <= 3 * 1024
+    assert not mid._demoting
+    assert sum(1 for _ in rootdir.glob('**/*.png')) > 0
+
+
+def test_wmts_tiers_dedup(tmp_path: Path):
+    """ Test deduplication of tiles payloads
+    """
+    rootdir = tmp_path / 'root'
+    rootdir.mkdir()
+
+    storage = TieredStorage(rootdir)
+    tiledir = rootdir / 'project' / 'tiles' / 'layer'
+
+    blank = b'blank' * 100
+    for i in range(10):
+        storage.write(tiledir / f'{i}.png', blank, dedup=True)
+    storage.write(tiledir / 'other.png', b'other', dedup=True)
+
+    stats = dedup_stats(storage.blob_roots())
+    assert stats['blobs'] == 2
+    assert stats['tiles'] == 11
+    assert stats['saved_bytes'] == 9 * len(blank)
+
+    # Shared payloads are kept in memory
+    payloads = PayloadCache(1024)
+    _, found, st = storage.find(tiledir / '0.png')
+    assert payloads.read(found, st) == blank
+    assert payloads.get((st.st_dev, st.st_ino, st.st_mtime_ns)) == blank
+
+    # Linked tiles share the validators of their payload
+    os.utime(found, (0, 0))
+    storage.write(tiledir / 'new.png', blank, dedup=True)
+    _, found, st = storage.find(tiledir / 'new.png')
+    # Shared payloads are never touched
+    assert st.st_mtime == 0
+    assert cache_headers(st)[1] == ('Last-Modified', 'Thu, 01 Jan 1970 00:00:00 GMT')
+
+    # Unreferenced payloads are removed
+    storage.rmtree(tiledir)
+    assert dedup_stats(storage.blob_roots())['blobs'] == 0
+
+
+def test_wmts_tiers_generation(tmp_path: Path):
+    """ Test retiring tiles of older project generations
+    """
+    rootdir = tmp_path / 'root'
+    rootdir.mkdir()
+
+    storage = TieredStorage(rootdir, parse_tiers("%s" % (tmp_path / 'hot')))
+    cache = CacheHelper(rootdir, 'tc', storage.shards)
+    generations = Generations(cache, storage)
+
+    params = {
+        'LAYER': 'france_parts',
+        'TILEMATRIXSET': 'EPSG:4326',
+        'TILEMATRIX': '0',
+        'TILEROW': '0',
+        'TILECOL': '0',
+    }
+    tile = cache.get_tile_cache(PROJECT, params, create_dir=True)
+    storage.write(tile, b'data')
+
+    # Existing tiles are kept when no generation is recorded
+    assert generations.validate(PROJECT, 1000)
+    assert storage.find(tile)[1] is not None
+    assert generations.recorded(PROJECT) == 1000
+
+    # Older generation from a process that did not reload the project
+    outdated = Generations(cache, storage)
+    assert not outdated.validate(PROJECT, 500)
+    assert not outdated.validate(PROJECT, 500)
+    assert storage.find(tile)[1] is not None
+    assert generations.recorded(PROJECT) == 1000
+
+    # Project update
+    assert generations.validate(PROJECT, 2000)
+    assert generations.validate(PROJECT, 2000)
+    assert storage.find(tile)[1] is None
+    assert generations.recorded(PROJECT) == 2000
+
+    storage.purge_retired()
+    assert not any((tmp_path / 'hot' / '.retired').iterdir())
+    assert not any((rootdir / '.retired').iterdir())
+
+    # Project updated by another process
+    updated = Generations(cache, storage)
+    assert updated.validate(PROJECT, 3000)
+    assert not generations.validate(PROJECT, 2000)
+    assert generations.validate(PROJECT, 3000)
+    assert generations.recorded(PROJECT) == 3000
+
+
+def test_wmts_tiers_grace(tmp_path: Path):
+    """ Test finding discarded tiles during the grace period
+    """
+    rootdir = tmp_path / 'root'
+    rootdir.mkdir()
+
+    storage = TieredStorage(rootdir, grace=3600)
+    cache = CacheHelper(rootdir, 'tc', storage.shards)
+
+    params = {
+        'LAYER': 'france_parts',
+        'TILEMATRIXSET': 'EPSG:4326',
+        'TILEMATRIX': '0',
+        'TILEROW': '0',
+        'TILECOL': '0',
+    }
+    tile = cache.get_tile_cache(PROJECT, params, create_dir=True)
+    storage.write(tile, b'old')
+    assert storage.discard(cache.get_tiles_root(PROJECT))
+    assert storage.find(tile)[1] is None
+
+    found, st = storage.find_retired(tile)
+    assert found.read_bytes() == b'old'
+
+    # The most recently retired tile is returned
+    tile.parent.mkdir(parents=True)
+    storage.write(tile, b'new')
+    storage.discard(cache.get_tiles_root(PROJECT))
+    found, st = storage.find_retired(tile)
+    assert found.read_bytes() == b'new'
+
+    # Retired tiles are kept during the grace period
+    assert storage.purge_retired() == 0
+    assert storage.purge_retired(grace=0) == 2
+    assert storage.find_retired(tile) == (None, None)
+
+
+def test_wmts_tiers_throttle(tmp_path: Path):
+    """ Test throttled removal of tiles
+    """
+    throttle = parse_purge_rate('100/s')
+    storage = TieredStorage(tmp_path, throttle=throttle)
+    cache = CacheHelper(tmp_path, 'tc', storage.shards)
+    for col in range(20):
+        params = {
+            'LAYER': 'france_parts',
+            'TILEMATRIXSET': 'EPSG:4326',
+            'TILEMATRIX': '1',
+            'TILEROW': '0',
+            'TILECOL': str(col),
+        }
+        storage.write(cache.get_tile_cache(PROJECT, params, create_dir=True), b'data')
+
+    tiledir = cache.get_tiles_root(PROJECT)
+    start = time.monotonic()
+    assert storage.rmtree(tiledir)
+    assert time.monotonic() - start >= 0.15
+    assert not tiledir.exists()
+
+    assert parse_purge_rate('20M').size == 20 * 1024 * 1024
+    assert parse_purge_rate('') is None
+
+
+def test_wmts_tiers_throttle_adaptive():
+    """ Test adaptive purge rate from lookup latency
+    """
+    throttle = parse_purge_rate('auto:1000')
+    assert throttle.adaptive and throttle.rate == 1000
+
+    throttle.observe(0.001)
+    throttle.adjust()
+    assert throttle.rate == 1000
+
+    # Lookups slow down
+    for _ in range(50):
+        throttle.observe(0.01)
+    throttle.adjust()
+    assert throttle.rate == 500
+    for _ in range(10):
+        throttle.adjust()
+    assert throttle.rate == MIN_RATE
+
+    # Lookups recover
+    for _ in range(100):
+        throttle.observe(0.001)
+    throttle.adjust()
+    assert throttle.rate == MIN_RATE + 100
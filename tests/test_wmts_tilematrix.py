@@ -0,0 +1,104 @@
+from pathlib import Path
+
+from wmtsCacheServer.tilematrix import TileMatrixInfos
+from wmtsCacheServer.wmsc import wms_tile
+
+CAPABILITIES = """<?xml version="1.0" encoding="utf-8"?>
+<Capabilities xmlns="http://www.opengis.net/wmts/1.0" xmlns:ows="http://www.opengis.net/ows/1.1" version="1.0.0">
+ <Contents>
+  <Layer>
+   <ows:Identifier>france_parts</ows:Identifier>
+   <TileMatrixSetLink>
+    <TileMatrixSet>EPSG:3857</TileMatrixSet>
+    <TileMatrixSetLimits>
+     <TileMatrixLimits>
+      <TileMatrix>2</TileMatrix>
+      <MinTileRow>1</MinTileRow>
+      <MaxTileRow>1</MaxTileRow>
+      <MinTileCol>1</MinTileCol>
+      <MaxTileCol>2</MaxTileCol>
+     </TileMatrixLimits>
+    </TileMatrixSetLimits>
+   </TileMatrixSetLink>
+  </Layer>
+  <TileMatrixSet>
+   <ows:Identifier>EPSG:3857</ows:Identifier>
+   <ows:SupportedCRS>EPSG:3857</ows:SupportedCRS>
+   <TileMatrix>
+    <ows:Identifier>2</ows:Identifier>
+    <ScaleDenominator>139770566.0071794390678406</ScaleDenominator>
+    <TopLeftCorner>-20037508.3427892 20037508.3427892</TopLeftCorner>
+    <TileWidth>256</TileWidth>
+    <TileHeight>256</TileHeight>
+    <MatrixWidth>4</MatrixWidth>
+    <MatrixHeight>4</MatrixHeight>
+   </TileMatrix>
+  </TileMatrixSet>
+ </Contents>
+</Capabilities>
+"""
+
+
+def test_wmts_tilematrix_limits(tmp_path: Path):
+    """ Test reading layer limits from capabilities
+    """
+    infos = TileMatrixInfos.from_capabilities(CAPABILITIES, 1234)
+
+    tm = infos.tile_matrix('EPSG:3857', '2')
+    assert tm.tile_width == 256
+    assert tm.matrix_height == 4
+
+    assert not infos.outside('france_parts', 'EPSG:3857', '2', 1, 1)
+    assert infos.outside('france_parts', 'EPSG:3857', '2', 0, 1)
+    assert infos.outside('france_parts', 'EPSG:3857', '2', 1, 3)
+    # Outside the tile matrix
+    assert not infos.outside('france_parts', 'EPSG:3857', '2', 5, 5)
+    # Unknown limits
+    assert not infos.outside('france_parts', 'EPSG:3857', '3', 0, 0)
+    assert not infos.outside('unknown', 'EPSG:3857', '2', 0, 0)
+
+    path = tmp_path / 'tilematrix.json'
+    infos.save(path)
+    infos = TileMatrixInfos.load(path)
+    assert infos.last_modified == 1234
+    assert infos.tile_matrix('EPSG:3857', '2').top_left == (-20037508.3427892, 20037508.3427892)
+    assert infos.outside('france_parts', 'EPSG:3857', '2', 0, 1)
+
+
+def test_wmts_wms_tile():
+    """ Test mapping tile aligned WMS requests to WMTS tiles
+    """
+    infos = TileMatrixInfos.from_capabilities(CAPABILITIES, 1234)
+
+    params = {
+        'SERVICE': 'WMS',
+        'VERSION': '1.3.0',
+        'REQUEST': 'GetMap',
+        'LAYERS': 'france_parts',
+        'STYLES': '',
+        'CRS': 'EPSG:3857',
+        'BBOX': '-10018754.1713946,0,0,10018754.1713946',
+        'WIDTH': '256',
+        'HEIGHT': '256',
+        'FORMAT': 'image/png',
+        'TRANSPARENT': 'TRUE',
+    }
+    tile = wms_tile(params, infos)
+    assert tile['LAYER'] == 'france_parts'
+    assert tile['TILEMATRIXSET'] == 'EPSG:3857'
+    assert (tile['TILEMATRIX'], tile['TILEROW'], tile['TILECOL']) == ('2', '1', '1')
+
+    # WMS 1.1.1
+    wms111 = dict(params, VERSION='1.1.1', SRS='EPSG:3857')
+    del wms111['CRS']
+    assert wms_tile(wms111, infos) == tile
+
+    # Not aligned
+    assert wms_tile(dict(params, BBOX='-10018000,0,754.1713946,10018754.1713946'), infos) is None
+    # Not a tile size
+    assert wms_tile(dict(params, WIDTH='512', HEIGHT='512'), infos) is None
+    # Opaque png
+    assert wms_tile(dict(params, TRANSPARENT='false'), infos) is None
+    # Multiple layers or rendering parameters
+    assert wms_tile(dict(params, LAYERS='france_parts,other'), infos) is None
+    assert wms_tile(dict(params, DPI='180'), infos) is None
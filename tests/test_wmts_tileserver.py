@@ -0,0 +1,252 @@
+import asyncio
+import os
+import time
+
+from pathlib import Path
+
+import pytest
+
+from wmtsCacheServer.helper import CacheHelper
+from wmtsCacheServer.policy import PolicyConfig
+from wmtsCacheServer.renderer import REFRESH_HEADER
+from wmtsCacheServer.tileserver import (
+    ProtocolError,
+    TileServer,
+    read_request,
+    read_response,
+)
+
+PROJECT = '/data/france_parts.qgs'
+
+TILE = {
+    "MAP": PROJECT,
+    "SERVICE": "WMTS",
+    "VERSION": "1.0.0",
+    "REQUEST": "GetTile",
+    "LAYER": "france_parts",
+    "STYLE": "",
+    "TILEMATRIXSET": "EPSG:4326",
+    "TILEMATRIX": "0",
+    "TILEROW": "0",
+    "TILECOL": "0",
+    "FORMAT": "image/png",
+}
+
+
+class StubUpstream:
+    """ Upstream server returning a fixed payload after a delay
+    """
+
+    def __init__(self, delay: float=0.2) -> None:
+        self.delay = delay
+        self.status = 200
+        self.requests = []
+        self.headers = []
+        self.connections = 0
+
+    async def handle(self, reader, writer):
+        self.connections += 1
+        try:
+            while True:
+                head = await reader.readuntil(b'\r\n\r\n')
+                self.requests.append(head.split(b' ')[1].decode())
+                self.headers.append(head.decode())
+                await asyncio.sleep(self.delay)
+                body = b'upstream tile'
+                writer.write(b'HTTP/1.1 %d OK\r\nContent-Type: image/png\r\n'
+                             b'Content-Length: %d\r\n\r\n%s' % (self.status, len(body), body))
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, '127.0.0.1', 0)
+        return 'http://127.0.0.1:%d/ows/' % self.server.sockets[0].getsockname()[1]
+
+
+async def get(port: int, target: str, headers: dict={}):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    head = ''.join('%s: %s\r\n' % h for h in headers.items())
+    writer.write(b'GET %s HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n%s\r\n'
+                 % (target.encode(), head.encode()))
+    await writer.drain()
+    resp, _ = await read_response(reader, 'GET')
+    writer.close()
+    return resp
+
+
+def run_server(rootdir: Path, test, policy: PolicyConfig=None):
+    async def main():
+        upstream = StubUpstream()
+        server = TileServer(rootdir, await upstream.start(), policy=policy)
+        srv = await server.start()
+        port = srv.sockets[0].getsockname()[1]
+        try:
+            await test(server, upstream, port)
+        finally:
+            srv.close()
+            server.close()
+            upstream.server.close()
+    asyncio.run(main())
+
+
+def test_wmts_tileserver_hit(tmp_path: Path):
+    """ Test serving cached tiles with KVP and REST requests
+    """
+    tile = CacheHelper(tmp_path, 'tc').get_tile_cache(PROJECT, TILE, create_dir=True)
+    tile.write_bytes(b'cached tile')
+
+    async def test(server, upstream, port):
+        qs = '&'.join('%s=%s' % item for item in TILE.items())
+        resp = await get(port, '/?' + qs)
+        assert resp.status == 200
+        assert resp.body == b'cached tile'
+        assert dict(resp.headers)['X-Qgis-Cache-Status'] == 'HIT'
+
+        resp = await get(port, '/wmts/france_parts//EPSG:4326/0/0/0.png?MAP=' + PROJECT)
+        assert resp.status == 200
+        assert resp.body == b'cached tile'
+
+        headers = dict(resp.headers)
+        resp = await get(port, '/?' + qs, {'If-None-Match': headers['ETag']})
+        assert resp.status == 304
+        assert resp.body == b''
+
+        resp = await get(port, '/?' + qs, {'If-Modified-Since': headers['Last-Modified']})
+        assert resp.status == 304
+
+        resp = await get(port, '/?' + qs, {'If-None-Match': '"other"'})
+        assert resp.status == 200
+
+        assert server.stats['hits'] == 5
+        assert not upstream.requests
+
+    run_server(tmp_path, test)
+
+
+def test_wmts_tileserver_miss(tmp_path: Path):
+    """ Test that concurrent misses are coalesced
+    """
+    async def test(server, upstream, port):
+        target = '/wmts/france_parts//EPSG:4326/1/0/0.png?MAP=' + PROJECT
+        responses = await asyncio.gather(*(get(port, target) for _ in range(5)))
+        for resp in responses:
+            assert resp.status == 200
+            assert resp.body == b'upstream tile'
+            assert dict(resp.headers)['X-Qgis-Cache-Status'] == 'MISS'
+
+        assert len(upstream.requests) == 1
+        assert upstream.requests[0].startswith('/ows/?')
+        assert 'TILEMATRIX=1' in upstream.requests[0]
+        assert server.stats['coalesced'] == 4
+
+        # Upstream connection is reused
+        await get(port, target.replace('/1/', '/2/'))
+        assert len(upstream.requests) == 2
+        assert upstream.connections == 1
+
+        # Client headers are forwarded, requests with other credentials are not coalesced
+        target = target.replace('/1/', '/3/')
+        await asyncio.gather(get(port, target, {'Authorization': 'Basic dXNlcjE6cHc='}),
+                             get(port, target, {'Authorization': 'Basic dXNlcjI6cHc=',
+                                                'X-Forwarded-Host': 'example.com',
+                                                'If-None-Match': '"tag"'}))
+        assert len(upstream.requests) == 4
+        forwarded = ''.join(upstream.headers[2:]).lower()
+        assert 'authorization: basic dxnlcje6chc=' in forwarded
+        assert 'x-forwarded-host: example.com' in forwarded
+        assert 'if-none-match' not in forwarded
+
+    run_server(tmp_path, test)
+
+
+def test_wmts_tileserver_stale(tmp_path: Path):
+    """ Test serving stale tiles
+    """
+    policy = PolicyConfig({'default': {'ttl': 60, 'max_stale': 3600}})
+
+    tile = CacheHelper(tmp_path, 'tc').get_tile_cache(PROJECT, TILE, create_dir=True)
+    tile.write_bytes(b'cached tile')
+    mtime = time.time() - 120
+    os.utime(tile, (mtime, mtime))
+
+    async def test(server, upstream, port):
+        qs = '&'.join('%s=%s' % item for item in TILE.items())
+        resp = await get(port, '/?' + qs)
+        assert resp.status == 200
+        assert resp.body == b'cached tile'
+        assert dict(resp.headers)['X-Qgis-Cache-Status'] == 'STALE'
+
+        # Rendered in background with the refresh token
+        await asyncio.sleep(0.5)
+        assert len(upstream.requests) == 1
+        assert REFRESH_HEADER in upstream.headers[0]
+        assert (tmp_path / '.refresh_token').read_text() in upstream.headers[0]
+
+        # Forced synchronous render after max stale
+        mtime = time.time() - 7200
+        os.utime(tile, (mtime, mtime))
+        resp = await get(port, '/?' + qs)
+        assert dict(resp.headers)['X-Qgis-Cache-Status'] == 'MISS'
+
+    run_server(tmp_path, test, policy)
+
+
+def test_wmts_tileserver_last_good(tmp_path: Path):
+    """ Test serving the last good tile when upstream fails
+    """
+    policy = PolicyConfig({'default': {'ttl': 60}})
+
+    tile = CacheHelper(tmp_path, 'tc').get_tile_cache(PROJECT, TILE, create_dir=True)
+    tile.write_bytes(b'cached tile')
+    mtime = time.time() - 120
+    os.utime(tile, (mtime, mtime))
+
+    async def test(server, upstream, port):
+        upstream.status = 500
+        qs = '&'.join('%s=%s' % item for item in TILE.items())
+        resp = await get(port, '/?' + qs)
+        assert resp.status == 200
+        assert resp.body == b'cached tile'
+        assert dict(resp.headers)['X-Qgis-Cache-Status'] == 'STALE'
+        assert server.stats['last_good'] == 1
+
+        # Retired tiles are served during the grace period
+        server.storage.grace = 3600
+        server.storage.discard(server.cache.get_tiles_root(PROJECT))
+        resp = await get(port, '/?' + qs)
+        assert resp.body == b'cached tile'
+
+        upstream.status = 200
+        resp = await get(port, '/?' + qs)
+        assert resp.body == b'upstream tile'
+
+    run_server(tmp_path, test, policy)
+
+
+def test_wmts_tileserver_read_request():
+    """ Test reading request bodies
+    """
+    async def read(data: bytes):
+        reader = asyncio.StreamReader()
+        reader.feed_data(data)
+        reader.feed_eof()
+        return await read_request(reader), reader
+
+    async def test():
+        req, reader = await read(b'POST / HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n'
+                                 b'4\r\nbody\r\n0\r\n\r\nGET /next HTTP/1.1\r\n\r\n')
+        assert req.method == 'POST'
+        # Body is consumed: the next request is read
+        assert (await read_request(reader)).path == '/next'
+
+        with pytest.raises(ProtocolError):
+            await read(b'POST / HTTP/1.1\r\nContent-Length: abc\r\n\r\n')
+        with pytest.raises(ProtocolError):
+            await read(b'POST / HTTP/1.1\r\nContent-Length: -1\r\n\r\n')
+        with pytest.raises(ProtocolError):
+            await read(b'POST / HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\nzz\r\n')
+
+    asyncio.run(test())
@@ -0,0 +1,235 @@
+""" Tile access log
+
+    Requested tiles are appended to a compact binary log in the
+    `.accesslog` directory of the cache root, so that the most requested
+    tiles can be rendered again after a purge or a project update.
+
+    Each process writes its own log segments. A segment is a sequence of
+    records:
+
+    * context records `b'C' <id:u16> <size:u16> <json>` defining the tile
+      context `[project, layer, style, tilematrixset, tilematrix, format]`
+    * tile records `b'T' <id:u16> <time:u32> <row:u32> <col:u32>`
+
+    Contexts are defined in each segment before their first use. Segments
+    are rotated when they reach their maximum size and the oldest segments
+    are removed when the log exceeds its maximum size.
+
+    Copyright: (C) 2019 3Liz
+"""
+import atexit
+import json
+import os
+import struct
+import threading
+import time
+
+from collections import Counter
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from .cachekeys import canonical_params
+
+ACCESS_LOG_DIR = '.accesslog'
+
+# Number of segments of the log
+LOG_SEGMENTS = 8
+
+# Delay in seconds before buffered records are written
+FLUSH_INTERVAL = 1
+
+# Maximum number of buffered records
+FLUSH_RECORDS = 4096
+
+CONTEXT_RECORD = struct.Struct('<cHH')
+TILE_RECORD = struct.Struct('<cHIII')
+
+MAX_CONTEXTS = 0xffff
+
+MAX_INDEX = 0xffffffff
+
+Context = Tuple[str, str, str, str, str, str]
+
+
+def log_context(project: str, params: Dict[str,str]) -> Context:
+    """ Return the context of the tile
+
+        Parameters are canonicalized like cache keys so that
+        equivalent requests share the same context.
+    """
+    params = canonical_params(params)
+    return (project, params.get('LAYER',''), params.get('STYLE',''), params.get('TILEMATRIXSET',''),
+            params.get('TILEMATRIX',''), params.get('FORMAT') or 'image/png')
+
+
+class AccessLog:
+    """ Append tile requests to the log
+    """
+
+    def __init__(self, rootdir: Path, max_size: int=64*1024*1024, segments: int=LOG_SEGMENTS) -> None:
+        self.path = rootdir / ACCESS_LOG_DIR
+        self.max_size = max_size
+        self.segment_size = max_size // segments
+        self._lock = threading.Lock()
+        self._records = []
+        self._flushed = time.monotonic()
+        self._pid = None
+        self._segment = None
+        self._contexts: Dict[Context, int] = {}
+        atexit.register(self.flush)
+
+    def log(self, project: str, params: Dict[str,str]) -> None:
+        """ Record a tile request
+
+            Records are buffered and written at most once every
+            flush interval.
+        """
+        try:
+            row, col = int(params['TILEROW']), int(params['TILECOL'])
+        except (KeyError, ValueError):
+            return
+        if not (0 <= row <= MAX_INDEX and 0 <= col <= MAX_INDEX):
+            return
+        now = time.monotonic()
+        with self._lock:
+            self._records.append((log_context(project, params), int(time.time()), row, col))
+            if len(self._records) < FLUSH_RECORDS and now - self._flushed < FLUSH_INTERVAL:
+                return
+            self._flush(now)
+
+    def flush(self) -> None:
+        """ Write buffered records
+        """
+        with self._lock:
+            self._flush(time.monotonic())
+
+    def _new_segment(self) -> None:
+        self._segment = self.path / ('%d.%d.log' % (time.time_ns(), self._pid))
+        self._contexts = {}
+
+    def _flush(self, now: float) -> None:
+        self._flushed = now
+        records, self._records = self._records, []
+        if not records:
+            return
+        if self._pid != os.getpid():
+            # Forked process
+            self._pid = os.getpid()
+            self._new_segment()
+        elif not self._segment.exists():
+            # Segment removed by another process
+            self._new_segment()
+
+        data = bytearray()
+        for context, timestamp, row, col in records:
+            ident = self._contexts.get(context)
+            if ident is None:
+                if len(self._contexts) >= MAX_CONTEXTS:
+                    # Drop the remaining records, the segment is rotated
+                    break
+                ident = len(self._contexts)
+                encoded = json.dumps(context).encode()
+                if len(encoded) > 0xffff:
+                    # Does not fit in a context record
+                    continue
+                data += CONTEXT_RECORD.pack(b'C', ident, len(encoded)) + encoded
+                # Register the context once its record is written
+                self._contexts[context] = ident
+            data += TILE_RECORD.pack(b'T', ident, timestamp & 0xffffffff, row, col)
+
+        try:
+            self.path.mkdir(mode=0o750, exist_ok=True)
+            with self._segment.open('ab') as f:
+                f.write(data)
+                size = f.tell()
+        except OSError:
+            return
+        if size >= self.segment_size or len(self._contexts) >= MAX_CONTEXTS:
+            self._new_segment()
+            self.prune()
+
+    def prune(self) -> None:
+        """ Remove the oldest segments exceeding the log size
+        """
+        segments = []
+        for p in log_segments(self.path.parent):
+            try:
+                segments.append((p, p.stat().st_size))
+            except FileNotFoundError:
+                pass
+        total = sum(size for _, size in segments)
+        for p, size in segments:
+            if total <= self.max_size:
+                break
+            try:
+                p.unlink()
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+def log_segments(rootdir: Path) -> List[Path]:
+    """ Return log segments from the oldest
+    """
+    path = rootdir / ACCESS_LOG_DIR
+    if not path.is_dir():
+        return []
+
+    def created(p):
+        ts, _, _ = p.name.partition('.')
+        return int(ts) if ts.isdigit() else 0
+
+    return sorted(path.glob('*.log'), key=created)
+
+
+def read_segment(path: Path) -> Iterator[Tuple[Context, int, int, int]]:
+    """ Return (context, time, row, col) records of a segment
+
+        Truncated records are ignored
+    """
+    data = path.read_bytes()
+    contexts = {}
+    pos, end = 0, len(data)
+    while pos < end:
+        kind = data[pos:pos+1]
+        if kind == b'C':
+            if pos + CONTEXT_RECORD.size > end:
+                break
+            _, ident, size = CONTEXT_RECORD.unpack_from(data, pos)
+            pos += CONTEXT_RECORD.size
+            if pos + size > end:
+                break
+            contexts[ident] = tuple(json.loads(data[pos:pos+size].decode()))
+            pos += size
+        elif kind == b'T':
+            if pos + TILE_RECORD.size > end:
+                break
+            _, ident, timestamp, row, col = TILE_RECORD.unpack_from(data, pos)
+            pos += TILE_RECORD.size
+            context = contexts.get(ident)
+            if context is not None:
+                yield context, timestamp, row, col
+        else:
+            # Corrupted segment
+            break
+
+
+def top_tiles(rootdir: Path, limit: Optional[int]=None, since: Optional[float]=None,
+              project: Optional[str]=None) -> List[Tuple[Tuple[Context, int, int], int]]:
+    """ Return the most requested tiles with their request count
+
+        If set, since is a timestamp of the oldest requests
+    """
+    counter = Counter()
+    for path in log_segments(rootdir):
+        try:
+            for context, timestamp, row, col in read_segment(path):
+                if since is not None and timestamp < since:
+                    continue
+                if project is not None and context[0] != project:
+                    continue
+                counter[(context, row, col)] += 1
+        except FileNotFoundError:
+            # Segment removed meanwhile
+            continue
+    return counter.most_common(limit)
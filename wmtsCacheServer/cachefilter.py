@@ -4,16 +4,20 @@
     Copyright: (C) 2019 3Liz
 """
 
+import os
+import time
 import traceback
 
 from contextlib import contextmanager
 from datetime import datetime
+from functools import lru_cache
 from pathlib import Path
 from shutil import rmtree
-from typing import TypeVar, Union
+from typing import Dict, NamedTuple, Optional, Sequence, Tuple, TypeVar, Union
 
 from qgis.core import Qgis, QgsMessageLog, QgsProject
-from qgis.PyQt.QtCore import QByteArray
+from qgis.PyQt.QtCore import QBuffer, QByteArray, QIODevice
+from qgis.PyQt.QtGui import QColor, QImage
 from qgis.PyQt.QtXml import QDomDocument
 from qgis.server import (
     QgsServerCacheFilter,
@@ -21,10 +25,43 @@ from qgis.server import (
     QgsServerRequest,
 )
 
-from .helper import CacheHelper
+from .accesslog import AccessLog
+from .cachekeys import KeyStats, canonical_key, canonical_params
+from .compression import negotiate, remove_variants, write_variants
+from .dedup import PayloadCache
+from .generation import Generations
+from .heatmap import HeatMap
+from .helper import CacheHelper, atomic_write
+from .policy import DEFAULT_POLICY, EXPIRED, STALE, CachePolicy, PolicyConfig
+from .prefetch import Prefetcher, neighbour_tiles
+from .renderer import (
+    REFRESH_HEADER,
+    Renderer,
+    RenderHealth,
+    is_refresh,
+    read_refresh_token,
+)
+from .tiers import TieredStorage
+from .tilematrix import TileMatrixInfos
+from .validators import cache_headers, not_modified
 
 Hash = TypeVar('Hash')
 
+# Delay before checking again for missing tile matrix infos
+TILEMATRIX_CHECK_DELAY = 60
+
+# Placeholders returned for not modified or compressed content:
+# QGIS server requires non empty content, the body is replaced
+# by the request filter.
+IMAGE_PLACEHOLDER = b'\0'
+DOCUMENT_PLACEHOLDER = b'<Placeholder/>'
+
+DOCUMENT_CONTENT_TYPE = 'text/xml; charset=utf-8'
+
+# Marker file in the cache root recording that documents
+# have been requested with an access control key
+KEYED_DOCUMENTS_FILE = '.keyed_documents'
+
 
 @contextmanager
 def trap():
@@ -37,17 +74,137 @@ def trap():
         QgsMessageLog.logMessage("WMTS Cache exception: %s\n%s" % (e,traceback.format_exc()) ,"wmtsCache",Qgis.Critical)
 
 
+@lru_cache(maxsize=32)
+def empty_tile(fmt: str, width: int, height: int, background: int) -> bytes:
+    """ Return an empty tile image
+
+        Jpeg tiles are filled with the background color (as 0xRRGGBB)
+        and png tiles are transparent
+    """
+    if fmt.startswith('image/jpeg'):
+        img = QImage(width, height, QImage.Format_RGB32)
+        img.fill(QColor(background))
+        imgformat = 'JPG'
+    else:
+        img = QImage(width, height, QImage.Format_ARGB32)
+        img.fill(QColor(0,0,0,0))
+        imgformat = 'PNG'
+
+    data = QByteArray()
+    buf = QBuffer(data)
+    buf.open(QIODevice.WriteOnly)
+    img.save(buf, imgformat)
+    buf.close()
+    return bytes(data)
+
+
+class CachedTile(NamedTuple):
+    path: Path
+    index: int
+    location: Path
+    stat: os.stat_result
+    policy: CachePolicy
+    stale: bool = False
+
+
+class Rendering(NamedTuple):
+    key: Tuple[str,str]
+    start: float
+    project: str
+    params: Dict[str,str]
+    policy: CachePolicy
+    refresh: bool = False
+
+
+class CachedDocument(NamedTuple):
+    location: Path
+    stat: os.stat_result
+    encoding: Optional[str] = None
+    variant: Optional[Path] = None
+
+
 class DiskCacheFilter(QgsServerCacheFilter):
 
     def __init__(self, serverIface: 'QgsServerInterface', rootdir: Path, layout: str,
-                 debug: bool=False) -> None:
+                 debug: bool=False, policy: Optional[PolicyConfig]=None,
+                 storage: Optional[TieredStorage]=None,
+                 payloads: Optional[PayloadCache]=None,
+                 keystats: Optional[KeyStats]=None,
+                 documents: Sequence[str]=('WMTS',),
+                 renderer: Optional[Renderer]=None,
+                 accesslog: Optional[AccessLog]=None,
+                 heatmap: Optional[HeatMap]=None,
+                 prefetcher: Optional[Prefetcher]=None,
+                 token: Optional[str]=None) -> None:
         super().__init__(serverIface)
 
         self._iface = serverIface
-        self._cache = CacheHelper(rootdir, layout)
+        self._storage = storage or TieredStorage(rootdir)
+        self._cache = CacheHelper(rootdir, layout, self._storage.shards)
+        self._keystats = keystats
+        self._payloads = payloads or PayloadCache(16*1024*1024)
+        self._generations = Generations(self._cache, self._storage)
         self._debug  = debug
+        self._policy = policy or PolicyConfig()
+        self._documents = tuple(s.upper() for s in documents)
+        self._renderer = renderer
+        # Refresh requests are also sent by seeding jobs
+        self._token = token or (renderer.token if renderer else None)
+        self._accesslog = accesslog
+        self._heatmap = heatmap
+        self._prefetcher = prefetcher
+        self._health = RenderHealth()
+        self._tilematrix = {}
+        self._keyed = False
+        self._not_modified = False
+        self._encoded = None
+        self._rendering = None
+
+    def take_encoded(self) -> Optional[Tuple[str, bytes]]:
+        """ Return the encoding and the content that must
+            replace the current response body
+        """
+        encoded, self._encoded = self._encoded, None
+        return encoded
+
+    def take_rendering(self) -> Optional[Rendering]:
+        """ Return the pending tile render of the current request
+        """
+        rendering, self._rendering = self._rendering, None
+        return rendering
+
+    def take_not_modified(self) -> bool:
+        """ Return True if the current response must be
+            replaced by a 304 response
+        """
+        not_modified, self._not_modified = self._not_modified, False
+        return not_modified
+
+    def set_cache_headers(self, st: os.stat_result, policy: Optional[CachePolicy]=None,
+                          encoding: Optional[str]=None) -> None:
+        """ Add validators and cache control response headers
+        """
+        rh = self._iface.requestHandler()
+        if rh:
+            for name, value in cache_headers(st, policy.cache_control if policy else None, encoding):
+                rh.setResponseHeader(name, value)
+
+    def set_document_headers(self, doc: CachedDocument) -> None:
+        """ Add response headers for cached document
+        """
+        self.set_cache_headers(doc.stat, encoding=doc.encoding)
+        rh = self._iface.requestHandler()
+        if rh:
+            rh.setResponseHeader('Vary', 'Accept-Encoding')
 
-    def set_debug_headers(self, path: str) -> None:
+    def is_not_modified(self, request: 'QgsServerRequest', st: os.stat_result,
+                        encoding: Optional[str]=None) -> bool:
+        """ Check conditional request headers
+        """
+        return not_modified(st, request.header('If-None-Match'), request.header('If-Modified-Since'),
+                            encoding)
+
+    def set_debug_headers(self, path: Union[Path,str]) -> None:
         """ Add a response header to tag cached response
         """
         if not self._debug:
@@ -56,50 +213,131 @@ class DiskCacheFilter(QgsServerCacheFilter):
         rh = self._iface.requestHandler()
         if rh:
             rh.setResponseHeader("X-Qgis-Debug-Cache-Plugin" ,"wmtsCacheServer")
-            rh.setResponseHeader("X-Qgis-Debug-Cache-Path"   , path.as_posix())
+            rh.setResponseHeader("X-Qgis-Debug-Cache-Path"   , str(path))
+
+    def is_cached_document(self, request: 'QgsServerRequest') -> bool:
+        """ Return True if the document of the request is cached
 
-    def get_document_cache( self, project: 'QgsProject', request: 'QgsServerRequest' , create_dir=False) -> Path:
+            Only capabilities are cached for services other than WMTS
+        """
+        params = request.parameters()
+        service = params.get('SERVICE','').upper()
+        if service not in self._documents:
+            return False
+        return service == 'WMTS' or params.get('REQUEST','').lower() == 'getcapabilities'
+
+    def get_document_cache( self, project: 'QgsProject', request: 'QgsServerRequest' , create_dir=False,
+                            key: str='') -> Path:
         """ Return cache location for document
         """
         last_modified = datetime.fromtimestamp(project.lastModified().toMSecsSinceEpoch() / 1000.0)
         return self._cache.get_document_cache(
             project.fileName(), request.parameters(),
-            create_dir=create_dir, last_modified=last_modified
+            create_dir=create_dir, last_modified=last_modified, key=key
         )
 
     def setCachedDocument(self, doc: QDomDocument, project: 'QgsProject', request: 'QgsServerRequest', key: str) -> bool:
         """ Override QgsServerCacheFilter::setCachedDocument
         """
-        if not doc or request.parameters().get('SERVICE','').upper() != 'WMTS' :
+        if not doc or not self.is_cached_document(request):
             return False
         with trap():
-            p = self.get_document_cache(project,request, create_dir=True)
-            with p.open(mode='w') as f:
-                f.write(doc.toString())
+            self.note_access_key(key)
+            p = self.get_document_cache(project,request, create_dir=True, key=key)
+            content = doc.toString()
+            data = content.encode('utf-8')
+            atomic_write(p, data)
+            # Precompressed variants
+            write_variants(p, data, self._policy.project(project.fileName()).default.compression)
+            params = request.parameters()
+            if params.get('SERVICE','').upper() == 'WMTS' and params.get('REQUEST','').lower() == 'getcapabilities':
+                self.set_tilematrix_infos(project, content)
         return True
 
+    def note_access_key(self, key: str) -> None:
+        """ Record that documents are requested with access control keys
+
+            QGIS server passes a non empty key when access control
+            filters are registered.
+        """
+        if key and not self._keyed:
+            self._keyed = True
+            marker = self._cache.rootdir / KEYED_DOCUMENTS_FILE
+            if not marker.exists():
+                marker.touch()
+
+    def keyed_documents(self) -> bool:
+        """ Check if documents have been requested with access control keys
+            by any server process
+        """
+        if not self._keyed:
+            self._keyed = (self._cache.rootdir / KEYED_DOCUMENTS_FILE).exists()
+        return self._keyed
+
+    def record_key(self, params: Dict[str,str]) -> None:
+        """ Record document request parameters in key statistics
+        """
+        if self._keystats is not None:
+            self._keystats.record(params, canonical_key(canonical_params(params)))
+
     def getCachedDocument(self, project: 'QgsProject', request: 'QgsServerRequest', key: str) -> QByteArray:
         """ Override QgsServerCacheFilter::getCachedDocument
         """
-        if request.parameters().get('SERVICE','').upper() != 'WMTS':
+        if not self.is_cached_document(request):
             return QByteArray()
 
         with trap():
-            p = self.get_document_cache(project,request)
-            if p.is_file():
-                with p.open('rb') as f:
-                    self.set_debug_headers(path=p)
-                    return QByteArray(f.read())
+            self.note_access_key(key)
+            self.record_key(request.parameters())
+            p = self.get_document_cache(project,request, key=key)
+            doc = self.select_document(p, request.header('Accept-Encoding'))
+            if doc:
+                self.set_document_headers(doc)
+                self.set_debug_headers(path=p)
+                if self.is_not_modified(request, doc.stat, doc.encoding):
+                    self._not_modified = True
+                    return QByteArray(DOCUMENT_PLACEHOLDER)
+                if doc.encoding:
+                    # QGIS server serializes the returned document: the
+                    # compressed variant is written by the request filter
+                    self._encoded = (doc.encoding, self.read_document(doc))
+                    return QByteArray(DOCUMENT_PLACEHOLDER)
+                return QByteArray(self.read_document(doc))
 
         return QByteArray()
 
+    def find_document(self, project: str, params: Dict[str,str], last_modified: float) -> Path:
+        """ Return cache location for document from the project file name
+        """
+        return self._cache.get_document_cache(project, params,
+                                              last_modified=datetime.fromtimestamp(last_modified))
+
+    def select_document(self, p: Path, accept_encoding: Optional[str]) -> Optional[CachedDocument]:
+        """ Return the cached document variant for the accepted encodings
+        """
+        try:
+            st = p.stat()
+        except FileNotFoundError:
+            return None
+        variant = negotiate(p, accept_encoding)
+        if variant:
+            encoding, path = variant
+            return CachedDocument(p, st, encoding, path)
+        return CachedDocument(p, st)
+
+    def read_document(self, doc: CachedDocument) -> bytes:
+        """ Return the content of a cached document
+        """
+        return (doc.variant or doc.location).read_bytes()
+
     def deleteCachedDocument(self, project: 'QgsProject', request: 'QgsServerRequest', key: str) -> bool:
         """ Override QgsServerCacheFilter::deleteCachedDocument
         """
         with trap():
-            p = self.get_document_cache(project,request)
+            p = self.get_document_cache(project,request, key=key)
             if p.is_file():
                 p.unlink()
+                remove_variants(p)
                 return True
 
         return False
@@ -115,44 +353,280 @@ class DiskCacheFilter(QgsServerCacheFilter):
 
         return False
 
-    def get_tile_cache(self, project: 'QgsProject', request: 'QgsServerRequest' , create_dir=False) -> Path:
-        return self._cache.get_tile_cache(project.fileName(),request.parameters(),create_dir=create_dir)
+    def set_tilematrix_infos(self, project: 'QgsProject', capabilities: str) -> None:
+        """ Store tile matrix infos from WMTS capabilities
+        """
+        last_modified = project.lastModified().toMSecsSinceEpoch()
+        infos = TileMatrixInfos.from_capabilities(capabilities, last_modified)
+        infos.save(self._cache.get_tilematrix_path(project.fileName()))
+        self._tilematrix[project.fileName()] = (infos, last_modified, time.time())
+
+    def get_tilematrix_infos(self, project: 'QgsProject') -> Optional[TileMatrixInfos]:
+        """ Return tile matrix infos for the current version of the project
+        """
+        return self.find_tilematrix_infos(project.fileName(), project.lastModified().toMSecsSinceEpoch())
+
+    def find_tilematrix_infos(self, project: str, last_modified: int) -> Optional[TileMatrixInfos]:
+        """ Return tile matrix infos from the project file name
+
+            The last modification time is given in milliseconds
+        """
+        infos, checked, timestamp = self._tilematrix.get(project, (None, None, 0))
+        if checked == last_modified and (infos or time.time() - timestamp < TILEMATRIX_CHECK_DELAY):
+            return infos
+
+        infos = None
+        path = self._cache.get_tilematrix_path(project)
+        if path.exists():
+            infos = TileMatrixInfos.load(path)
+            if infos.last_modified != last_modified:
+                infos = None
+        self._tilematrix[project] = (infos, last_modified, time.time())
+        return infos
+
+    def get_empty_tile(self, project: 'QgsProject', params: Dict[str,str]) -> Optional[bytes]:
+        """ Return an empty tile if the tile is outside the layer limits
+        """
+        infos = self.get_tilematrix_infos(project)
+        if infos is None:
+            return None
+        tms, matrix = params.get('TILEMATRIXSET',''), params.get('TILEMATRIX','')
+        try:
+            row, col = int(params['TILEROW']), int(params['TILECOL'])
+        except (KeyError, ValueError):
+            return None
+        if not infos.outside(params.get('LAYER',''), tms, matrix, row, col):
+            return None
+        tm = infos.tile_matrix(tms, matrix)
+        return empty_tile(params.get('FORMAT','image/png'), tm.tile_width, tm.tile_height,
+                          project.backgroundColor().rgb() & 0xffffff)
+
+    def get_tile_policy(self, project: 'QgsProject', params: Dict[str,str]) -> CachePolicy:
+        """ Return the cache policy for the requested tile
+        """
+        return self._policy.resolve(project.fileName(), params.get('LAYER',''))
+
+    def get_tile_cache(self, project: 'QgsProject', request: 'QgsServerRequest' , create_dir=False,
+                       policy: Optional[CachePolicy]=None) -> Path:
+        policy = policy or DEFAULT_POLICY
+        return self._cache.get_tile_cache(project.fileName(),request.parameters(),create_dir=create_dir,
+                                          layout=policy.layout, project_id=policy.project_id)
+
+    def validate_generation(self, project: 'QgsProject') -> bool:
+        """ Retire tiles of older versions of the project
+
+            Return False if the project is older than the cached tiles
+        """
+        last_modified = project.lastModified()
+        if last_modified.isValid():
+            return self._generations.validate(project.fileName(), last_modified.toMSecsSinceEpoch())
+        return True
+
+    def tile_state(self, st: os.stat_result, policy: CachePolicy) -> str:
+        """ Return the state of the cached tile
+
+            Stale tiles are expired if they cannot be rendered in background
+        """
+        state = policy.tile_state(time.time() - st.st_mtime)
+        if state == STALE and self._renderer is None:
+            return EXPIRED
+        return state
+
+    def is_refresh(self, value: Optional[str]) -> bool:
+        """ Check if the request is a background render request
+
+            The token may have been created by another process,
+            i.e by the command line tools.
+        """
+        if value and self._token is None:
+            self._token = read_refresh_token(self._cache.rootdir)
+        return is_refresh(self._token, value)
+
+    def log_access(self, project: str, params: Dict[str,str], hit: bool=False) -> None:
+        """ Append the tile request to the access log and the heatmap
+        """
+        if self._accesslog is not None:
+            self._accesslog.log(project, params)
+        if self._heatmap is not None:
+            self._heatmap.record(project, params)
+        if hit and self._prefetcher is not None:
+            self._prefetcher.hit(project, params)
+
+    def prefetch(self, project: 'QgsProject', params: Dict[str,str], policy: CachePolicy) -> None:
+        """ Render the neighbours of the missed tile in background
+        """
+        if not policy.cache:
+            return
+        self._prefetcher.miss()
+        project_file = project.fileName()
+        for tile in neighbour_tiles(params, self.get_tilematrix_infos(project)):
+            if not policy.accept_zoom(tile['TILEMATRIX']):
+                continue
+            if self.find_tile(project_file, tile, policy):
+                continue
+            self._prefetcher.submit(project_file, tile)
+
+    def revalidate(self, project: str, params: Dict[str,str]) -> None:
+        """ Render the stale tile in background
+        """
+        self._renderer.submit(project, params)
+        rh = self._iface.requestHandler()
+        if rh:
+            rh.setResponseHeader('X-Qgis-Cache-Status', 'STALE')
+            rh.setResponseHeader('Warning', '110 - "Response is Stale"')
+
+    def find_tile(self, project: str, params: Dict[str,str],
+                  policy: Optional[CachePolicy]=None,
+                  generation: Optional[int]=None) -> Optional[CachedTile]:
+        """ Return the cached tile
+
+            The tile is looked up from the project file name so
+            that it does not require the project to be loaded.
+            If set, generation is the last modification time of
+            the project in milliseconds.
+        """
+        if policy is None:
+            policy = self._policy.resolve(project, params.get('LAYER',''))
+        if not policy.cache or not policy.accept_zoom(params.get('TILEMATRIX','')):
+            return None
+        if generation is not None and not self._generations.validate(project, generation):
+            return None
+        p = self._cache.get_tile_cache(project, params, layout=policy.layout,
+                                       project_id=policy.project_id)
+        index, found, st = self._storage.find(p)
+        if not found:
+            return None
+        state = self.tile_state(st, policy)
+        if state == EXPIRED:
+            return None
+        return CachedTile(p, index, found, st, policy, state == STALE)
+
+    def find_last_good(self, project: str, params: Dict[str,str],
+                       policy: CachePolicy) -> Optional[CachedTile]:
+        """ Return the last good tile, even if expired or retired
+        """
+        p = self._cache.get_tile_cache(project, params, layout=policy.layout,
+                                       project_id=policy.project_id)
+        index, found, st = self._storage.find(p)
+        if not found:
+            index = -1
+            found, st = self._storage.find_retired(p)
+            if not found:
+                return None
+        return CachedTile(p, index, found, st, policy, True)
+
+    def serve_last_good(self, tile: CachedTile) -> bytes:
+        """ Return the content of the last good tile instead of rendering
+        """
+        rh = self._iface.requestHandler()
+        if rh:
+            self.set_cache_headers(tile.stat, tile.policy)
+            rh.setResponseHeader('X-Qgis-Cache-Status', 'STALE')
+            rh.setResponseHeader('Warning', '111 - "Revalidation Failed"')
+        self.set_debug_headers(path=tile.location)
+        return self.read_tile(tile)
+
+    def render_failed(self) -> Optional[Tuple[str, bytes]]:
+        """ Record a failed tile render
+
+            Return the format and content of the last good tile
+        """
+        rendering = self.take_rendering()
+        if rendering is None:
+            return None
+        self._health.record(rendering.key, None)
+        if rendering.refresh:
+            return None
+        tile = self.find_last_good(rendering.project, rendering.params, rendering.policy)
+        if tile is None:
+            return None
+        return rendering.params.get('FORMAT','image/png'), self.serve_last_good(tile)
+
+    def read_tile(self, tile: CachedTile) -> bytes:
+        """ Return the content of a cached tile
+        """
+        data = self._payloads.read(tile.location, tile.stat)
+        if tile.index > 0:
+            self._storage.promote(tile.index, tile.path, data, dedup=tile.policy.dedup)
+        return data
 
     def setCachedImage(self, img: Union[QByteArray, bytes, bytearray],
                        project: 'QgsProject', request: 'QgsServerRequest', key: str) -> bool:
         """ Override QgsServerCacheFilter::setCachedImage
         """
-        if request.parameters().get('SERVICE','').upper() == 'WMTS':
+        params = request.parameters()
+        if params.get('SERVICE','').upper() == 'WMTS':
             with trap():
-                p = self.get_tile_cache(project, request, create_dir=True)
-                with p.open(mode='wb') as f:
-                    f.write(img)
-                    return True
+                policy = self.get_tile_policy(project, params)
+                if not policy.cache or not policy.accept_zoom(params.get('TILEMATRIX','')):
+                    return False
+                if not self.validate_generation(project):
+                    # Do not write tiles of an outdated project
+                    return False
+                p = self.get_tile_cache(project, request, create_dir=True, policy=policy)
+                st = self._storage.write(p, bytes(img), dedup=policy.dedup)
+                rendering = self.take_rendering()
+                if rendering:
+                    self._health.record(rendering.key, time.monotonic() - rendering.start)
+                if st is not None:
+                    self.set_cache_headers(st, policy)
+                return True
 
         return False
 
     def getCachedImage(self, project: 'QgsProject', request: 'QgsServerRequest', key: str) -> QByteArray:
         """ Override QgsServerCacheFilter::getCachedImage
         """
-        if request.parameters().get('SERVICE','').upper() == 'WMTS':
+        params = request.parameters()
+        if params.get('SERVICE','').upper() == 'WMTS':
             with trap():
-                p = self.get_tile_cache(project,request)
-                if p.is_file():
-                    with p.open('rb') as f:
-                        self.set_debug_headers(path=p)
-                        return QByteArray(f.read())
+                policy = self.get_tile_policy(project, params)
+                if policy.empty_tiles:
+                    data = self.get_empty_tile(project, params)
+                    if data:
+                        self.set_debug_headers(path='<empty>')
+                        return QByteArray(data)
+                project_file = project.fileName()
+                refresh = self.is_refresh(request.header(REFRESH_HEADER))
+                if not refresh:
+                    tile = None
+                    if self.validate_generation(project):
+                        tile = self.find_tile(project_file, params, policy)
+                    self.log_access(project_file, params, hit=tile is not None)
+                    if tile is None and self._prefetcher is not None:
+                        self.prefetch(project, params, policy)
+                    if tile:
+                        if tile.stale:
+                            self.revalidate(project_file, params)
+                        self.set_cache_headers(tile.stat, policy)
+                        self.set_debug_headers(path=tile.location)
+                        if self.is_not_modified(request, tile.stat):
+                            self._not_modified = True
+                            return QByteArray(IMAGE_PLACEHOLDER)
+                        return QByteArray(self.read_tile(tile))
+                key = (project_file, params.get('LAYER',''))
+                if not refresh and policy.render_budget is not None \
+                   and self._health.degraded(key, policy.render_budget):
+                    # Rendering is too slow or failing: serve the last good tile
+                    tile = self.find_last_good(project_file, params, policy)
+                    if tile:
+                        if self._renderer:
+                            self._renderer.submit(project_file, params)
+                        return QByteArray(self.serve_last_good(tile))
+                self._rendering = Rendering(key, time.monotonic(), project_file, dict(params),
+                                            policy, refresh)
 
         return QByteArray()
 
     def deleteCachedImage(self, project: 'QgsProject', request: 'QgsServerRequest', key: str) -> bool:
         """ Override QgsServerCacheFilter::deleteCachedImage
         """
-        if request.parameters().get('SERVICE','').upper() == 'WMTS':
+        params = request.parameters()
+        if params.get('SERVICE','').upper() == 'WMTS':
             with trap():
-                p = self.get_tile_cache(project,request)
-                if p.is_file():
-                    p.unlink()
-                    return True
+                policy = self.get_tile_policy(project, params)
+                p = self.get_tile_cache(project, request, policy=policy)
+                return self._storage.unlink(p)
 
         return False
 
@@ -161,8 +635,10 @@ class DiskCacheFilter(QgsServerCacheFilter):
         """
         with trap():
             cachedir = self._cache.get_tiles_root(project.fileName())
-            if cachedir.is_dir():
-                rmtree(cachedir.as_posix())
-                return True
+            removed = self._storage.discard(cachedir)
+            readable = self._cache.get_readable_root(project.fileName())
+            if readable:
+                removed = self._storage.discard(readable) or removed
+            return removed
 
         return False
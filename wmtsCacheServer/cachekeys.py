@@ -0,0 +1,129 @@
+""" Canonical cache keys
+
+    Request parameters are normalized before computing cache keys:
+    only significant parameters are kept and parameter names and
+    case insensitive values are folded, so that equivalent requests
+    share the same cached content.
+
+    Copyright: (C) 2019 3Liz
+"""
+import threading
+
+from collections import OrderedDict
+from typing import Dict, List, Set
+
+# Significant parameters by service and request:
+# other requests keep all parameters but the project
+SIGNIFICANT_PARAMETERS = {
+    ('WMTS', 'GETCAPABILITIES'): ('SERVICE', 'REQUEST', 'VERSION', 'ACCEPTVERSIONS', 'SECTIONS', 'LANGUAGE'),
+    ('WMS', 'GETCAPABILITIES'): ('SERVICE', 'REQUEST', 'VERSION', 'LANGUAGE'),
+    ('WFS', 'GETCAPABILITIES'): ('SERVICE', 'REQUEST', 'VERSION', 'ACCEPTVERSIONS', 'LANGUAGE'),
+    ('WCS', 'GETCAPABILITIES'): ('SERVICE', 'REQUEST', 'VERSION', 'ACCEPTVERSIONS'),
+    ('WMTS', 'GETTILE'): ('SERVICE', 'REQUEST', 'LAYER', 'STYLE', 'TILEMATRIXSET', 'TILEMATRIX',
+                          'TILEROW', 'TILECOL', 'FORMAT'),
+}
+
+# Parameters with case insensitive values
+CASE_INSENSITIVE = ('SERVICE', 'REQUEST', 'ACCEPTVERSIONS', 'SECTIONS')
+
+
+def canonical_params(params: Dict[str,str]) -> Dict[str,str]:
+    """ Return the significant parameters in canonical form
+
+        Empty values are dropped, the default style is the empty style
+        and formats are lowercased without their options, i.e
+        'image/PNG; mode=8bit' is 'image/png'.
+    """
+    params = {k.upper(): v.strip() for k, v in params.items()}
+    significant = SIGNIFICANT_PARAMETERS.get((params.get('SERVICE','').upper(),
+                                              params.get('REQUEST','').upper()))
+    if significant is None:
+        params.pop('MAP', None)
+    else:
+        params = {k: params[k] for k in significant if k in params}
+
+    for k in CASE_INSENSITIVE:
+        if k in params:
+            params[k] = params[k].upper()
+
+    fmt = params.get('FORMAT')
+    if fmt:
+        params['FORMAT'] = fmt.split(';')[0].strip().lower()
+    style = params.get('STYLE')
+    if style and style.lower() == 'default':
+        params['STYLE'] = ''
+    for k in ('TILEROW', 'TILECOL'):
+        value = params.get(k)
+        if value and value.isascii() and value.isdigit():
+            params[k] = str(int(value))
+
+    return {k: v for k, v in params.items() if v}
+
+
+def canonical_key(params: Dict[str,str]) -> str:
+    """ Return cache key from canonical parameters
+    """
+    return "&".join("%s=%s" % (k, params[k]) for k in sorted(params.keys()))
+
+
+class KeyStats:
+    """ Count distinct raw requests collapsed on each canonical key
+
+        The number of recorded raw requests is bounded, the least
+        recently requested canonical keys are evicted when the bound
+        is reached.
+    """
+
+    def __init__(self, maxkeys: int=100000) -> None:
+        self._keys: 'OrderedDict[str, Set[int]]' = OrderedDict()
+        self._size = 0
+        self._maxkeys = maxkeys
+        self._lock = threading.Lock()
+        self.evicted = 0
+
+    def record(self, raw: Dict[str,str], key: str) -> None:
+        """ Record raw parameters for the canonical key
+        """
+        h = hash(tuple(sorted(raw.items())))
+        with self._lock:
+            keys = self._keys.get(key)
+            if keys is not None:
+                self._keys.move_to_end(key)
+                if h in keys:
+                    return
+            while self._size >= self._maxkeys and len(self._keys) > (keys is not None):
+                _, evicted = self._keys.popitem(last=False)
+                self._size -= len(evicted)
+                self.evicted += 1
+            if self._size >= self._maxkeys:
+                # All recorded raw requests belong to this key
+                return
+            if keys is None:
+                keys = self._keys[key] = set()
+            keys.add(h)
+            self._size += 1
+
+    def collapsed(self, key: str) -> int:
+        """ Return the number of distinct raw keys for the canonical key
+        """
+        with self._lock:
+            return len(self._keys.get(key, ()))
+
+    def stats(self, top: int=20) -> Dict:
+        """ Return key statistics
+
+            Canonical keys with the most raw keys are listed first
+        """
+        with self._lock:
+            counts = [(k, len(v)) for k, v in self._keys.items()]
+            size, evicted = self._size, self.evicted
+        counts.sort(key=lambda item: -item[1])
+        topkeys: List[Dict] = [{'key': k, 'raw_keys': n} for k, n in counts[:top] if n > 1]
+        return {
+            'canonical_keys': len(counts),
+            'raw_keys': size,
+            'collapsed': size - len(counts),
+            'evicted': evicted,
+            'top': topkeys,
+        }
+
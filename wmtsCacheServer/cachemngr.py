@@ -5,15 +5,31 @@ import argparse
 import json
 import os
 import sys
+import time
 
 from pathlib import Path
-from shutil import rmtree
-from typing import List
+from typing import List, Optional
+from urllib.parse import unquote
 
-from .helper import CacheHelper
+from .dedup import dedup_stats
+from .helper import CacheHelper, escape_segment, get_readable_root
+from .policy import load_policy
+from .shards import parse_shards, rebalance
+from .throttle import parse_purge_rate
+from .tiers import TieredStorage, parse_tiers
 
 
-def read_metadata(rootdir: Path) -> dict:
+def get_storage( rootdir: Path, metadata: dict, tiers: Optional[str]=None,
+                 shards: Optional[str]=None, purge_rate: Optional[str]=None ) -> TieredStorage:
+    """ Return the cache storage
+
+        Shards default to the shards recorded in metadata
+    """
+    shards = parse_shards(shards) or [Path(p) for p in metadata.get('shards',[])]
+    return TieredStorage(rootdir, parse_tiers(tiers), shards, throttle=parse_purge_rate(purge_rate))
+
+
+def read_metadata(rootdir: Path, tiers: Optional[str]=None, shards: Optional[str]=None) -> dict:
     """ Read metadata
     """
     print('Reading cache infos from %s' % rootdir, file=sys.stderr)
@@ -25,13 +41,19 @@ def read_metadata(rootdir: Path) -> dict:
 
     metadata = json.loads(metadata.read_text())
 
+    storage = get_storage(rootdir, metadata, tiers, shards)
+
     data = {}
     for c in rootdir.glob('*.inf'):
         d = c.with_suffix('')
         h = d.name
 
         tiledir = d / 'tiles'
-        layers  = [layer.name for layer in tiledir.glob('*') if layer.is_dir()]
+        layers  = [layer.name for layer in storage.iterdir(tiledir)]
+        readable = get_readable_root(rootdir, h)
+        if readable:
+            layers.extend(l for l in (unquote(layer.name) for layer in storage.iterdir(readable))
+                          if l not in layers)
 
         data[h] = {
             'project': c.read_text(),
@@ -84,7 +106,8 @@ def delete_command( args, rootdir: Path, metadata: dict ) -> None:
         print("No projects found for %s" % args.name, file=sys.stderr)
         return
 
-    cache = CacheHelper(rootdir, metadata['layout'])
+    storage = get_storage(rootdir, metadata, args.tiers, args.shards, args.rate)
+    cache = CacheHelper(rootdir, metadata['layout'], storage.shards)
 
     for h,v in data.items():
         project  = v['project']
@@ -95,19 +118,26 @@ def delete_command( args, rootdir: Path, metadata: dict ) -> None:
             continue
 
         cachedir = rootdir / h
+        readable = cache.get_readable_root(project)
         if args.layer is not None:
             tileroot = cache.get_tiles_root(project)
-            cachedir = tileroot / args.layer
-            if cachedir.exists():
-                print("Removing layer %s" % cachedir, file=sys.stderr)
-                rmtree(cachedir.as_posix())
-            else:
-                print("Warning: tile cache directory  %s not found" % cachedir, file=sys.stderr)
+            cachedirs = [tileroot / args.layer]
+            if readable:
+                cachedirs.append(readable / escape_segment(args.layer))
+            for cachedir in cachedirs:
+                if storage.exists(cachedir):
+                    print("Removing layer %s" % cachedir, file=sys.stderr)
+                    storage.rmtree(cachedir)
+                else:
+                    print("Warning: tile cache directory  %s not found" % cachedir, file=sys.stderr)
         else:
+            if readable and storage.exists(readable):
+                print("Removing %s" % readable, file=sys.stderr)
+                storage.rmtree(readable)
             cachedir = rootdir / h
-            if cachedir.exists():
+            if storage.exists(cachedir):
                 print("Removing %s" % cachedir, file=sys.stderr)
-                rmtree(cachedir.as_posix())
+                storage.rmtree(cachedir)
             else:
                 print("Warning: cache directory %s not found" % cachedir, file=sys.stderr)
             # Remove medatata infos
@@ -116,14 +146,210 @@ def delete_command( args, rootdir: Path, metadata: dict ) -> None:
                 inf.unlink()
 
 
+def rebalance_command( args, rootdir: Path, metadata: dict ) -> None:
+    """ Move tiles to their assigned shard
+    """
+    storage = get_storage(rootdir, metadata, args.tiers, args.shards)
+    if len(storage.shards) < 2:
+        print("No shards defined", file=sys.stderr)
+        return
+
+    # Update the shards list in metadata
+    CacheHelper(rootdir, metadata['layout'], storage.shards)
+
+    moved = 0
+    for src, dst, count in rebalance(storage.shards, [rootdir], dry_run=args.dry_run):
+        print("Moving %s -> %s" % (src, dst), file=sys.stderr)
+        moved += count
+    print("Moved %d files" % moved, file=sys.stderr)
+
+
+def dedup_command( args, rootdir: Path, metadata: dict ) -> None:
+    """ Print deduplication statistics
+    """
+    storage = get_storage(rootdir, metadata, args.tiers, args.shards)
+    if args.gc:
+        removed = storage.collect_blobs()
+        print("Removed %d unreferenced payloads" % removed, file=sys.stderr)
+
+    stats = dedup_stats(storage.blob_roots())
+    if args.json:
+        json.dump(stats,fp=sys.stdout,indent=2)
+    else:
+        print('Unique payloads:', stats['blobs'])
+        print('Tiles:          ', stats['tiles'])
+        print('Stored bytes:   ', stats['stored_bytes'])
+        print('Saved bytes:    ', stats['saved_bytes'])
+        print('Dedup ratio:    ', stats['ratio'])
+
+
+def nginx_config_command( args, rootdir: Path, metadata: dict ) -> None:
+    """ Print nginx configuration for serving tiles with the readable layout
+    """
+    from .nginxconf import nginx_config
+
+    storage = get_storage(rootdir, metadata, args.tiers, args.shards)
+    projects = { h: v['project'] for h,v in metadata['data'].items() }
+    print(nginx_config(rootdir, storage, projects, args.location, args.upstream))
+
+
+def serve_command( args, rootdir: Path, metadata: dict ) -> None:
+    """ Serve cached tiles and forward misses to upstream
+    """
+    from .tileserver import TileServer, run
+
+    host, _, port = args.bind.rpartition(':')
+    policy = load_policy(Path(args.policy) if args.policy else None)
+    storage = get_storage(rootdir, metadata, args.tiers, args.shards)
+
+    def factory():
+        return TileServer(rootdir, args.upstream, metadata['layout'], storage.tiers, storage.shards,
+                          policy=policy, concurrency=args.concurrency, project=args.project)
+
+    run(factory, host or '127.0.0.1', int(port), workers=args.workers)
+
+
+def import_command( args, rootdir: Path, metadata: dict ) -> None:
+    """ Import tiles from a directory, a tar archive or a MBTiles file
+    """
+    from .importer import TileImporter, iter_source
+
+    policy = load_policy(Path(args.policy) if args.policy else None)
+    storage = get_storage(rootdir, metadata, args.tiers, args.shards)
+    cache = CacheHelper(rootdir, metadata['layout'], storage.shards)
+
+    options = { k: getattr(args, k) for k in ('layer', 'style', 'tilematrixset', 'format')
+                if getattr(args, k) }
+    importer = TileImporter(storage, cache, policy, args.project, workers=args.workers)
+
+    start = time.monotonic()
+
+    def progress(count):
+        if count % 10000 == 0:
+            print("Imported %d tiles (%.0f tiles/s)" % (count, count / (time.monotonic() - start)),
+                  file=sys.stderr)
+
+    try:
+        stats = importer.run(iter_source(Path(args.source), options), progress=progress)
+    except ValueError as err:
+        print("Error: %s" % err, file=sys.stderr)
+        sys.exit(1)
+    print("Imported %d tiles, skipped %d tiles in %.1fs" % (stats['imported'], stats['skipped'],
+                                                           time.monotonic() - start), file=sys.stderr)
+
+
+def warm_command( args, rootdir: Path, metadata: dict ) -> None:
+    """ Render again the most requested tiles
+    """
+    from .accesslog import top_tiles
+    from .renderer import refresh_token
+    from .seeder import Seeder, render_tiles, tile_params
+
+    if not args.from_log:
+        print("Error: a tile source is required (--from-log)", file=sys.stderr)
+        sys.exit(1)
+
+    since = time.time() - args.since * 3600 if args.since else None
+    tiles = top_tiles(rootdir, args.top, since=since, project=args.project)
+    print("Found %d tiles in access log" % len(tiles), file=sys.stderr)
+    if args.dry_run:
+        for (context, row, col), count in tiles:
+            print("%d\t%s\t%s" % (count, context[0], '/'.join(context[1:5] + (str(row), str(col)))))
+        return
+
+    if not args.url:
+        print("Error: no QGIS server url defined", file=sys.stderr)
+        sys.exit(1)
+
+    policy = load_policy(Path(args.policy) if args.policy else None)
+    storage = get_storage(rootdir, metadata, args.tiers, args.shards)
+    cache = CacheHelper(rootdir, metadata['layout'], storage.shards)
+    seeder = Seeder(args.url, refresh_token(rootdir), concurrency=args.concurrency)
+
+    def requests():
+        for (context, row, col), _ in tiles:
+            project, layer, style, tms, tm, fmt = context
+            yield project, tile_params(layer, style, tms, tm, row, col, fmt)
+
+    start = time.monotonic()
+
+    def progress(count, stats):
+        if count % 1000 == 0:
+            print("Processed %d/%d tiles (%.0f tiles/s)" % (count, len(tiles), count / (time.monotonic() - start)),
+                  file=sys.stderr)
+
+    stats = render_tiles(seeder, storage, cache, policy, requests(), force=args.force, progress=progress)
+    print("Rendered %d tiles, skipped %d tiles, %d errors in %.1fs" % (
+          stats['rendered'], stats['skipped'], stats['errors'], time.monotonic() - start), file=sys.stderr)
+    if stats['errors']:
+        print("Last error: %s" % stats['last_error'], file=sys.stderr)
+
+
+def overviews_command( args, rootdir: Path, metadata: dict ) -> None:
+    """ Build lower zoom levels from cached tiles
+    """
+    from .overviews import build_overviews
+    from .tilematrix import TileMatrixInfos
+
+    policy = load_policy(Path(args.policy) if args.policy else None)
+    storage = get_storage(rootdir, metadata, args.tiers, args.shards)
+    cache = CacheHelper(rootdir, metadata['layout'], storage.shards)
+
+    path = cache.get_tilematrix_path(args.project)
+    if not path.exists():
+        print("Error: no tile matrix infos for project %s, request the WMTS capabilities first" % args.project,
+              file=sys.stderr)
+        sys.exit(1)
+
+    bbox = None
+    if args.bbox:
+        try:
+            bbox = tuple(float(v) for v in args.bbox.split(','))
+        except ValueError:
+            bbox = ()
+        if len(bbox) != 4:
+            print("Error: invalid bbox %s" % args.bbox, file=sys.stderr)
+            sys.exit(1)
+
+    try:
+        background = bytes.fromhex(args.background)
+    except ValueError:
+        background = b''
+    if len(background) != 3:
+        print("Error: invalid background color %s" % args.background, file=sys.stderr)
+        sys.exit(1)
+
+    start = time.monotonic()
+
+    def progress(tilematrix, stats):
+        print("Built tile matrix %s: %d tiles (%.1fs)" % (tilematrix, stats['built'], time.monotonic() - start),
+              file=sys.stderr)
+
+    try:
+        stats = build_overviews(storage, cache, policy, args.project, TileMatrixInfos.load(path),
+                                args.layer, args.tilematrixset, args.from_zoom, args.to_zoom,
+                                style=args.style, fmt=args.format, bbox=bbox, workers=args.workers,
+                                force=args.force, background=tuple(background), progress=progress)
+    except ValueError as err:
+        print("Error: %s" % err, file=sys.stderr)
+        sys.exit(1)
+    print("Built %d tiles, skipped %d tiles, %d tiles without children, %d tiles with missing children"
+          " in %.1fs" % (stats['built'], stats['skipped'], stats['empty'], stats['partial'],
+                         time.monotonic() - start), file=sys.stderr)
+
+
 def main() -> None:
 
     name = os.path.basename(sys.argv[0])
 
     rootdir = os.getenv('QGIS_WMTS_CACHE_ROOTDIR')
+    tiers = os.getenv('QGIS_WMTS_CACHE_TIERS')
+    shards = os.getenv('QGIS_WMTS_CACHE_SHARDS')
 
     parser = argparse.ArgumentParser(description='WMTS cache manager')
     parser.add_argument('--rootdir', metavar='PATH', default=rootdir, help="Cache rootdir")
+    parser.add_argument('--tiers', metavar='SPEC', default=tiers, help="Cache storage tiers")
+    parser.add_argument('--shards', metavar='PATHS', default=shards, help="Cache shards")
 
     sub = parser.add_subparsers(title='commands', help="type  '%s <command> --help'" % name)
     sub.required = True
@@ -131,6 +357,8 @@ def main() -> None:
 
     cmd = sub.add_parser('delete'   , description="Delete cached content")
     cmd.add_argument('--layer   ', '-l', metavar='NAME', default=None, help="Tile layer name", dest='layer')
+    cmd.add_argument('--rate'    , metavar='RATE', default=os.getenv('QGIS_WMTS_CACHE_PURGE_RATE'),
+                     help="Maximum removal rate in files or bytes per second")
     cmd.add_argument('name'      , metavar='PATH', help="Project path - globbing allowed")
     cmd.set_defaults(func=delete_command)
 
@@ -139,6 +367,77 @@ def main() -> None:
     cmd.add_argument('--name'  , metavar='PATH',  default='*', help="Project path - globbing allowed")
     cmd.set_defaults(func=list_command)
 
+    cmd = sub.add_parser('dedup', description="Deduplication statistics")
+    cmd.add_argument('--json'  , action="store_true", help="Output in json format")
+    cmd.add_argument('--gc'    , action="store_true", help="Remove unreferenced payloads")
+    cmd.set_defaults(func=dedup_command)
+
+    cmd = sub.add_parser('nginx-config', description="Print nginx configuration for the readable layout")
+    cmd.add_argument('--upstream', metavar='URL', required=True, help="Upstream QGIS server url")
+    cmd.add_argument('--location', metavar='PATH', default='/ows/', help="Nginx location of OWS requests")
+    cmd.set_defaults(func=nginx_config_command)
+
+    cmd = sub.add_parser('serve', description="Serve cached tiles and forward misses to QGIS server")
+    cmd.add_argument('--upstream', metavar='URL', required=True, help="Upstream QGIS server url")
+    cmd.add_argument('--bind', metavar='[HOST:]PORT', default='127.0.0.1:8090', help="Listen address")
+    cmd.add_argument('--workers', metavar='NUM', type=int, default=1, help="Number of worker processes")
+    cmd.add_argument('--concurrency', metavar='NUM', type=int, default=8,
+                     help="Maximum concurrent upstream requests per worker")
+    cmd.add_argument('--policy', metavar='PATH', default=os.getenv('QGIS_WMTS_CACHE_POLICY'),
+                     help="Cache policy file")
+    cmd.add_argument('--project', metavar='PATH', default=os.getenv('QGIS_PROJECT_FILE'),
+                     help="Project file used instead of the MAP parameter")
+    cmd.set_defaults(func=serve_command)
+
+    cmd = sub.add_parser('import-dir', description="Import tiles from a directory, a tar archive or a MBTiles file")
+    cmd.add_argument('--project', metavar='PATH', required=True, help="Project path")
+    cmd.add_argument('--layer', metavar='NAME', help="Tile layer name")
+    cmd.add_argument('--style', metavar='NAME', default='', help="Tile style name")
+    cmd.add_argument('--tilematrixset', metavar='ID', help="Tile matrix set identifier")
+    cmd.add_argument('--format', metavar='MIMETYPE', help="Tile format (default from file extensions)")
+    cmd.add_argument('--workers', metavar='NUM', type=int, default=8, help="Number of writer threads")
+    cmd.add_argument('--policy', metavar='PATH', default=os.getenv('QGIS_WMTS_CACHE_POLICY'),
+                     help="Cache policy file")
+    cmd.add_argument('source', metavar='PATH', help="Directory, tar archive or MBTiles file")
+    cmd.set_defaults(func=import_command)
+
+    cmd = sub.add_parser('warm', description="Render again the most requested tiles")
+    cmd.add_argument('--from-log', action="store_true", help="Read requested tiles from the access log")
+    cmd.add_argument('--top', metavar='NUM', type=int, default=10000, help="Number of tiles to render")
+    cmd.add_argument('--since', metavar='HOURS', type=float, help="Only count requests of the last hours")
+    cmd.add_argument('--project', metavar='PATH', help="Only render tiles of the project")
+    cmd.add_argument('--url', metavar='URL',
+                     default=os.getenv('QGIS_WMTS_CACHE_SEED_URL', os.getenv('QGIS_WMTS_CACHE_REFRESH_URL')),
+                     help="QGIS server url")
+    cmd.add_argument('--concurrency', metavar='NUM', type=int, default=2, help="Maximum concurrent renders")
+    cmd.add_argument('--force', action="store_true", help="Render fresh cached tiles")
+    cmd.add_argument('--policy', metavar='PATH', default=os.getenv('QGIS_WMTS_CACHE_POLICY'),
+                     help="Cache policy file")
+    cmd.add_argument('--dry-run', action="store_true", help="Only print tiles")
+    cmd.set_defaults(func=warm_command)
+
+    cmd = sub.add_parser('build-overviews', description="Build lower zoom levels from cached tiles")
+    cmd.add_argument('--project', metavar='PATH', required=True, help="Project path")
+    cmd.add_argument('--layer', metavar='NAME', required=True, help="Tile layer name")
+    cmd.add_argument('--style', metavar='NAME', default='', help="Tile style name")
+    cmd.add_argument('--tilematrixset', metavar='ID', required=True, help="Tile matrix set identifier")
+    cmd.add_argument('--format', metavar='MIMETYPE', default='image/png', help="Tile format")
+    cmd.add_argument('--from-zoom', metavar='ID', required=True, help="Tile matrix of the cached tiles")
+    cmd.add_argument('--to-zoom', metavar='ID', help="Last tile matrix to build (default the first one)")
+    cmd.add_argument('--bbox', metavar='MINX,MINY,MAXX,MAXY', help="Extent in the tile matrix set crs")
+    cmd.add_argument('--workers', metavar='NUM', type=int, default=os.cpu_count() or 1,
+                     help="Number of worker processes")
+    cmd.add_argument('--background', metavar='RRGGBB', default='ffffff',
+                     help="Background color of jpeg tiles")
+    cmd.add_argument('--force', action="store_true", help="Build existing tiles")
+    cmd.add_argument('--policy', metavar='PATH', default=os.getenv('QGIS_WMTS_CACHE_POLICY'),
+                     help="Cache policy file")
+    cmd.set_defaults(func=overviews_command)
+
+    cmd = sub.add_parser('rebalance', description="Move tiles to their assigned shard")
+    cmd.add_argument('--dry-run', action="store_true", help="Only print moves")
+    cmd.set_defaults(func=rebalance_command)
+
     args = parser.parse_args()
 
     rootdir = args.rootdir
@@ -148,7 +447,7 @@ def main() -> None:
 
     rootdir = Path(rootdir)
 
-    data = read_metadata(rootdir)
+    data = read_metadata(rootdir, args.tiers, args.shards)
 
     # Execute command
     args.func(args, rootdir, data)
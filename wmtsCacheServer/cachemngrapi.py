@@ -1,15 +1,44 @@
 import json
 import mimetypes
+import os
+import sqlite3
+import tarfile
+import time
+import uuid
 
+from email.utils import formatdate
 from pathlib import Path
 from shutil import rmtree
-
-from typing import Optional, Tuple, Iterable, Dict, Any
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+from urllib.parse import unquote
 
 from qgis.server import QgsServerOgcApi
 
-from .helper import CacheHelper
 from .apiutils import HTTPError, RequestHandler, register_api_handlers
+from .cachekeys import KeyStats
+from .dedup import dedup_stats
+from .heatmap import HeatGrid, HeatMap, heatmap_path, heatmap_tilematrixsets
+from .helper import (
+    PROJECT_ID_FILE,
+    CacheHelper,
+    atomic_write,
+    escape_segment,
+    get_readable_root,
+)
+from .importer import (
+    IMPORT_DIR,
+    TileImporter,
+    TileRef,
+    import_tiles,
+    iter_source,
+)
+from .jobs import JobQueue, delete_tiles
+from .policy import PolicyConfig
+from .prefetch import Prefetcher
+from .seeder import Seeder, seed_params, seed_tiles
+from .tiers import TieredStorage
+from .tileserver import FORMATS
+from .validators import cache_headers, etag
 
 
 def read_wmts_metadata( rootdir ) -> Dict:
@@ -37,7 +66,8 @@ def read_metadata_collection(rootdir: Path) -> Tuple[dict,Iterable]:
     return (metadata, collect())
 
 
-def read_project_metadata( rootdir: Path, name: str ) -> Optional[Tuple[dict,Iterable]]:
+def read_project_metadata( rootdir: Path, name: str,
+                           storage: Optional[TieredStorage]=None ) -> Optional[Tuple[dict,Iterable]]:
     """ Collect metadata about project
     """
     path = rootdir / f"{name}.inf"
@@ -46,11 +76,58 @@ def read_project_metadata( rootdir: Path, name: str ) -> Optional[Tuple[dict,Ite
 
     project = path.read_text()
 
+    storage = storage or TieredStorage(rootdir)
+
     tiledir = path.with_suffix('') / "tiles"
-    layers  = (layer.name for layer in tiledir.glob('*') if layer.is_dir())
+    layers  = [layer.name for layer in storage.iterdir(tiledir)]
+    readable = get_readable_root(rootdir, name)
+    if readable:
+        layers.extend(l for l in (unquote(layer.name) for layer in storage.iterdir(readable))
+                      if l not in layers)
     # (project, layers)
     return (project, layers)
 
+
+# Maximum number of tiles checked by a batch request
+MAX_TILE_BATCH = 1000
+
+# Keys of tiles in batch requests
+TILE_KEYS = ('layer', 'style', 'tilematrixset', 'tilematrix', 'tilerow', 'tilecol', 'format')
+
+
+def find_cached_tile(storage: TieredStorage, cache: CacheHelper, policy: PolicyConfig,
+                     project: str, tile: Dict[str,str]) -> Optional[Tuple[Path, os.stat_result, Dict]]:
+    """ Return the location, the status and the metadata of a cached tile
+
+        Tiles are looked up only, they are never rendered
+    """
+    params = {k.upper(): str(v) for k, v in tile.items() if k in TILE_KEYS}
+    if not all(params.get(k) for k in ('LAYER', 'TILEMATRIXSET', 'TILEMATRIX', 'TILEROW', 'TILECOL')):
+        raise HTTPError(400, reason="Missing tile parameters")
+    if not (params['TILEROW'].isdigit() and params['TILECOL'].isdigit()):
+        raise HTTPError(400, reason="Invalid tile row or column")
+    params.setdefault('FORMAT', 'image/png')
+    params.update(SERVICE='WMTS', REQUEST='GetTile')
+
+    tile_policy = policy.resolve(project, params['LAYER'])
+    if not tile_policy.cache:
+        return None
+    try:
+        p = cache.get_tile_cache(project, params, layout=tile_policy.layout,
+                                 project_id=tile_policy.project_id)
+    except ValueError:
+        raise HTTPError(400, reason="Invalid tile format %s" % params['FORMAT']) from None
+    _, found, st = storage.find(p)
+    if found is None:
+        return None
+    return found, st, {
+        'size': st.st_size,
+        'mtime': st.st_mtime,
+        'last_modified': formatdate(st.st_mtime, usegmt=True),
+        'etag': etag(st),
+        'state': tile_policy.tile_state(time.time() - st.st_mtime),
+    }
+
 #
 # WMTS API Handlers
 #
@@ -65,6 +142,26 @@ class LandingPage(RequestHandler):
                 "rel": QgsServerOgcApi.relToString(QgsServerOgcApi.data),
                 "type": QgsServerOgcApi.mimeType(QgsServerOgcApi.JSON),
                 "title": "Cache collections",
+            },{
+                "href": self.href("/dedup"),
+                "rel": QgsServerOgcApi.relToString(QgsServerOgcApi.data),
+                "type": QgsServerOgcApi.mimeType(QgsServerOgcApi.JSON),
+                "title": "Deduplication statistics",
+            },{
+                "href": self.href("/keys"),
+                "rel": QgsServerOgcApi.relToString(QgsServerOgcApi.data),
+                "type": QgsServerOgcApi.mimeType(QgsServerOgcApi.JSON),
+                "title": "Cache keys statistics",
+            },{
+                "href": self.href("/prefetch"),
+                "rel": QgsServerOgcApi.relToString(QgsServerOgcApi.data),
+                "type": QgsServerOgcApi.mimeType(QgsServerOgcApi.JSON),
+                "title": "Prefetch statistics",
+            },{
+                "href": self.href("/jobs"),
+                "rel": QgsServerOgcApi.relToString(QgsServerOgcApi.data),
+                "type": QgsServerOgcApi.mimeType(QgsServerOgcApi.JSON),
+                "title": "Cache jobs",
             }]
         }
         self.write(data)
@@ -100,11 +197,21 @@ class Collections(RequestHandler):
 
 class MetadataMixIn:
 
+    def initialize(self, rootdir: Path, storage: Optional[TieredStorage]=None,
+                   jobs: Optional[JobQueue]=None, policy: Optional[PolicyConfig]=None,
+                   **kwargs: Any) -> None:
+        """ Set storage
+        """
+        super().initialize(rootdir, **kwargs)
+        self.storage = storage or TieredStorage(rootdir)
+        self.jobs = jobs
+        self.policy = policy or PolicyConfig()
+
     def get_metadata(self, collectionid: str):
         """ Return project metadata 
         """
         try:
-            project, layers = read_project_metadata(self.rootdir, collectionid)
+            project, layers = read_project_metadata(self.rootdir, collectionid, self.storage)
         except FileNotFoundError:
             raise HTTPError(404,reason=f"Collection '{collectionid}' not found") from None
 
@@ -114,10 +221,33 @@ class MetadataMixIn:
     def cache_helper(self, metadata):
         """ Return cache helper
         """
-        return CacheHelper(self.rootdir, metadata['layout'])
+        return CacheHelper(self.rootdir, metadata['layout'], self.storage.shards)
+
+    def delete_tiles(self, paths: List[Path], data: Dict) -> None:
+        """ Remove tile directories in a background job
+
+            Tiles are removed at once if no job queue is set
+        """
+        if self.jobs is None:
+            for p in paths:
+                self.storage.discard(p)
+            self.write(data)
+            return
+        self.submit_job('delete', {'paths': [str(p) for p in paths]}, data)
+
+    def submit_job(self, kind: str, params: Dict, data: Dict) -> None:
+        """ Queue a job and return its location
+        """
+        job = self.jobs.submit(kind, params)
+        href = self._parent.href(self._context, '')
+        href = href[:href.index('/collections/')] + '/jobs/' + job['id']
+        data['job'] = { 'id': job['id'], 'href': href }
+        self.set_status(202)
+        self.set_header('Location', href)
+        self.write(data)
 
 
-class ProjectCollection(RequestHandler,MetadataMixIn):
+class ProjectCollection(MetadataMixIn,RequestHandler):
     """ Project listing handler
     """
 
@@ -169,18 +299,24 @@ class ProjectCollection(RequestHandler,MetadataMixIn):
         if docroot.exists():
             rmtree(docroot.as_posix())
             # Remove tiles
-        tileroot = cache.get_tiles_root(project)
-        if tileroot.exists():
-            rmtree(tileroot.as_posix())
+        tiles = [cache.get_tiles_root(project)]
+        readable = cache.get_readable_root(project)
+        if readable:
+            tiles.append(readable)
+            (self.rootdir / collectionid / PROJECT_ID_FILE).unlink()
+        # Remove tile matrix infos
+        tilematrix = cache.get_tilematrix_path(project)
+        if tilematrix.exists():
+            tilematrix.unlink()
         # Remove medatata infos
         inf = (self.rootdir / collectionid).with_suffix('.inf')
         if inf.exists():
             inf.unlink()
 
-        self.write({ 'deleted': collectionid, 'project': project })
+        self.delete_tiles(tiles, { 'deleted': collectionid, 'project': project })
 
 
-class DocumentCollection(RequestHandler,MetadataMixIn):
+class DocumentCollection(MetadataMixIn,RequestHandler):
     """ Return documentation about project 
     """
 
@@ -214,7 +350,7 @@ class DocumentCollection(RequestHandler,MetadataMixIn):
         self.write({ 'deleted': collectionid, 'documents': str(docroot) })
 
 
-class LayerCollection(RequestHandler,MetadataMixIn):
+class LayerCollection(MetadataMixIn,RequestHandler):
     """ 
     """
 
@@ -250,13 +386,15 @@ class LayerCollection(RequestHandler,MetadataMixIn):
 
         # Remove tiles
         tileroot = cache.get_tiles_root(project)
-        if tileroot.exists():
-            rmtree(tileroot.as_posix())
+        tiles = [tileroot]
+        readable = cache.get_readable_root(project)
+        if readable:
+            tiles.append(readable)
 
-        self.write({ 'deleted': collectionid, 'tiles': str(tileroot) })
+        self.delete_tiles(tiles, { 'deleted': collectionid, 'tiles': str(tileroot) })
 
 
-class LayerCache(RequestHandler,MetadataMixIn):
+class LayerCache(MetadataMixIn,RequestHandler):
     """ Handle cached layer
     """
 
@@ -281,15 +419,372 @@ class LayerCache(RequestHandler,MetadataMixIn):
         if layerid not in layers:
             raise HTTPError(404,reason=f"Layer '{layerid}' not found")
 
-        cache = self.cache_helper(metadata)   
-        cache = CacheHelper(self.rootdir, metadata['layout'])
+        cache = self.cache_helper(metadata)
 
         # Remove tiles
         cachedir = cache.get_tiles_root(project) / layerid
-        if cachedir.exists():
-            rmtree(cachedir.as_posix())
+        tiles = [cachedir]
+        readable = cache.get_readable_root(project)
+        if readable:
+            tiles.append(readable / escape_segment(layerid))
+
+        self.delete_tiles(tiles, { 'deleted': collectionid, 'tiles': str(cachedir) })
+
+class LayerSeed(MetadataMixIn,RequestHandler):
+    """ Seed layer tiles
+    """
+
+    def initialize(self, seeder: Optional[Seeder]=None, **kwargs: Any) -> None:
+        """ Set seeder
+        """
+        super().initialize(**kwargs)
+        self.seeder = seeder
+
+    def post(self, collectionid: str, layerid: str) -> None:
+        """ Render layer tiles in a background job
+        """
+        if self.jobs is None or self.seeder is None:
+            raise HTTPError(503, reason="Seeding is not enabled")
+        metadata, project, _ = self.get_metadata(collectionid)
+        try:
+            params = seed_params(json.loads(bytes(self._request.data())))
+        except ValueError as e:
+            raise HTTPError(400, reason=f"Invalid seed request: {e}") from None
+        if not self.policy.resolve(project, layerid).cache:
+            raise HTTPError(400, reason=f"Layer '{layerid}' is not cached")
+
+        params.update(project=project, layer=layerid, layout=metadata['layout'])
+        self.submit_job('seed', params, { 'id': layerid, 'project': project })
+
+
+class LayerHeatmap(MetadataMixIn,RequestHandler):
+    """ Layer tile requests heatmap
+    """
+
+    def initialize(self, heatmap: Optional[HeatMap]=None, **kwargs: Any) -> None:
+        """ Set heatmap
+        """
+        super().initialize(**kwargs)
+        self.heatmap = heatmap
+
+    def get(self, collectionid: str, layerid: str) -> None:
+        """ Return the request counts of a zoom level as json or as PNG image with 'f=png'
+        """
+        self.get_metadata(collectionid)
+        params = { k.lower(): v for k, v in self._request.parameters().items() }
+        zoom = params.get('zoom')
+        if not zoom:
+            raise HTTPError(400, reason="Missing zoom parameter")
+        tilematrixset = params.get('tilematrixset')
+        if not tilematrixset:
+            tilematrixsets = heatmap_tilematrixsets(self.rootdir, collectionid, layerid)
+            if len(tilematrixsets) != 1:
+                raise HTTPError(400, reason="Missing tilematrixset parameter")
+            tilematrixset = tilematrixsets[0]
+
+        if self.heatmap is not None:
+            # Include the requests counted by this process
+            self.heatmap.flush()
+
+        path = heatmap_path(self.rootdir, collectionid, layerid, tilematrixset, zoom)
+        try:
+            grid = HeatGrid.load(path)
+        except FileNotFoundError:
+            grid = HeatGrid()
+        except ValueError as e:
+            raise HTTPError(500, reason=str(e)) from None
+
+        if params.get('f','').lower() == 'png':
+            self.set_header('Content-Type', 'image/png')
+            self.write(grid.png())
+            return
+
+        blocks = list(grid.blocks())
+        self.write({
+            'id': layerid,
+            'tilematrixset': tilematrixset,
+            'tilematrix': zoom,
+            'block_size': 1 << grid.shift,
+            'width': grid.width,
+            'height': grid.height,
+            'total': sum(n for _, _, n in blocks),
+            'blocks': blocks,
+        })
+
+
+class TileItem(MetadataMixIn,RequestHandler):
+    """ Cached tile handler
+    """
+
+    def head(self, collectionid: str, layerid: str, tilematrixset: str, tilematrix: str,
+             tilerow: str, tilecol: str) -> None:
+        """ Return cached tile headers
+        """
+        self.get(collectionid, layerid, tilematrixset, tilematrix, tilerow, tilecol,
+                 write_content=False)
+
+    def get_tile(self, layerid: str, tilematrixset: str, tilematrix: str,
+                 tilerow: str, tilecol: str) -> Tuple[Dict[str,str], Dict[str,str]]:
+        """ Return the tile keys from the url and the request parameters
+        """
+        params = { k.upper(): v for k, v in self._request.parameters().items() }
+
+        tile = dict(layer=layerid, tilematrixset=tilematrixset, tilematrix=tilematrix,
+                    tilerow=tilerow, tilecol=tilecol, style=params.get('STYLE',''))
+        col, _, ext = tilecol.rpartition('.')
+        if col:
+            fmt = FORMATS.get(ext.lower())
+            if fmt is None:
+                raise HTTPError(400, reason=f"Invalid tile format '{ext}'")
+            tile.update(tilecol=col, format=fmt)
+        else:
+            tile['format'] = params.get('FORMAT', 'image/png')
+        return tile, params
+
+    def put(self, collectionid: str, layerid: str, tilematrixset: str, tilematrix: str,
+            tilerow: str, tilecol: str) -> None:
+        """ Store tile content
+        """
+        metadata, project, _ = self.get_metadata(collectionid)
+        tile, _ = self.get_tile(layerid, tilematrixset, tilematrix, tilerow, tilecol)
+        if not (tile['tilerow'].isdigit() and tile['tilecol'].isdigit()):
+            raise HTTPError(400, reason="Invalid tile row or column")
+        data = bytes(self._request.data())
+        if not data:
+            raise HTTPError(400, reason="Empty tile")
+
+        cache = self.cache_helper(metadata)
+        importer = TileImporter(self.storage, cache, self.policy, project)
+        ref = TileRef(tile['layer'], tile['style'], tile['tilematrixset'], tile['tilematrix'],
+                      int(tile['tilerow']), int(tile['tilecol']), tile['format'])
+        try:
+            written = importer.write(ref, data)
+        except ValueError:
+            raise HTTPError(400, reason="Invalid tile format %s" % tile['format']) from None
+        if not written:
+            raise HTTPError(400, reason="Tile is not cacheable")
+
+        _, st, info = find_cached_tile(self.storage, cache, self.policy, project, tile)
+        for name, value in cache_headers(st):
+            self.set_header(name, value)
+        self.set_status(201)
+        tile.update(info)
+        self.write(tile)
+
+    post = put
+
+    def get(self, collectionid: str, layerid: str, tilematrixset: str, tilematrix: str,
+            tilerow: str, tilecol: str, write_content: bool=True) -> None:
+        """ Return cached tile content or metadata with 'f=json'
+        """
+        metadata, project, _ = self.get_metadata(collectionid)
+        tile, params = self.get_tile(layerid, tilematrixset, tilematrix, tilerow, tilecol)
+
+        found = find_cached_tile(self.storage, self.cache_helper(metadata), self.policy, project, tile)
+        if found is None:
+            raise HTTPError(404, reason="Tile not found")
+        location, st, info = found
+
+        for name, value in cache_headers(st):
+            self.set_header(name, value)
+        self.set_header('X-Qgis-Cache-Status', 'HIT')
+        if params.get('F','').lower() == 'json':
+            tile.update(info)
+            self.write(tile)
+            return
+        self.set_header('Content-Type', tile['format'])
+        self.set_header('Content-Length', str(st.st_size))
+        if write_content:
+            self.write(location.read_bytes())
+
+
+class TileBatch(MetadataMixIn,RequestHandler):
+    """ Check cached tiles in batch
+    """
+
+    def post(self, collectionid: str) -> None:
+        """ Return the metadata of the requested tiles
+
+            The body is a json object with a 'tiles' list, keys
+            missing from tiles default to the keys of the object.
+        """
+        metadata, project, _ = self.get_metadata(collectionid)
+        try:
+            body = json.loads(bytes(self._request.data()))
+            tiles = body['tiles']
+        except (ValueError, TypeError, KeyError):
+            raise HTTPError(400, reason="Invalid tiles request") from None
+        if not isinstance(tiles, list) or not all(isinstance(t, dict) for t in tiles):
+            raise HTTPError(400, reason="Invalid tiles request")
+        if len(tiles) > MAX_TILE_BATCH:
+            raise HTTPError(400, reason=f"Too many tiles (max {MAX_TILE_BATCH})")
+
+        defaults = { k: body[k] for k in TILE_KEYS if k in body }
+        cache = self.cache_helper(metadata)
+
+        def results():
+            for tile in tiles:
+                tile = dict(defaults, **tile)
+                found = find_cached_tile(self.storage, cache, self.policy, project, tile)
+                tile['cached'] = found is not None
+                if found:
+                    tile.update(found[2])
+                yield tile
+
+        tiles = list(results())
+        self.write({
+            'id': collectionid,
+            'tiles': tiles,
+            'cached': sum(1 for t in tiles if t['cached']),
+        })
+
+
+class TileImport(MetadataMixIn,RequestHandler):
+    """ Import tiles from an archive
+    """
+
+    def put(self, collectionid: str) -> None:
+        """ Import a tar archive or a MBTiles file in a background job
+
+            Tiles are imported at once if no job queue is set
+        """
+        metadata, project, _ = self.get_metadata(collectionid)
+        params = { k.lower(): v for k, v in self._request.parameters().items() }
+        options = { k: params[k] for k in ('layer', 'style', 'tilematrixset', 'format') if k in params }
+
+        data = bytes(self._request.data())
+        if not data:
+            raise HTTPError(400, reason="Empty archive")
+        importdir = self.rootdir / IMPORT_DIR
+        importdir.mkdir(mode=0o750, parents=True, exist_ok=True)
+        archive = importdir / uuid.uuid4().hex
+        atomic_write(archive, data)
+
+        data = { 'id': collectionid, 'project': project }
+        if self.jobs is None:
+            importer = TileImporter(self.storage, self.cache_helper(metadata), self.policy, project)
+            try:
+                data.update(importer.run(iter_source(archive, options)))
+            except (ValueError, tarfile.TarError, sqlite3.DatabaseError) as e:
+                raise HTTPError(400, reason="Invalid archive: %s" % e) from None
+            finally:
+                archive.unlink()
+            self.write(data)
+            return
+
+        self.submit_job('import', { 'project': project, 'layout': metadata['layout'],
+                                    'archive': str(archive), 'options': options }, data)
+
+    post = put
+
+
+class DedupStats(MetadataMixIn,RequestHandler):
+    """ Deduplication statistics
+    """
+
+    def get(self) -> None:
+        """ Return deduplication ratio and saved bytes
+        """
+        self.write(dedup_stats(self.storage.blob_roots()))
+
+class KeyStatsHandler(RequestHandler):
+    """ Cache keys statistics
+    """
+
+    def initialize(self, keystats: Optional[KeyStats]=None, **kwargs: Any) -> None:
+        """ Set key statistics
+        """
+        super().initialize(**kwargs)
+        self.keystats = keystats
+
+    def get(self) -> None:
+        """ Return the number of raw keys collapsed on canonical keys
+        """
+        if self.keystats is None:
+            raise HTTPError(404, reason="Key statistics not available")
+        self.write(self.keystats.stats())
+
+class PrefetchStats(RequestHandler):
+    """ Prefetch statistics
+    """
+
+    def initialize(self, prefetcher: Optional[Prefetcher]=None, **kwargs: Any) -> None:
+        """ Set prefetcher
+        """
+        super().initialize(**kwargs)
+        self.prefetcher = prefetcher
+
+    def get(self) -> None:
+        """ Return the number of prefetched tiles and the prefetch hit rate
+        """
+        if self.prefetcher is None:
+            raise HTTPError(404, reason="Prefetching is not enabled")
+        self.write(self.prefetcher.metrics())
+
+
+class JobsMixIn:
+
+    def initialize(self, jobs: Optional[JobQueue]=None, **kwargs: Any) -> None:
+        """ Set job queue
+        """
+        super().initialize(**kwargs)
+        self.jobs = jobs
+
+    def prepare(self, **values: Any) -> None:
+        """ Check that jobs are available
+        """
+        if self.jobs is None:
+            raise HTTPError(404, reason="Jobs not available")
+
+    def job_data(self, job: Dict, href: str) -> Dict:
+        """ Return job status
+        """
+        data = { k: job[k] for k in ('id', 'kind', 'state', 'created', 'started', 'finished',
+                                     'done', 'total', 'rate', 'error') }
+        # Seeding statistics
+        data.update((k, job[k]) for k in ('rendered', 'skipped', 'errors', 'last_error') if k in job)
+        data['links'] = [{
+            "href": href,
+            "rel": QgsServerOgcApi.relToString(QgsServerOgcApi.item),
+            "type": QgsServerOgcApi.mimeType(QgsServerOgcApi.JSON),
+            "title": "Cache job",
+        }]
+        return data
+
+
+class JobCollection(JobsMixIn,RequestHandler):
+    """ Jobs listing handler
+    """
+
+    def get(self) -> None:
+        """ List jobs
+        """
+        self.write({
+            'jobs': [self.job_data(job, self.href(f"/{job['id']}")) for job in self.jobs.jobs()],
+            'links': [],
+        })
+
+
+class JobItem(JobsMixIn,RequestHandler):
+    """ Job handler
+    """
+
+    def get(self, jobid: str) -> None:
+        """ Return job progress
+        """
+        job = self.jobs.get(jobid)
+        if job is None:
+            raise HTTPError(404, reason=f"Job '{jobid}' not found")
+        self.write(self.job_data(job, self.href()))
+
+    def delete(self, jobid: str) -> None:
+        """ Cancel job
+        """
+        job = self.jobs.cancel(jobid)
+        if job is None:
+            raise HTTPError(404, reason=f"Job '{jobid}' not found")
+        self.write(self.job_data(job, self.href()))
 
-        self.write({ 'deleted': collectionid, 'tiles': str(cachedir) })
 #
 # Web Manager
 #
@@ -356,23 +851,47 @@ class WebManager(RequestHandler,MetadataMixIn):
 
 
 
-def init_cache_api(serverIface, cacherootdir: Path) -> None:
+def init_cache_api(serverIface, cacherootdir: Path, storage: Optional[TieredStorage]=None,
+                   keystats: Optional[KeyStats]=None, jobs: Optional[JobQueue]=None,
+                   policy: Optional[PolicyConfig]=None, seeder: Optional[Seeder]=None,
+                   heatmap: Optional[HeatMap]=None, prefetcher: Optional[Prefetcher]=None) -> None:
     """ Initialize the cache manager API
     """
     collectionid = r"collections/(?P<collectionid>[^/]+)"
 
-    kwargs = dict(rootdir=cacherootdir)
+    storage = storage or TieredStorage(cacherootdir)
+    if jobs is not None:
+        jobs.register('delete', lambda job, params: delete_tiles(storage, job, params))
+        jobs.register('import', lambda job, params: import_tiles(storage, policy or PolicyConfig(),
+                                                                 cacherootdir, job, params))
+        if seeder is not None:
+            jobs.register('seed', lambda job, params: seed_tiles(seeder, storage, policy or PolicyConfig(),
+                                                                 cacherootdir, job, params))
+
+    kwargs = dict(rootdir=cacherootdir, storage=storage, jobs=jobs, policy=policy)
 
     # Because the way plugin are installed in Qgis we cannot rely on pkg_resources
     # Do it the old way
     staticpath = Path(__file__).parent / "resources" / "www"
 
+    tile = r"tiles/(?P<tilematrixset>[^/]+)/(?P<tilematrix>[^/]+)/(?P<tilerow>[^/]+)/(?P<tilecol>[^/]+)"
+
     handlers = [
+        (rf"/{collectionid}/layers/(?P<layerid>[^/]+)/{tile}/?", TileItem, kwargs),
+        (rf"/{collectionid}/layers/(?P<layerid>[^/]+)/seed/?", LayerSeed, dict(kwargs, seeder=seeder)),
+        (rf"/{collectionid}/layers/(?P<layerid>[^/]+)/heatmap/?", LayerHeatmap, dict(kwargs, heatmap=heatmap)),
         (rf"/{collectionid}/layers/(?P<layerid>[^/]+)/?", LayerCache, kwargs),
+        (rf"/{collectionid}/tiles/?", TileBatch, kwargs),
+        (rf"/{collectionid}/import/?", TileImport, kwargs),
         (rf"/{collectionid}/layers/?", LayerCollection, kwargs),
         (rf"/{collectionid}/docs/?", DocumentCollection, kwargs),
         (rf"/{collectionid}/?", ProjectCollection,  kwargs),
         (r"/collections/?", Collections, kwargs),
+        (r"/dedup/?", DedupStats, kwargs),
+        (r"/keys/?", KeyStatsHandler, dict(rootdir=cacherootdir, keystats=keystats)),
+        (r"/prefetch/?", PrefetchStats, dict(rootdir=cacherootdir, prefetcher=prefetcher)),
+        (r"/jobs/(?P<jobid>[0-9a-f]+)/?", JobItem, dict(rootdir=cacherootdir, jobs=jobs)),
+        (r"/jobs/?", JobCollection, dict(rootdir=cacherootdir, jobs=jobs)),
         (r"/manager/(?P<path>.+)", WebManager, {'staticpath': staticpath}),
         (r"/manager/?", WebManager, {'staticpath': staticpath}),
         (r"/?", LandingPage, kwargs),
@@ -0,0 +1,116 @@
+""" Precompressed variants of cached documents
+
+    Variants are written next to the cached document when the
+    document is cached, `brotli` and `zstd` variants require the
+    `brotli` and `zstandard` packages.
+
+    Copyright: (C) 2019 3Liz
+"""
+import gzip
+
+from pathlib import Path
+from typing import Callable, Dict, Optional, Sequence, Tuple
+
+from .helper import atomic_write
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+DEFAULT_COMPRESSION = (('gzip', 6),)
+
+SUFFIXES = {
+    'gzip': '.gz',
+    'br': '.br',
+    'zstd': '.zst',
+}
+
+# Server preference order
+PREFERENCE = ('br', 'zstd', 'gzip')
+
+
+def _compressors() -> Dict[str, Callable[[bytes,int],bytes]]:
+    compressors = {'gzip': lambda data, level: gzip.compress(data, compresslevel=level, mtime=0)}
+    if brotli is not None:
+        compressors['br'] = lambda data, level: brotli.compress(data, quality=level)
+    if zstandard is not None:
+        compressors['zstd'] = lambda data, level: zstandard.ZstdCompressor(level=level).compress(data)
+    return compressors
+
+
+COMPRESSORS = _compressors()
+
+
+def variant_path(path: Path, encoding: str) -> Path:
+    """ Return the path of the compressed variant
+    """
+    return path.with_name(path.name + SUFFIXES[encoding])
+
+
+def write_variants(path: Path, data: bytes, compression: Sequence[Tuple[str,int]]=()) -> None:
+    """ Write compressed variants of data
+
+        Unavailable encodings are ignored
+    """
+    for encoding, level in (compression or DEFAULT_COMPRESSION):
+        compress = COMPRESSORS.get(encoding)
+        if compress is not None:
+            atomic_write(variant_path(path, encoding), compress(data, level))
+
+
+def remove_variants(path: Path) -> None:
+    """ Remove compressed variants
+    """
+    for encoding in SUFFIXES:
+        p = variant_path(path, encoding)
+        if p.exists():
+            p.unlink()
+
+
+def accepted_encodings(accept_encoding: Optional[str]) -> Dict[str,float]:
+    """ Parse Accept-Encoding header
+    """
+    accepted = {}
+    for item in (accept_encoding or '').split(','):
+        encoding, *params = item.strip().split(';')
+        q = 1.0
+        for param in params:
+            name, _, value = param.strip().partition('=')
+            if name == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.
+        if encoding:
+            accepted[encoding.lower()] = q
+    return accepted
+
+
+def negotiate(path: Path, accept_encoding: Optional[str]) -> Optional[Tuple[str, Path]]:
+    """ Return the encoding and the path of the best variant for the request
+
+        Variants older than the document are ignored
+    """
+    accepted = accepted_encodings(accept_encoding)
+    if not accepted:
+        return None
+    mtime = None
+    for encoding in sorted(PREFERENCE, key=lambda e: -accepted.get(e, accepted.get('*', 0.))):
+        if accepted.get(encoding, accepted.get('*', 0.)) <= 0:
+            break
+        p = variant_path(path, encoding)
+        try:
+            st = p.stat()
+        except FileNotFoundError:
+            continue
+        if mtime is None:
+            mtime = path.stat().st_mtime
+        if st.st_mtime >= mtime:
+            return encoding, p
+    return None
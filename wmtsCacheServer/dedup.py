@@ -0,0 +1,181 @@
+""" Content addressed deduplication of tiles
+
+    Unique tile payloads are stored once in a 'blobs' directory
+    at the root of each storage location, tiles are hard links
+    to the blob of their payload.
+
+    Copyright: (C) 2019 3Liz
+"""
+import errno
+import os
+import threading
+
+from collections import OrderedDict
+from hashlib import md5
+from pathlib import Path
+from typing import Dict, Iterable, Optional
+
+from .helper import atomic_write
+
+BLOBS_DIR = 'blobs'
+
+
+def blob_path(root: Path, digest: str, suffix: str, variant: int=0) -> Path:
+    """ Return the blob path for payload digest
+    """
+    name = digest if not variant else "%s-%d" % (digest, variant)
+    return (root / BLOBS_DIR / digest[:2] / name).with_suffix(suffix)
+
+
+def _create_blob(blob: Path, data: bytes) -> None:
+    """ Create blob - an existing blob is never replaced
+    """
+    blob.parent.mkdir(mode=0o750, parents=True, exist_ok=True)
+    tmp = blob.with_name('.%s.%d.%d.tmp' % (blob.name, os.getpid(), threading.get_ident()))
+    with tmp.open('wb') as f:
+        f.write(data)
+    try:
+        os.link(tmp.as_posix(), blob.as_posix())
+    except FileExistsError:
+        pass
+    finally:
+        tmp.unlink()
+
+
+def store_blob(root: Path, path: Path, data: bytes) -> None:
+    """ Store data as a hard link to its blob
+
+        A new blob variant is created when the maximum number
+        of links is reached. If hard links are not supported,
+        the data is written as a regular file.
+    """
+    digest = md5(data).hexdigest()
+    tmp = path.with_name('.%s.%d.%d.tmp' % (path.name, os.getpid(), threading.get_ident()))
+    variant = 0
+    retries = 3
+    while True:
+        blob = blob_path(root, digest, path.suffix, variant)
+        try:
+            if not blob.exists():
+                _create_blob(blob, data)
+            os.link(blob.as_posix(), tmp.as_posix())
+            break
+        except FileNotFoundError:
+            # Blob may have been collected concurrently
+            retries -= 1
+            if retries <= 0:
+                raise
+        except OSError as e:
+            if e.errno == errno.EMLINK:
+                variant += 1
+                continue
+            if e.errno in (errno.EXDEV, errno.EPERM, errno.ENOTSUP):
+                atomic_write(path, data)
+                return
+            raise
+    os.replace(tmp.as_posix(), path.as_posix())
+
+
+def collect_blobs(root: Path) -> int:
+    """ Remove blobs that are no more referenced by tiles
+
+        Return the number of removed blobs
+    """
+    removed = 0
+    blobdir = root / BLOBS_DIR
+    if not blobdir.is_dir():
+        return removed
+    for dirpath, _, filenames in os.walk(blobdir.as_posix()):
+        for name in filenames:
+            if name.startswith('.'):
+                # Temporary file
+                continue
+            p = os.path.join(dirpath, name)
+            try:
+                if os.stat(p).st_nlink <= 1:
+                    os.unlink(p)
+                    removed += 1
+            except FileNotFoundError:
+                pass
+    return removed
+
+
+def dedup_stats(roots: Iterable[Path]) -> Dict:
+    """ Compute deduplication statistics
+
+        - `blobs`: number of unique payloads
+        - `tiles`: number of tiles referencing a payload
+        - `stored_bytes`: size of unique payloads
+        - `logical_bytes`: size of all tiles referencing a payload
+        - `saved_bytes`: size saved by deduplication
+        - `ratio`: deduplication ratio
+    """
+    blobs = tiles = stored = logical = 0
+    for root in roots:
+        blobdir = root / BLOBS_DIR
+        if not blobdir.is_dir():
+            continue
+        for dirpath, _, filenames in os.walk(blobdir.as_posix()):
+            for name in filenames:
+                try:
+                    st = os.stat(os.path.join(dirpath, name))
+                except FileNotFoundError:
+                    continue
+                refs = st.st_nlink - 1
+                blobs += 1
+                tiles += refs
+                stored += st.st_size
+                logical += refs * st.st_size
+    return {
+        'blobs': blobs,
+        'tiles': tiles,
+        'stored_bytes': stored,
+        'logical_bytes': logical,
+        'saved_bytes': max(0, logical - stored),
+        'ratio': round(logical / stored, 2) if stored else None,
+    }
+
+
+class PayloadCache:
+    """ In memory LRU cache for shared payloads
+
+        Payloads are keyed by the inode of the blob, only
+        payloads referenced by multiple tiles are kept.
+    """
+
+    def __init__(self, max_size: int, min_links: int=3) -> None:
+        self.max_size = max_size
+        self.min_links = min_links
+        self._size = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def read(self, path: Path, st: os.stat_result) -> bytes:
+        """ Read payload from memory or from path
+        """
+        if st.st_nlink < self.min_links or st.st_size > self.max_size:
+            return path.read_bytes()
+
+        key = (st.st_dev, st.st_ino, st.st_mtime_ns)
+        data = self.get(key)
+        if data is None:
+            data = path.read_bytes()
+            self.put(key, data)
+        return data
+
+    def get(self, key) -> Optional[bytes]:
+        with self._lock:
+            data = self._items.get(key)
+            if data is not None:
+                self._items.move_to_end(key)
+            return data
+
+    def put(self, key, data: bytes) -> None:
+        with self._lock:
+            if key in self._items:
+                return
+            self._items[key] = data
+            self._size += len(data)
+            while self._size > self.max_size:
+                _, evicted = self._items.popitem(last=False)
+                self._size -= len(evicted)
@@ -0,0 +1,85 @@
+""" Project generations
+
+    The generation of a project is the last modification time of the
+    project in milliseconds. It is recorded in the project cache
+    directory the first time tiles are looked up for a version of the
+    project: tiles of older generations are retired at once by moving
+    their directories out of the cache and are removed in background.
+
+    Copyright: (C) 2019 3Liz
+"""
+import os
+import threading
+
+from typing import Dict, Optional, Tuple
+
+from .helper import CacheHelper, atomic_write
+from .tiers import TieredStorage
+
+
+class Generations:
+    """ Validate tiles against the project generation
+
+        Validation is done once for each generation of a project and
+        done again when the recorded generation is changed by another
+        process.
+    """
+
+    def __init__(self, cache: CacheHelper, storage: TieredStorage) -> None:
+        self._cache = cache
+        self._storage = storage
+        self._checked: Dict[str,Tuple[int,Optional[Tuple[int,int]],bool]] = {}
+        self._lock = threading.Lock()
+
+    def recorded(self, project: str) -> Optional[int]:
+        """ Return the recorded generation of the project
+        """
+        try:
+            return int(self._cache.get_generation_path(project).read_text())
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def _stamp(self, project: str) -> Optional[Tuple[int,int]]:
+        """ Return the identity of the recorded generation file
+        """
+        try:
+            st = os.stat(self._cache.get_generation_path(project))
+        except FileNotFoundError:
+            return None
+        return st.st_mtime_ns, st.st_ino
+
+    def validate(self, project: str, generation: int) -> bool:
+        """ Retire tiles of older generations of the project
+
+            Tiles are kept if no generation has been recorded yet
+            or if the recorded generation is newer: the project may
+            not have been reloaded yet by this process.
+
+            Return False if the recorded generation is newer: tiles
+            must then be neither served nor written for this version
+            of the project.
+        """
+        stamp = self._stamp(project)
+        checked = self._checked.get(project)
+        if checked is not None and checked[:2] == (generation, stamp):
+            return checked[2]
+        with self._lock:
+            stamp = self._stamp(project)
+            checked = self._checked.get(project)
+            if checked is not None and checked[:2] == (generation, stamp):
+                return checked[2]
+            recorded = self.recorded(project)
+            if recorded is None or recorded < generation:
+                if recorded is not None:
+                    self._storage.retire(self._cache.get_tiles_root(project))
+                    readable = self._cache.get_readable_root(project)
+                    if readable:
+                        self._storage.retire(readable)
+                path = self._cache.get_generation_path(project)
+                path.parent.mkdir(mode=0o750, parents=True, exist_ok=True)
+                atomic_write(path, str(generation).encode())
+                recorded = generation
+                stamp = self._stamp(project)
+            current = recorded <= generation
+            self._checked[project] = (generation, stamp, current)
+            return current
@@ -0,0 +1,247 @@
+""" Tile request heatmaps
+
+    Tile requests are counted in memory by tile and periodically added
+    to a grid of counts per layer, tile matrix set and tile matrix stored
+    in the `heatmap` directory of the project cache.
+
+    Grids have at most GRID_SIZE x GRID_SIZE blocks of 2^shift x 2^shift
+    tiles: the block size is doubled when tiles do not fit in the grid.
+    Grids are stored as a small header followed by the little endian
+    32 bits counts of the blocks, row by row.
+
+    Copyright: (C) 2019 3Liz
+"""
+import atexit
+import fcntl
+import os
+import struct
+import sys
+import threading
+import zlib
+
+from array import array
+from collections import Counter, defaultdict
+from hashlib import md5
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+from urllib.parse import unquote
+
+from .helper import atomic_write, escape_segment
+
+HEATMAP_DIR = 'heatmap'
+
+# Maximum number of blocks by grid side
+GRID_SIZE = 256
+
+# Delay in seconds between writes of the counts
+FLUSH_INTERVAL = 60
+
+# Number of counted tiles triggering a write of the counts
+MAX_PENDING = 100000
+
+HEADER = struct.Struct('<4sBHH')
+MAGIC = b'WHM1'
+
+Key = Tuple[str, str, str, str]
+
+
+class HeatGrid:
+    """ Grid of request counts
+    """
+
+    def __init__(self, shift: int=0, width: int=0, height: int=0,
+                 counts: Optional[array]=None) -> None:
+        self.shift = shift
+        self.width = width
+        self.height = height
+        self.counts = counts if counts is not None else array('I', bytes(4 * width * height))
+
+    @classmethod
+    def load(cls, path: Path) -> 'HeatGrid':
+        return cls.loads(path.read_bytes())
+
+    @classmethod
+    def loads(cls, data: bytes) -> 'HeatGrid':
+        if len(data) < HEADER.size:
+            raise ValueError("Invalid heatmap")
+        magic, shift, width, height = HEADER.unpack_from(data)
+        if magic != MAGIC or len(data) < HEADER.size + 4 * width * height:
+            raise ValueError("Invalid heatmap")
+        counts = array('I')
+        counts.frombytes(data[HEADER.size:HEADER.size + 4 * width * height])
+        if sys.byteorder == 'big':
+            counts.byteswap()
+        return cls(shift, width, height, counts)
+
+    def dumps(self) -> bytes:
+        counts = self.counts
+        if sys.byteorder == 'big':
+            counts = array('I', counts)
+            counts.byteswap()
+        return HEADER.pack(MAGIC, self.shift, self.width, self.height) + counts.tobytes()
+
+    def get(self, row: int, col: int) -> int:
+        """ Return the count of the block at block coordinates
+        """
+        return self.counts[row * self.width + col]
+
+    def resize(self, shift: int, width: int, height: int) -> None:
+        """ Resize the grid, counts are merged into larger blocks
+        """
+        counts = array('I', bytes(4 * width * height))
+        delta = shift - self.shift
+        for r in range(self.height):
+            for c in range(self.width):
+                n = self.counts[r * self.width + c]
+                if n:
+                    counts[(r >> delta) * width + (c >> delta)] += n
+        self.shift, self.width, self.height, self.counts = shift, width, height, counts
+
+    def add(self, tiles: Dict[Tuple[int,int], int]) -> None:
+        """ Add the request counts of tiles
+        """
+        maxrow = max(row for row, _ in tiles)
+        maxcol = max(col for _, col in tiles)
+        shift = self.shift
+        while max(maxrow, maxcol) >> shift >= GRID_SIZE:
+            shift += 1
+        delta = shift - self.shift
+        height = max(((self.height - 1) >> delta) + 1 if self.height else 0, (maxrow >> shift) + 1)
+        width = max(((self.width - 1) >> delta) + 1 if self.width else 0, (maxcol >> shift) + 1)
+        if (shift, width, height) != (self.shift, self.width, self.height):
+            self.resize(shift, width, height)
+        for (row, col), n in tiles.items():
+            index = (row >> shift) * width + (col >> shift)
+            self.counts[index] = min(self.counts[index] + n, 0xffffffff)
+
+    def blocks(self) -> Iterator[Tuple[int, int, int]]:
+        """ Return the (row, col, count) of the blocks with requests
+
+            Block coordinates are the coordinates of their first tile
+        """
+        for r in range(self.height):
+            for c in range(self.width):
+                n = self.counts[r * self.width + c]
+                if n:
+                    yield r << self.shift, c << self.shift, n
+
+    def png(self) -> bytes:
+        """ Return the grid as a PNG density image
+
+            Colors go from transparent blue to opaque red with the
+            logarithm of the counts.
+        """
+        peak = max(self.counts, default=0)
+        scale = 255 / (peak.bit_length() or 1)
+        raw = bytearray()
+        for r in range(self.height):
+            raw.append(0)
+            for c in range(self.width):
+                n = self.counts[r * self.width + c]
+                if not n:
+                    raw += b'\0\0\0\0'
+                    continue
+                v = int(max(1, n.bit_length()) * scale)
+                raw += bytes((v, 0, 255 - v, 64 + v * 191 // 255))
+
+        def chunk(kind: bytes, data: bytes) -> bytes:
+            return struct.pack('>I', len(data)) + kind + data + \
+                struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+
+        return b'\x89PNG\r\n\x1a\n' + \
+            chunk(b'IHDR', struct.pack('>IIBBBBB', max(self.width, 1), max(self.height, 1), 8, 6, 0, 0, 0)) + \
+            chunk(b'IDAT', zlib.compress(bytes(raw) or b'\0\0\0\0\0')) + \
+            chunk(b'IEND', b'')
+
+
+def heatmap_root(rootdir: Path, projecthash: str) -> Path:
+    """ Return the heatmap directory of the project cache
+    """
+    return rootdir / projecthash / HEATMAP_DIR
+
+
+def heatmap_path(rootdir: Path, projecthash: str, layer: str, tilematrixset: str,
+                 tilematrix: str) -> Path:
+    """ Return the path of the heatmap grid
+    """
+    return heatmap_root(rootdir, projecthash) / escape_segment(layer) / escape_segment(tilematrixset) \
+        / (escape_segment(tilematrix) + '.heat')
+
+
+def heatmap_tilematrixsets(rootdir: Path, projecthash: str, layer: str) -> List[str]:
+    """ Return the tile matrix sets of the layer heatmaps
+    """
+    path = heatmap_root(rootdir, projecthash) / escape_segment(layer)
+    if not path.is_dir():
+        return []
+    return sorted(unquote(p.name) for p in path.iterdir() if p.is_dir())
+
+
+class HeatMap:
+    """ Count tile requests
+    """
+
+    def __init__(self, rootdir: Path, interval: float=FLUSH_INTERVAL) -> None:
+        self.rootdir = rootdir
+        self.interval = interval
+        self._pending: Dict[Key, Counter] = defaultdict(Counter)
+        self._size = 0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        t = threading.Thread(target=self._run, daemon=True, name="wmtscache-heatmap")
+        t.start()
+        atexit.register(self.flush)
+
+    def record(self, project: str, params: Dict[str,str]) -> None:
+        """ Count a tile request
+        """
+        try:
+            row, col = int(params['TILEROW']), int(params['TILECOL'])
+        except (KeyError, ValueError):
+            return
+        if row < 0 or col < 0:
+            return
+        key = (project, params.get('LAYER',''), params.get('TILEMATRIXSET',''), params.get('TILEMATRIX',''))
+        with self._lock:
+            self._pending[key][(row, col)] += 1
+            self._size += 1
+            if self._size >= MAX_PENDING:
+                self._wakeup.set()
+
+    def flush(self) -> None:
+        """ Add the pending counts to the stored grids
+        """
+        with self._lock:
+            pending, self._pending = self._pending, defaultdict(Counter)
+            self._size = 0
+        with self._flush_lock:
+            for (project, layer, tms, tm), tiles in pending.items():
+                path = heatmap_path(self.rootdir, md5(project.encode()).hexdigest(), layer, tms, tm)
+                try:
+                    update_grid(path, tiles)
+                except (OSError, ValueError):
+                    continue
+
+    def _run(self) -> None:
+        while True:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            self.flush()
+
+
+def update_grid(path: Path, tiles: Dict[Tuple[int,int], int]) -> None:
+    """ Add counts to the stored grid
+
+        Grids are updated under a file lock since they are
+        shared by all server processes
+    """
+    path.parent.mkdir(mode=0o750, parents=True, exist_ok=True)
+    fd = os.open(path.with_suffix('.lock').as_posix(), os.O_RDWR | os.O_CREAT, 0o640)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        grid = HeatGrid.load(path) if path.exists() else HeatGrid()
+        grid.add(tiles)
+        atomic_write(path, grid.dumps())
+    finally:
+        os.close(fd)
@@ -4,18 +4,29 @@
     Copyright: (C) 2019 3Liz
 """
 import json
+import os
+import shutil
+import threading
 
 from datetime import datetime
 from hashlib import md5
 from pathlib import Path
-from typing import Dict, TypeVar
+from typing import Dict, Optional, Sequence, TypeVar
+from urllib.parse import quote
 
+from .cachekeys import canonical_key, canonical_params
 from .layouts import layouts
+from .shards import RESERVED_NAMES, is_project_hash, shard_for
 
 Hash = TypeVar('Hash')
 
 METADATA_VERSION = '1.0'
 
+READABLE_LAYOUT = 'readable'
+
+# File storing the readable project id in the project cache directory
+PROJECT_ID_FILE = 'project_id'
+
 
 def get_image_sfx(fmt: str) -> str:
     """ Return suffix from mimetype
@@ -31,16 +42,72 @@ def get_image_sfx(fmt: str) -> str:
         raise ValueError("Unknown image type %s" % fmt)
 
 
+def escape_segment(value: str) -> str:
+    """ Escape value as a single path segment
+
+        Values are percent encoded as with javascript `encodeURIComponent`
+    """
+    value = quote(value, safe="!'()*")
+    if value in ('.', '..'):
+        value = value.replace('.', '%2E')
+    return value
+
+
+def get_readable_root(rootdir: Path, digest: str) -> Optional[Path]:
+    """ Return the root of readable tiles for the project digest
+    """
+    p = rootdir / digest / PROJECT_ID_FILE
+    return rootdir / p.read_text() if p.exists() else None
+
+
+def atomic_write(path: Path, data: bytes) -> None:
+    """ Write data so that readers never see a partial file
+    """
+    tmp = path.with_name('.%s.%d.%d.tmp' % (path.name, os.getpid(), threading.get_ident()))
+    try:
+        with tmp.open('wb') as f:
+            f.write(data)
+        os.replace(tmp.as_posix(), path.as_posix())
+    except Exception:
+        if tmp.exists():
+            tmp.unlink()
+        raise
+
+
+def atomic_copy(src: Path, dst: Path) -> None:
+    """ Copy file so that readers never see a partial file
+    """
+    dst.parent.mkdir(mode=0o750, parents=True, exist_ok=True)
+    tmp = dst.with_name('.%s.%d.%d.tmp' % (dst.name, os.getpid(), threading.get_ident()))
+    shutil.copy2(src.as_posix(), tmp.as_posix())
+    os.replace(tmp.as_posix(), dst.as_posix())
+
+
 class CacheHelper:
 
-    def __init__(self, rootdir: Path, layout: str) -> None:
+    def __init__(self, rootdir: Path, layout: str, shards: Sequence[Path]=()) -> None:
         self.rootdir = rootdir
+        self.layout = layout
         self._tile_location = layouts.get(layout)
         if self._tile_location is None:
             raise ValueError("Unknown tile layout %s" % layout)
 
-        metadata = rootdir / 'wmts.json'
-        metadata.write_text(json.dumps({'layout': layout,}))
+        self.shards = list(shards) or [rootdir]
+        self._shard_cache = {}
+
+        metadata = {'layout': layout}
+        if self.shards != [rootdir]:
+            metadata.update(shards=[s.as_posix() for s in self.shards])
+
+        (rootdir / 'wmts.json').write_text(json.dumps(metadata))
+
+    def get_shard(self, digest: str) -> Path:
+        """ Return the shard root for tile digest
+        """
+        shard = self._shard_cache.get(digest)
+        if shard is None:
+            shard = self._shard_cache[digest] = shard_for(self.shards, digest)
+        return shard
 
     def get_project_hash(self, ident: str) -> Hash:
         """ Attempt to create a hash from project infos
@@ -54,16 +121,19 @@ class CacheHelper:
 
     def get_document_cache(
             self, project: str, params: Dict[str,str], suffix: str='.xml', create_dir: bool=False,
-            last_modified: datetime=None) -> Path:
+            last_modified: datetime=None, key: str='') -> Path:
         """ Create a cache path for the document
+
+            The key is the access control cache key
         """
         h = self.get_project_hash(project)
         cachedir = self.rootdir / h.hexdigest()
         p = cachedir / "docs"
 
-        # XXX: Take care that that order of items is random !
-        qs = "&".join("%s=%s" % (k,params[k]) for k in sorted(params.keys())).encode()
-        h.update(qs)
+        # Equivalent requests share the same document
+        h.update(canonical_key(canonical_params(params)).encode())
+        if key:
+            h.update(key.encode())
 
         digest = h.hexdigest()
 
@@ -89,13 +159,48 @@ class CacheHelper:
         h = self.get_project_hash(project)
         return self.rootdir / h.hexdigest() / "docs"
 
+    def get_tilematrix_path(self, project: str) -> Path:
+        """ Return the path of project tile matrix infos
+        """
+        h = self.get_project_hash(project)
+        return self.rootdir / h.hexdigest() / "tilematrix.json"
+
+    def get_generation_path(self, project: str) -> Path:
+        """ Return the path of the recorded project generation
+        """
+        h = self.get_project_hash(project)
+        return self.rootdir / h.hexdigest() / "generation"
+
+    def get_project_id(self, project: str, project_id: Optional[str]=None) -> str:
+        """ Return the readable project id
+
+            Default to the project file name without extension followed
+            by the beginning of the project hash, so that projects with
+            the same file name do not share their tiles
+        """
+        if not project_id:
+            project_id = "%s-%s" % (Path(project).stem, self.get_project_hash(project).hexdigest()[:8])
+        pid = escape_segment(project_id)
+        if pid in RESERVED_NAMES or is_project_hash(pid):
+            pid += '_'
+        return pid
+
+    def get_readable_root(self, project: str) -> Optional[Path]:
+        """ Return base path for tiles with the readable layout
+        """
+        return get_readable_root(self.rootdir, self.get_project_hash(project).hexdigest())
+
     def get_tiles_root(self, project: str) -> Path:
         """ Return base path for tiles
+
+            With multiple shards, this is the logical path
+            of tiles in the cache root
         """
         h = self.get_project_hash(project)
         return self.rootdir / h.hexdigest() / "tiles"
 
-    def get_tile_cache(self, project: str, params: Dict[str,str], create_dir: bool=False) -> Path:
+    def get_tile_cache(self, project: str, params: Dict[str,str], create_dir: bool=False,
+                       layout: Optional[str]=None, project_id: Optional[str]=None) -> Path:
         """ Create a cache path for tile
 
             The path is computed according to the folowing parameters:
@@ -107,31 +212,58 @@ class CacheHelper:
             TILECOL (y en tms)
             STYLE (le style)
             FORMAT (sous la forme image/*)
+
+            If layout is set, it overrides the default tile layout
+
+            With the readable layout, tiles are stored at
+            '<project_id>/<layer>/<tilematrixset>/<style>/z/x/y.format'
         """
+        params = canonical_params(params)
+
         h = self.get_project_hash(project)
-        cachedir = self.rootdir / h.hexdigest()
-        tiledir  = cachedir / 'tiles'
+        projectid = h.hexdigest()
+        cachedir = self.rootdir / projectid
 
         layer = params.get('LAYER','_none')
 
-        h.update(layer.encode())
-        h.update(params.get('TILEMATRIXSET','').encode())
-        h.update(params.get('STYLE','').encode())
-
-        digest = h.hexdigest()
-
         x,y,z= params['TILEROW'],params['TILECOL'],params['TILEMATRIX']
 
         # Retrieve file suffix from FORMAT spec
         fmt = params.get('FORMAT')
         file_ext = get_image_sfx(fmt) if fmt else '.png'
 
-        p = self._tile_location(tiledir / layer / digest, int(x), int(y), z, file_ext)
+        layout = layout or self.layout
+
+        if layout == READABLE_LAYOUT:
+            pid = self.get_project_id(project, project_id)
+            key = '/'.join((
+                pid,
+                escape_segment(layer),
+                escape_segment(params.get('TILEMATRIXSET','')),
+                escape_segment(params.get('STYLE','') or 'default'),
+            ))
+            tiledir = self.get_shard(key) / key
+        else:
+            h.update(layer.encode())
+            h.update(params.get('TILEMATRIXSET','').encode())
+            h.update(params.get('STYLE','').encode())
+
+            digest = h.hexdigest()
+
+            tiledir = self.get_shard(digest) / projectid / 'tiles' / layer / digest
+
+        p = layouts[layout](tiledir, int(x), int(y), z, file_ext)
 
         if create_dir:
             p.parent.mkdir(mode=0o750, parents=True, exist_ok=True)
             inf = cachedir.with_suffix('.inf')
             if not inf.exists():
                 inf.write_text(project)
+            if layout == READABLE_LAYOUT:
+                # Record the readable project id
+                pidfile = cachedir / PROJECT_ID_FILE
+                if not pidfile.exists() or pidfile.read_text() != pid:
+                    cachedir.mkdir(mode=0o750, parents=True, exist_ok=True)
+                    pidfile.write_text(pid)
 
         return p
@@ -0,0 +1,256 @@
+""" Tile import
+
+    Tiles rendered outside of QGIS server are imported from directories,
+    tar archives or MBTiles files. Tiles are written through the cache
+    layout of their layer policy with atomic writes, by a pool of writer
+    threads.
+
+    Directory and tar archive entries are named as the WMTS REST
+    template '{layer}/{style}/{tilematrixset}/{tilematrix}/{tilerow}/{tilecol}.{ext}'
+    or as '{tilematrix}/{tilerow}/{tilecol}.{ext}' when the layer and the
+    tile matrix set are given as options.
+
+    Copyright: (C) 2019 3Liz
+"""
+import os
+import sqlite3
+import tarfile
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import (
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    NamedTuple,
+    Optional,
+    Tuple,
+    Union,
+)
+
+from .generation import Generations
+from .helper import CacheHelper
+from .jobs import Job
+from .policy import PolicyConfig
+from .tiers import TieredStorage
+from .tileserver import FORMATS
+
+# Directory of uploaded archives in the cache root
+IMPORT_DIR = '.imports'
+
+SQLITE_MAGIC = b'SQLite format 3\0'
+
+IMPORT_WORKERS = 8
+
+
+class TileRef(NamedTuple):
+    layer: str
+    style: str
+    tilematrixset: str
+    tilematrix: str
+    tilerow: int
+    tilecol: int
+    format: str
+
+    def params(self) -> Dict[str,str]:
+        """ Return the WMTS GetTile parameters of the tile
+        """
+        return {
+            'SERVICE': 'WMTS',
+            'REQUEST': 'GetTile',
+            'LAYER': self.layer,
+            'STYLE': self.style,
+            'TILEMATRIXSET': self.tilematrixset,
+            'TILEMATRIX': self.tilematrix,
+            'TILEROW': str(self.tilerow),
+            'TILECOL': str(self.tilecol),
+            'FORMAT': self.format,
+        }
+
+
+Payload = Union[bytes, Callable[[], bytes]]
+
+
+def tile_ref(name: str, options: Dict[str,str]) -> Optional[TileRef]:
+    """ Return the tile of an entry name
+
+        Return None if the name does not match a tile
+    """
+    parts = [p for p in name.replace(os.sep, '/').split('/') if p and p != '.']
+    col, _, ext = parts[-1].rpartition('.') if parts else ('', '', '')
+    fmt = FORMATS.get(ext.lower())
+    if fmt is None:
+        return None
+    if len(parts) == 6:
+        layer, style, tms, tm, row = parts[:5]
+    elif len(parts) == 3 and options.get('layer') and options.get('tilematrixset'):
+        layer, style, tms = options['layer'], options.get('style',''), options['tilematrixset']
+        tm, row = parts[:2]
+    else:
+        return None
+    if not (row.isdigit() and col.isdigit()):
+        return None
+    if style.lower() == 'default':
+        style = ''
+    return TileRef(layer, style, tms, tm, int(row), int(col), options.get('format') or fmt)
+
+
+def iter_dir(root: Path, options: Dict[str,str]) -> Iterator[Tuple[TileRef, Payload]]:
+    """ Return tiles of a directory
+
+        Tiles are read by the writer threads
+    """
+    for dirpath, _, files in os.walk(root.as_posix()):
+        for name in files:
+            path = Path(dirpath, name)
+            tile = tile_ref(path.relative_to(root).as_posix(), options)
+            if tile is not None:
+                yield tile, path.read_bytes
+
+
+def iter_tar(path: Path, options: Dict[str,str]) -> Iterator[Tuple[TileRef, Payload]]:
+    """ Return tiles of a tar archive, optionally compressed
+
+        The archive is read as a stream
+    """
+    with tarfile.open(path.as_posix(), mode='r|*') as tar:
+        for member in tar:
+            if not member.isfile():
+                continue
+            tile = tile_ref(member.name, options)
+            if tile is not None:
+                yield tile, tar.extractfile(member).read()
+
+
+def iter_mbtiles(path: Path, options: Dict[str,str]) -> Iterator[Tuple[TileRef, Payload]]:
+    """ Return tiles of a MBTiles file
+
+        MBTiles rows are flipped from the TMS scheme: the tile matrix set
+        must be a quad tree with a single tile at level 0.
+    """
+    if not options.get('layer') or not options.get('tilematrixset'):
+        raise ValueError("Layer and tile matrix set are required for MBTiles")
+    conn = sqlite3.connect('file:%s?mode=ro' % path.as_posix(), uri=True)
+    try:
+        fmt = options.get('format')
+        if not fmt:
+            row = conn.execute("SELECT value FROM metadata WHERE name = 'format'").fetchone()
+            fmt = FORMATS.get((row[0] if row else 'png').lower(), 'image/png')
+        cursor = conn.execute("SELECT zoom_level, tile_column, tile_row, tile_data FROM tiles")
+        for z, col, row, data in cursor:
+            yield TileRef(options['layer'], options.get('style',''), options['tilematrixset'],
+                          str(z), (1 << z) - 1 - row, col, fmt), bytes(data)
+    finally:
+        conn.close()
+
+
+def iter_source(path: Path, options: Dict[str,str]) -> Iterator[Tuple[TileRef, Payload]]:
+    """ Return tiles of a directory, a tar archive or a MBTiles file
+    """
+    if path.is_dir():
+        return iter_dir(path, options)
+    with path.open('rb') as f:
+        magic = f.read(len(SQLITE_MAGIC))
+    if magic == SQLITE_MAGIC:
+        return iter_mbtiles(path, options)
+    return iter_tar(path, options)
+
+
+class TileImporter:
+    """ Write tiles to the cache
+    """
+
+    def __init__(self, storage: TieredStorage, cache: CacheHelper, policy: PolicyConfig,
+                 project: str, workers: int=IMPORT_WORKERS) -> None:
+        self.storage = storage
+        self.cache = cache
+        self.policy = policy
+        self.project = project
+        self.workers = workers
+        self.stats = {'imported': 0, 'skipped': 0}
+        self._lock = threading.Lock()
+
+    def write(self, tile: TileRef, data: Payload) -> bool:
+        """ Write tile with atomic publication
+
+            Return False if the tile is invalid or not cacheable
+        """
+        if any(v in ('', '.', '..') for v in (tile.layer, tile.tilematrixset, tile.tilematrix)):
+            return False
+        policy = self.policy.resolve(self.project, tile.layer)
+        if not policy.cache or not policy.accept_zoom(tile.tilematrix):
+            return False
+        if callable(data):
+            data = data()
+        p = self.cache.get_tile_cache(self.project, tile.params(), create_dir=True,
+                                      layout=policy.layout, project_id=policy.project_id)
+        self.storage.write(p, data, dedup=policy.dedup)
+        return True
+
+    def _write(self, tile: TileRef, data: Payload) -> None:
+        written = self.write(tile, data)
+        with self._lock:
+            self.stats['imported' if written else 'skipped'] += 1
+
+    def run(self, tiles: Iterable[Tuple[TileRef, Payload]],
+            progress: Optional[Callable[[int], None]]=None,
+            cancelled: Optional[Callable[[], bool]]=None) -> Dict[str,int]:
+        """ Import tiles in parallel
+
+            The number of pending writes is bounded so that
+            archives are not loaded in memory.
+
+            Raise ValueError if the project file is older than
+            the recorded project generation.
+        """
+        # Do not retire imported tiles on the next lookup
+        try:
+            generation = os.stat(self.project).st_mtime_ns // 1000000
+        except OSError:
+            pass
+        else:
+            if not Generations(self.cache, self.storage).validate(self.project, generation):
+                raise ValueError("Project %s is older than its cached tiles" % self.project)
+
+        pending = threading.BoundedSemaphore(self.workers * 4)
+        errors = []
+
+        def done(fut):
+            pending.release()
+            if fut.exception() is not None:
+                errors.append(fut.exception())
+
+        count = 0
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='wmtscache-import') as pool:
+            for tile, data in tiles:
+                if errors or (cancelled and cancelled()):
+                    break
+                pending.acquire()
+                pool.submit(self._write, tile, data).add_done_callback(done)
+                count += 1
+                if progress:
+                    progress(count)
+        if errors:
+            raise errors[0]
+        return dict(self.stats)
+
+
+def import_tiles(storage: TieredStorage, policy: PolicyConfig, rootdir: Path,
+                 job: Job, params: Dict) -> None:
+    """ Job importing an uploaded archive
+
+        The archive is removed when the job is finished
+    """
+    archive = Path(params['archive'])
+    cache = CacheHelper(rootdir, params['layout'], storage.shards)
+    importer = TileImporter(storage, cache, policy, params['project'])
+    try:
+        importer.run(iter_source(archive, params['options']), progress=job.progress,
+                     cancelled=job.cancelled)
+    finally:
+        try:
+            archive.unlink()
+        except FileNotFoundError:
+            pass
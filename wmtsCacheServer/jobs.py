@@ -0,0 +1,338 @@
+""" Background jobs
+
+    Long running cache operations are run as jobs by worker threads.
+    Jobs are stored as json records in the `.jobs` directory of the
+    cache root so that they are shared by all server processes and
+    survive restarts: a job is run by the process holding the lock on
+    its lock file and jobs left running by a stopped process are
+    started again. Job functions must therefore be idempotent.
+
+    Idle workers also run periodic maintenance tasks.
+
+    Copyright: (C) 2019 3Liz
+"""
+import fcntl
+import json
+import os
+import re
+import sys
+import threading
+import time
+import traceback
+import uuid
+
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from .helper import atomic_write
+from .tiers import TieredStorage
+
+try:
+    from qgis.core import Qgis, QgsMessageLog
+except ImportError:
+    # Command line tools run without QGIS
+    QgsMessageLog = None
+
+JOBS_DIR = '.jobs'
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+
+# Delay in seconds between checks for jobs submitted by other processes
+JOB_POLL_INTERVAL = 5
+
+# Time in seconds finished jobs are kept
+JOB_RETENTION = 86400
+
+# Minimum delay in seconds between progress updates
+PROGRESS_INTERVAL = 1
+
+JOB_ID = re.compile(r'^[0-9a-f]{32}$')
+
+
+def log_exception(message: str) -> None:
+    """ Log the current exception
+    """
+    text = "%s\n%s" % (message, traceback.format_exc())
+    if QgsMessageLog is not None:
+        QgsMessageLog.logMessage(text, 'wmtsCache', Qgis.Critical)
+    else:
+        sys.stderr.write(text)
+
+
+class Job:
+    """ Running job
+    """
+
+    def __init__(self, queue: 'JobQueue', record: Dict) -> None:
+        self._queue = queue
+        self.record = record
+        self._start = time.monotonic()
+        self._saved = 0.
+        self._checked = 0.
+        self._cancelled = False
+
+    @property
+    def id(self) -> str:
+        return self.record['id']
+
+    def progress(self, done: int, total: Optional[int]=None) -> None:
+        """ Update job progress
+
+            Progress is saved at most once every progress interval
+        """
+        elapsed = time.monotonic() - self._start
+        self.record.update(done=done, total=total, rate=round(done / elapsed, 1) if elapsed else None)
+        now = time.monotonic()
+        if now - self._saved >= PROGRESS_INTERVAL:
+            self._saved = now
+            self._queue.save(self.record)
+
+    def cancelled(self) -> bool:
+        """ Check if job cancellation has been requested
+        """
+        if not self._cancelled:
+            now = time.monotonic()
+            if now - self._checked >= PROGRESS_INTERVAL:
+                self._checked = now
+                self._cancelled = self._queue.cancel_path(self.id).exists()
+        return self._cancelled
+
+
+JobFunction = Callable[[Job, Dict], None]
+
+
+class JobQueue:
+    """ Queue of jobs persisted on disk
+    """
+
+    def __init__(self, rootdir: Path, workers: int=1, poll: float=JOB_POLL_INTERVAL,
+                 retention: float=JOB_RETENTION) -> None:
+        self.path = rootdir / JOBS_DIR
+        self.workers = workers
+        self.poll = poll
+        self.retention = retention
+        self._functions: Dict[str, JobFunction] = {}
+        self._tasks: List[List] = []
+        self._tasks_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._started = False
+
+    def register(self, kind: str, func: JobFunction) -> None:
+        """ Register the function running jobs of kind
+        """
+        self._functions[kind] = func
+
+    def schedule(self, func: Callable[[], Any], interval: float) -> None:
+        """ Run func every interval seconds from idle workers
+
+            The first run happens as soon as a worker is idle.
+        """
+        with self._tasks_lock:
+            self._tasks.append([func, interval, 0.0])
+
+    def run_tasks(self) -> None:
+        """ Run due periodic tasks
+        """
+        now = time.monotonic()
+        due = []
+        with self._tasks_lock:
+            for task in self._tasks:
+                if task[2] <= now:
+                    task[2] = now + task[1]
+                    due.append(task[0])
+        for func in due:
+            try:
+                func()
+            except Exception as e:
+                log_exception("WMTS Cache task exception: %s" % e)
+
+    def start(self) -> None:
+        """ Start worker threads
+        """
+        if self._started:
+            return
+        self._started = True
+        self.path.mkdir(mode=0o750, parents=True, exist_ok=True)
+        for i in range(self.workers):
+            t = threading.Thread(target=self._run, daemon=True, name="wmtscache-job-%d" % i)
+            t.start()
+
+    def record_path(self, jobid: str) -> Path:
+        return self.path / ('%s.json' % jobid)
+
+    def lock_path(self, jobid: str) -> Path:
+        return self.path / ('%s.lock' % jobid)
+
+    def cancel_path(self, jobid: str) -> Path:
+        return self.path / ('%s.cancel' % jobid)
+
+    def save(self, record: Dict) -> None:
+        atomic_write(self.record_path(record['id']), json.dumps(record).encode())
+
+    def submit(self, kind: str, params: Dict) -> Dict:
+        """ Queue a new job
+        """
+        self.path.mkdir(mode=0o750, parents=True, exist_ok=True)
+        record = {
+            'id': uuid.uuid4().hex,
+            'kind': kind,
+            'params': params,
+            'state': QUEUED,
+            'created': time.time(),
+            'started': None,
+            'finished': None,
+            'done': 0,
+            'total': None,
+            'rate': None,
+            'runs': 0,
+            'error': None,
+        }
+        self.save(record)
+        self._wakeup.set()
+        return record
+
+    def get(self, jobid: str) -> Optional[Dict]:
+        """ Return job record
+        """
+        if not JOB_ID.match(jobid):
+            return None
+        try:
+            return json.loads(self.record_path(jobid).read_text())
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def jobs(self) -> List[Dict]:
+        """ Return all job records, oldest first
+        """
+        records = []
+        if self.path.is_dir():
+            for p in self.path.glob('*.json'):
+                record = self.get(p.stem)
+                if record:
+                    records.append(record)
+        records.sort(key=lambda r: r['created'])
+        return records
+
+    def cancel(self, jobid: str) -> Optional[Dict]:
+        """ Cancel job
+
+            Queued jobs are cancelled at once, running jobs are
+            cancelled by the process running them.
+        """
+        record = self.get(jobid)
+        if record is None or record['state'] not in (QUEUED, RUNNING):
+            return record
+        self.cancel_path(jobid).touch()
+        claimed = self._lock(jobid)
+        if claimed is not None:
+            # Not running
+            try:
+                record = self.get(jobid)
+                if record['state'] in (QUEUED, RUNNING):
+                    record.update(state=CANCELLED, finished=time.time())
+                    self.save(record)
+            finally:
+                os.close(claimed)
+        return record
+
+    def _lock(self, jobid: str) -> Optional[int]:
+        """ Lock the job, return the lock file descriptor
+        """
+        fd = os.open(self.lock_path(jobid).as_posix(), os.O_RDWR | os.O_CREAT, 0o640)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return None
+        return fd
+
+    def remove(self, jobid: str) -> None:
+        for p in (self.record_path(jobid), self.lock_path(jobid), self.cancel_path(jobid)):
+            try:
+                p.unlink()
+            except FileNotFoundError:
+                pass
+
+    def claim(self) -> Optional[Tuple[Dict, int]]:
+        """ Return the oldest runnable job with its lock
+
+            Expired jobs are removed
+        """
+        limit = time.time() - self.retention
+        for record in self.jobs():
+            if record['state'] not in (QUEUED, RUNNING):
+                if record['finished'] and record['finished'] < limit:
+                    self.remove(record['id'])
+                continue
+            if record['kind'] not in self._functions:
+                continue
+            fd = self._lock(record['id'])
+            if fd is None:
+                continue
+            # Check that the job has not been run meanwhile
+            record = self.get(record['id'])
+            if record and record['state'] in (QUEUED, RUNNING):
+                return record, fd
+            os.close(fd)
+        return None
+
+    def execute(self, record: Dict) -> None:
+        """ Run the job
+        """
+        job = Job(self, record)
+        record.update(state=RUNNING, started=time.time(), runs=record['runs'] + 1)
+        self.save(record)
+        try:
+            if not job.cancelled():
+                self._functions[record['kind']](job, record['params'])
+            record['state'] = CANCELLED if job.cancelled() else DONE
+        except Exception as e:
+            record.update(state=FAILED, error=str(e))
+            log_exception("WMTS Cache job %s failed: %s" % (record['id'], e))
+        record['finished'] = time.time()
+        self.save(record)
+
+    def _run(self) -> None:
+        while True:
+            try:
+                claimed = self.claim()
+            except OSError as e:
+                log_exception("WMTS Cache jobs exception: %s" % e)
+                claimed = None
+            if claimed is None:
+                self.run_tasks()
+                self._wakeup.wait(self.poll)
+                self._wakeup.clear()
+                continue
+            record, fd = claimed
+            try:
+                self.execute(record)
+            finally:
+                os.close(fd)
+
+
+def delete_tiles(storage: TieredStorage, job: Job, params: Dict) -> None:
+    """ Job removing tile directories
+    """
+    paths = [Path(p) for p in params['paths']]
+    if storage.grace:
+        # Tiles are retired at once
+        for i, p in enumerate(paths):
+            storage.discard(p)
+            job.progress(i + 1, len(paths))
+        return
+    total = sum(storage.count_files(p) for p in paths)
+    done = 0
+    try:
+        for p in paths:
+            for count in storage.iter_rmtree(p):
+                done += count
+                job.progress(done, total)
+                if job.cancelled():
+                    return
+    finally:
+        storage.collect_blobs()
@@ -5,6 +5,8 @@
     * `tc`: TileCache compatible layout, (`zz/xxx/xxx/xxx/yyy/yyy/yyy.format`)
     * `mp`: MapProxy layout (`zz/xxxx/xxxx/yyyy/yyyy.format`), moins de niveaux de repertoire
     * `tms`: TMS compatible layout (`zz/xxxx/yyyy.format`)
+    * `readable`: XYZ layout (`z/x/y.format`) under readable project, layer, tile matrix set
+      and style directories
 """
 # Original licence
 # This file is part of the MapProxy project.
@@ -88,9 +90,18 @@ def tile_location_reverse_tms(root: Path, x: int, y: int, z: Union[int,str], fil
     return (root / os.path.join( str(y), str(x), str(z))).with_suffix(file_ext)
 
 
+def tile_location_zxy(root: Path, x: int, y: int, z: Union[int,str], file_ext: str) -> Path:
+    """ XYZ layout
+
+        schema: z/col/row.format
+    """
+    return (root / os.path.join( str(z), str(y), str(x))).with_suffix(file_ext)
+
+
 layouts = {
     'tc': tile_location_tc,
     'mp': tile_location_mp,
     'tms': tile_location_tms,
-    'reverse_tms': tile_location_tms
+    'reverse_tms': tile_location_tms,
+    'readable': tile_location_zxy,
 }
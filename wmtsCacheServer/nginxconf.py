@@ -0,0 +1,150 @@
+""" Nginx configuration for serving tiles with the readable layout
+
+    Request parameters are mapped to the escaped path segments of cached
+    tiles, only values found in the cache are mapped: other requests
+    are forwarded to QGIS server.
+
+    Copyright: (C) 2019 3Liz
+"""
+import os
+import sys
+
+from pathlib import Path
+from typing import Dict, Iterable, List, Set, Tuple
+from urllib.parse import quote, unquote, urlsplit
+
+from .helper import get_readable_root
+from .tiers import TieredStorage
+
+
+def _string(value: str) -> str:
+    return '"%s"' % value.replace('\\', '\\\\').replace('"', '\\"')
+
+
+# Map parameter names
+MAP_SPECIAL_NAMES = ('default', 'hostnames', 'include', 'volatile')
+
+
+def _map(source: str, variable: str, entries: Iterable[Tuple[str,str]], default: str='""',
+         regexes: Iterable[Tuple[str,str]]=()) -> List[str]:
+    lines = ["map %s %s {" % (source, variable), "    default %s;" % default]
+    seen = set()
+    for key, value in entries:
+        if key in seen or '$' in key or key.startswith('~'):
+            # Variables and regular expressions are not allowed in values
+            continue
+        seen.add(key)
+        if key in MAP_SPECIAL_NAMES:
+            lines.append("    \\%s %s;" % (key, value))
+        else:
+            lines.append("    %s %s;" % (_string(key), value))
+    for regex, value in regexes:
+        lines.append("    %s %s;" % (_string(regex), value))
+    lines.append("}")
+    return lines
+
+
+def _segments(names: Set[str]) -> Iterable[Tuple[str,str]]:
+    """ Map raw and encoded request values to escaped names
+    """
+    for name in sorted(names):
+        yield name, _string(name)
+        yield unquote(name), _string(name)
+
+
+def tile_roots(storage: TieredStorage) -> List[Path]:
+    """ Return tile roots in lookup order
+    """
+    roots = []
+    for tier in storage.tiers:
+        roots.extend(storage.shards if tier is storage.base else [tier.root])
+    return roots
+
+
+def collect(rootdir: Path, storage: TieredStorage,
+            projects: Dict[str,str]) -> Tuple[Dict[str,str], List[Set[str]]]:
+    """ Collect project ids and path segments of readable tiles
+
+        Return project ids by project path and the sets of
+        layers, tile matrix sets, styles and tile matrices
+    """
+    pids = {}
+    segments = [set(), set(), set(), set()]
+
+    def walk(path: Path, depth: int) -> None:
+        for p in storage.iterdir(path):
+            segments[depth].add(p.name)
+            if depth < 3:
+                walk(p, depth + 1)
+
+    for digest, project in projects.items():
+        readable = get_readable_root(rootdir, digest)
+        if readable is None:
+            continue
+        pids[project] = readable.name
+        walk(readable, 0)
+
+    return pids, segments
+
+
+def nginx_config(rootdir: Path, storage: TieredStorage, projects: Dict[str,str],
+                 location: str, upstream: str) -> str:
+    """ Return nginx configuration for serving readable tiles
+
+        Projects are given as a dict of project paths by digest
+    """
+    pids, (layers, tms, styles, matrices) = collect(rootdir, storage, projects)
+
+    def project_keys():
+        for project, pid in sorted(pids.items()):
+            for key in (project, quote(project, safe=''), quote(project, safe='/')):
+                yield key, _string(pid)
+
+    roots = tile_roots(storage)
+    root = Path(os.path.commonpath([r.as_posix() for r in roots]))
+
+    u = urlsplit(upstream)
+    if u.path not in ('', '/'):
+        # Named locations cannot have an uri part
+        print("Warning: ignoring upstream path '%s'" % u.path, file=sys.stderr)
+
+    lines = ["# Generated by wmtscache nginx-config", "", "# http context", ""]
+    lines += _map("$arg_map", "$wmts_project", project_keys())
+    lines += _map("$arg_layer", "$wmts_layer", _segments(layers))
+    lines += _map("$arg_tilematrixset", "$wmts_tms", _segments(tms))
+    lines += _map("$arg_style", "$wmts_style", [("", '"default"')] + list(_segments(styles)))
+    lines += _map("$arg_tilematrix", "$wmts_z", _segments(matrices))
+    lines += _map("$arg_tilerow", "$wmts_y", (), regexes=[("~^0*(?<wmts_row>[0-9]+)$", "$wmts_row")])
+    lines += _map("$arg_tilecol", "$wmts_x", (), regexes=[("~^0*(?<wmts_col>[0-9]+)$", "$wmts_col")])
+    lines += _map("$arg_format", "$wmts_ext", [("", '"png"')], regexes=[
+        ("~*^image(/|%2F)png$", '"png"'),
+        ("~*^image(/|%2F)jpeg$", '"jpg"'),
+    ])
+    lines += _map('"$arg_service:$arg_request"', "$wmts_gettile", (), default="0",
+                  regexes=[("~*^wmts:gettile$", "1")])
+    lines += _map('"$wmts_gettile/$wmts_project/$wmts_layer/$wmts_tms/$wmts_style/$wmts_z/$wmts_x/$wmts_y.$wmts_ext"',
+                  "$wmts_tile", (), regexes=[("~^1/(?<wmts_path>([^/]+/){6}[^/]+\\.[a-z]+)$", "$wmts_path")])
+
+    try_files = " ".join("/%s/$wmts_tile" % r.relative_to(root).as_posix() if r != root else "/$wmts_tile"
+                         for r in roots)
+
+    lines += [
+        "",
+        "# server context",
+        "",
+        "location %s {" % location,
+        "    error_page 418 = @wmts_upstream;",
+        "    if ($wmts_tile = \"\") {",
+        "        return 418;",
+        "    }",
+        "    root %s;" % root.as_posix(),
+        "    add_header X-Qgis-Cache-Status HIT;",
+        "    try_files %s @wmts_upstream;" % try_files,
+        "}",
+        "",
+        "location @wmts_upstream {",
+        "    proxy_pass %s://%s;" % (u.scheme, u.netloc),
+        "}",
+        "",
+    ]
+    return "\n".join(lines)
@@ -0,0 +1,242 @@
+""" Overview tiles
+
+    Tiles of lower zoom levels are built from the cached tiles of the
+    next finer tile matrix instead of being rendered by QGIS server:
+    children tiles are mosaicked and downsampled with a box filter on
+    premultiplied alpha, by a pool of processes.
+
+    Adjacent tile matrices must have an integer scale ratio, the same
+    top left corner and the same tile size. Building overviews requires
+    the `numpy` and `Pillow` packages and is enabled per layer with the
+    `overviews` policy option, since downsampled tiles may differ from
+    rendered tiles (labels, symbol sizes, scale dependent rendering).
+
+    Copyright: (C) 2019 3Liz
+"""
+import os
+
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from io import BytesIO
+from typing import Callable, Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+from .generation import Generations
+from .helper import CacheHelper
+from .policy import PolicyConfig
+from .seeder import BBox, tile_limits, tile_params
+from .tiers import TieredStorage
+from .tilematrix import TileMatrix, TileMatrixInfos
+
+try:
+    import numpy
+
+    from PIL import Image
+except ImportError:
+    numpy = None
+    Image = None
+
+# Pillow formats of tile formats
+IMAGE_FORMATS = {
+    'image/png': 'PNG',
+    'image/jpeg': 'JPEG',
+}
+
+JPEG_QUALITY = 90
+
+OVERVIEW_WORKERS = os.cpu_count() or 1
+
+# Tolerance on the scale ratio of adjacent tile matrices
+SCALE_TOLERANCE = 0.01
+
+
+class OverviewLevel(NamedTuple):
+    target: TileMatrix
+    source: TileMatrix
+    ratio: int
+
+
+def overview_levels(matrices: Sequence[TileMatrix], from_zoom: str,
+                    to_zoom: Optional[str]=None) -> List[OverviewLevel]:
+    """ Return the levels to build from the source tile matrix down to the target tile matrix
+
+        Raise ValueError if tile matrices are unknown or if adjacent
+        tile matrices are not aligned.
+    """
+    idents = [tm.identifier for tm in matrices]
+    if from_zoom not in idents:
+        raise ValueError("Unknown tile matrix %s" % from_zoom)
+    if to_zoom is not None and to_zoom not in idents:
+        raise ValueError("Unknown tile matrix %s" % to_zoom)
+    start = idents.index(from_zoom)
+    end = idents.index(to_zoom) if to_zoom is not None else 0
+    if end >= start:
+        raise ValueError("Target tile matrix %s is not above %s" % (matrices[end].identifier, from_zoom))
+
+    levels = []
+    for i in range(start, end, -1):
+        source, target = matrices[i], matrices[i - 1]
+        scale = target.scale_denominator / source.scale_denominator
+        ratio = round(scale)
+        if ratio < 2 or abs(scale - ratio) > ratio * SCALE_TOLERANCE:
+            raise ValueError("Scale ratio of tile matrices %s and %s is not an integer: %g" % (
+                             target.identifier, source.identifier, scale))
+        if target.top_left != source.top_left:
+            raise ValueError("Tile matrices %s and %s are not aligned" % (target.identifier, source.identifier))
+        if (target.tile_width, target.tile_height) != (source.tile_width, source.tile_height):
+            raise ValueError("Tile matrices %s and %s have different tile sizes" % (
+                             target.identifier, source.identifier))
+        levels.append(OverviewLevel(target, source, ratio))
+    return levels
+
+
+def build_tile(children: Sequence[Optional[str]], ratio: int, width: int, height: int,
+               fmt: str, background: Tuple[int,int,int]=(255, 255, 255)) -> bytes:
+    """ Return the tile built from its children tiles
+
+        Children are given row by row, missing children are transparent.
+        Opaque formats are composited over the background color.
+    """
+    mosaic = numpy.zeros((ratio * height, ratio * width, 4), dtype=numpy.float32)
+    for i, path in enumerate(children):
+        if path is None:
+            continue
+        with Image.open(path) as im:
+            if im.size != (width, height):
+                raise ValueError("Invalid tile size %dx%d: %s" % (im.size + (path,)))
+            data = numpy.asarray(im.convert('RGBA'), dtype=numpy.float32)
+        r, c = divmod(i, ratio)
+        mosaic[r * height:(r + 1) * height, c * width:(c + 1) * width] = data
+
+    # Average premultiplied colors so that transparent pixels do not bleed
+    alpha = mosaic[..., 3:] / 255
+    mosaic[..., :3] *= alpha
+    blocks = mosaic.reshape(height, ratio, width, ratio, 4).mean(axis=(1, 3))
+    color, alpha = blocks[..., :3], blocks[..., 3:] / 255
+
+    image_format = IMAGE_FORMATS[fmt]
+    if image_format == 'JPEG':
+        pixels = color + numpy.array(background, dtype=numpy.float32) * (1 - alpha)
+    else:
+        color = numpy.divide(color, alpha, out=numpy.zeros_like(color), where=alpha > 0)
+        pixels = numpy.concatenate([color, alpha * 255], axis=2)
+    image = Image.fromarray(numpy.clip(pixels + 0.5, 0, 255).astype(numpy.uint8))
+
+    buf = BytesIO()
+    if image_format == 'JPEG':
+        image.save(buf, image_format, quality=JPEG_QUALITY)
+    else:
+        image.save(buf, image_format, optimize=True)
+    return buf.getvalue()
+
+
+def build_overviews(storage: TieredStorage, cache: CacheHelper, policy: PolicyConfig,
+                    project: str, infos: TileMatrixInfos, layer: str, tilematrixset: str,
+                    from_zoom: str, to_zoom: Optional[str]=None, style: str='',
+                    fmt: str='image/png', bbox: Optional[BBox]=None,
+                    workers: int=OVERVIEW_WORKERS, force: bool=False,
+                    background: Tuple[int,int,int]=(255, 255, 255),
+                    progress: Optional[Callable[[str, Dict[str,int]], None]]=None) -> Dict[str,int]:
+    """ Build the tiles of the tile matrices above the source tile matrix
+
+        Levels are built from the finest to the coarsest so that each
+        level is built from the tiles of the previous one. Existing
+        tiles are rebuilt only if a child tile is newer, unless force
+        is set. Tiles are built only if all their children inside the
+        layer limits are cached: tiles without any cached child are
+        counted as empty, other incomplete tiles as partial.
+
+        Raise ValueError if overviews cannot be built for the layer.
+    """
+    if numpy is None or Image is None:
+        raise ValueError("Building overviews requires the numpy and Pillow packages")
+    if fmt not in IMAGE_FORMATS:
+        raise ValueError("Unsupported tile format %s" % fmt)
+    layer_policy = policy.resolve(project, layer)
+    if not layer_policy.cache or not layer_policy.overviews:
+        raise ValueError("Overviews are not enabled for layer %s" % layer)
+    tms = infos.tilematrixsets.get(tilematrixset)
+    if tms is None:
+        raise ValueError("Unknown tile matrix set %s" % tilematrixset)
+    levels = overview_levels(list(tms.matrices.values()), from_zoom, to_zoom)
+    for level in levels:
+        if not layer_policy.accept_zoom(level.target.identifier):
+            raise ValueError("Tile matrix %s is not cached for layer %s" % (level.target.identifier, layer))
+
+    # Do not retire built tiles on the next lookup
+    try:
+        generation = os.stat(project).st_mtime_ns // 1000000
+    except OSError:
+        pass
+    else:
+        if not Generations(cache, storage).validate(project, generation):
+            raise ValueError("Project %s is older than its cached tiles" % project)
+
+    layer_limits = infos.limits.get(layer, {}).get(tilematrixset, {})
+    stats = {'built': 0, 'skipped': 0, 'empty': 0, 'partial': 0}
+
+    def tile_path(tm: TileMatrix, row: int, col: int, create_dir: bool=False):
+        params = tile_params(layer, style, tilematrixset, tm.identifier, row, col, fmt)
+        return cache.get_tile_cache(project, params, create_dir=create_dir,
+                                    layout=layer_policy.layout, project_id=layer_policy.project_id)
+
+    def children(level: OverviewLevel, row: int, col: int) -> Tuple[List[Optional[str]], float, int]:
+        """ Return the children paths, their last modification time
+            and the number of missing children inside the layer limits
+        """
+        paths, mtime, missing = [], 0.0, 0
+        source = level.source
+        # Tiles outside the layer limits are empty and never cached
+        limits = tile_limits(tms, source, None, layer_limits.get(source.identifier))
+        for r in range(row * level.ratio, (row + 1) * level.ratio):
+            for c in range(col * level.ratio, (col + 1) * level.ratio):
+                found = None
+                if limits is not None and limits[0] <= r <= limits[1] and limits[2] <= c <= limits[3]:
+                    _, found, st = storage.find(tile_path(source, r, c))
+                    if found is None:
+                        missing += 1
+                if found is not None:
+                    mtime = max(mtime, st.st_mtime)
+                paths.append(found.as_posix() if found is not None else None)
+        return paths, mtime, missing
+
+    def write(fut, path) -> None:
+        storage.write(path, fut.result(), dedup=layer_policy.dedup)
+        stats['built'] += 1
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for level in levels:
+            target = level.target
+            limits = tile_limits(tms, target, bbox, layer_limits.get(target.identifier))
+            if limits is None:
+                continue
+            minrow, maxrow, mincol, maxcol = limits
+            pending = {}
+            for row in range(minrow, maxrow + 1):
+                for col in range(mincol, maxcol + 1):
+                    paths, mtime, missing = children(level, row, col)
+                    if not any(paths):
+                        stats['empty'] += 1
+                        continue
+                    if missing:
+                        # Missing children would be blank in the built tile
+                        stats['partial'] += 1
+                        continue
+                    path = tile_path(target, row, col, create_dir=True)
+                    if not force:
+                        _, _, st = storage.find(path)
+                        if st is not None and st.st_mtime >= mtime:
+                            stats['skipped'] += 1
+                            continue
+                    fut = pool.submit(build_tile, paths, level.ratio, target.tile_width,
+                                      target.tile_height, fmt, background)
+                    pending[fut] = path
+                    # Bound the number of pending tiles
+                    if len(pending) >= workers * 4:
+                        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                        for fut in done:
+                            write(fut, pending.pop(fut))
+            # The next level is built from the tiles of this level
+            for fut in wait(pending).done:
+                write(fut, pending[fut])
+            if progress:
+                progress(target.identifier, dict(stats))
+    return stats
@@ -0,0 +1,237 @@
+""" Cache policy configuration
+
+    Per-project and per-layer cache policies read from a json or toml file
+
+    Copyright: (C) 2019 3Liz
+"""
+import fnmatch
+import json
+import re
+
+from pathlib import Path
+from typing import Any, Dict, List, NamedTuple, Optional, Pattern, Tuple
+
+from .layouts import layouts
+
+STORAGES = ('disk',)
+
+# Cached tile states
+FRESH = 'fresh'
+STALE = 'stale'
+EXPIRED = 'expired'
+
+
+class CachePolicy(NamedTuple):
+    """ Resolved cache policy for a project layer
+    """
+    cache: bool = True
+    minzoom: Optional[int] = None
+    maxzoom: Optional[int] = None
+    ttl: Optional[int] = None
+    max_stale: Optional[int] = None
+    render_budget: Optional[float] = None
+    storage: str = 'disk'
+    layout: Optional[str] = None
+    compression: Tuple[Tuple[str,int],...] = ()
+    dedup: bool = False
+    empty_tiles: bool = True
+    overviews: bool = False
+    project_id: Optional[str] = None
+    cache_control: Optional[str] = None
+
+    def accept_zoom(self, z: str) -> bool:
+        """ Check that the tile matrix is in the cacheable zoom range
+        """
+        if self.minzoom is None and self.maxzoom is None:
+            return True
+        try:
+            z = int(z)
+        except ValueError:
+            # Not a numerical tile matrix identifier
+            return True
+        if self.minzoom is not None and z < self.minzoom:
+            return False
+        if self.maxzoom is not None and z > self.maxzoom:
+            return False
+        return True
+
+    def tile_state(self, age: float) -> str:
+        """ Return the state of a cached tile from its age in seconds
+
+            Tiles are stale during max_stale seconds after
+            their time to live
+        """
+        if self.ttl is None or age <= self.ttl:
+            return FRESH
+        if self.max_stale is not None and age <= self.ttl + self.max_stale:
+            return STALE
+        return EXPIRED
+
+
+DEFAULT_POLICY = CachePolicy()
+
+
+def _parse_int(value: Any, name: str) -> Optional[int]:
+    if value is None:
+        return None
+    if isinstance(value, bool) or not isinstance(value, int) or value < 0:
+        raise ValueError("Invalid value for '%s': %s" % (name, value))
+    return value
+
+
+def _parse_number(value: Any, name: str) -> Optional[float]:
+    if value is None:
+        return None
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or value < 0:
+        raise ValueError("Invalid value for '%s': %s" % (name, value))
+    return float(value)
+
+
+def _parse_options(options: Dict, base: CachePolicy) -> CachePolicy:
+    """ Merge options into base policy
+    """
+    values = {}
+    for key in ('minzoom','maxzoom','ttl','max_stale'):
+        if key in options:
+            values[key] = _parse_int(options[key], key)
+    if 'render_budget' in options:
+        values['render_budget'] = _parse_number(options['render_budget'], 'render_budget')
+    for key in ('cache','dedup','empty_tiles','overviews'):
+        if key in options:
+            values[key] = bool(options[key])
+    if 'storage' in options:
+        if options['storage'] not in STORAGES:
+            raise ValueError("Unknown storage backend %s" % options['storage'])
+        values['storage'] = options['storage']
+    if 'layout' in options:
+        if options['layout'] not in layouts:
+            raise ValueError("Unknown tile layout %s" % options['layout'])
+        values['layout'] = options['layout']
+    for key in ('project_id','cache_control'):
+        if key in options:
+            if not isinstance(options[key], str) or not options[key]:
+                raise ValueError("Invalid value for '%s': %s" % (key, options[key]))
+            values[key] = options[key]
+    if 'compression' in options:
+        compression = options['compression']
+        if not isinstance(compression, dict):
+            raise ValueError("Invalid compression options: %s" % compression)
+        values['compression'] = tuple((k,int(v)) for k,v in compression.items())
+    policy = base._replace(**values)
+    if policy.dedup and (policy.ttl is not None or policy.max_stale is not None):
+        # Deduplicated tiles share the modification time of their payload
+        raise ValueError("'dedup' cannot be combined with 'ttl' or 'max_stale'")
+    return policy
+
+
+def _compile(globs: List[str]) -> List[Pattern]:
+    """ Compile a list of globs
+
+        Globs are compiled separately: translated globs may
+        use named groups that cannot be combined in a single
+        pattern with older Python versions.
+    """
+    return [re.compile(fnmatch.translate(g)) for g in globs]
+
+
+def _first_match(matchers: List[Pattern], name: str) -> Optional[int]:
+    """ Return the index of the first matching glob
+    """
+    for i, matcher in enumerate(matchers):
+        if matcher.match(name):
+            return i
+    return None
+
+
+class ProjectPolicy:
+    """ Policy resolver for a project
+    """
+
+    def __init__(self, default: CachePolicy, layers: List[Tuple[str,CachePolicy]]) -> None:
+        self._default = default
+        self._policies = [p for _,p in layers]
+        self._matchers = _compile([g for g,_ in layers])
+        self._resolved = {}
+
+    @property
+    def default(self) -> CachePolicy:
+        return self._default
+
+    def layer(self, name: str) -> CachePolicy:
+        """ Return the policy for layer
+        """
+        policy = self._resolved.get(name)
+        if policy is None:
+            index = _first_match(self._matchers, name)
+            policy = self._default if index is None else self._policies[index]
+            self._resolved[name] = policy
+        return policy
+
+
+class PolicyConfig:
+    """ Cache policy configuration
+
+        Policies are resolved once per project and layer and
+        are kept in memory.
+    """
+
+    def __init__(self, config: Optional[Dict]=None) -> None:
+        config = config or {}
+
+        self._default = _parse_options(config.get('default',{}), DEFAULT_POLICY)
+
+        projects = []
+        for entry in config.get('projects',[]):
+            if 'match' not in entry:
+                raise ValueError("Missing 'match' in project policy")
+            base = _parse_options(entry, self._default)
+            layers = [(glob, _parse_options(options, base))
+                      for glob,options in entry.get('layers',{}).items()]
+            projects.append((entry['match'], base, layers))
+
+        self._projects = [(base, layers) for _,base,layers in projects]
+        self._matchers = _compile([glob for glob,_,_ in projects])
+        self._resolved = {}
+
+    @property
+    def default(self) -> CachePolicy:
+        return self._default
+
+    def project(self, project: str) -> ProjectPolicy:
+        """ Return the policy resolver for project
+        """
+        policy = self._resolved.get(project)
+        if policy is None:
+            index = _first_match(self._matchers, project)
+            if index is None:
+                policy = ProjectPolicy(self._default, [])
+            else:
+                policy = ProjectPolicy(*self._projects[index])
+            self._resolved[project] = policy
+        return policy
+
+    def resolve(self, project: str, layer: str) -> CachePolicy:
+        """ Return the policy for project layer
+        """
+        return self.project(project).layer(layer)
+
+
+def load_policy(path: Optional[Path]) -> PolicyConfig:
+    """ Load policy from json or toml file
+    """
+    if path is None:
+        return PolicyConfig()
+
+    if path.suffix == '.toml':
+        try:
+            import tomllib as toml_loader
+        except ImportError:
+            try:
+                import toml as toml_loader
+            except ImportError:
+                raise ValueError("No toml module available for reading %s" % path) from None
+        config = toml_loader.loads(path.read_text())
+    else:
+        config = json.loads(path.read_text())
+
+    return PolicyConfig(config)
@@ -0,0 +1,143 @@
+""" Neighbour tiles prefetching
+
+    On tile cache misses, the tiles around the requested tile and
+    its parent and children tiles are rendered in background, since
+    clients request them when panning or zooming.
+
+    Prefetched tiles are rendered by a single worker from a small
+    bounded queue, requests are dropped when the queue is full so that
+    prefetching never delays interactive requests. Prefetched tiles are
+    tracked to measure the ratio of prefetched tiles that are requested
+    afterwards.
+
+    Copyright: (C) 2019 3Liz
+"""
+import threading
+
+from collections import OrderedDict
+from typing import Dict, Iterator, Optional
+
+from .renderer import Renderer
+from .tilematrix import TileMatrix, TileMatrixInfos
+
+PREFETCH_WORKERS = 1
+
+PREFETCH_QUEUE = 64
+
+# Number of tracked prefetched tiles
+PREFETCH_TRACKED = 10000
+
+# Tolerance on the scale ratio of adjacent tile matrices
+SCALE_TOLERANCE = 0.01
+
+
+def _quad_level(tm: TileMatrix, other: TileMatrix) -> bool:
+    """ Check that the other tile matrix has twice the resolution of tm
+    """
+    ratio = tm.scale_denominator / other.scale_denominator
+    return abs(ratio - 2) < 2 * SCALE_TOLERANCE and tm.top_left == other.top_left
+
+
+def neighbour_tiles(params: Dict[str,str], infos: Optional[TileMatrixInfos]=None,
+                    ring: int=1) -> Iterator[Dict[str,str]]:
+    """ Return the tiles around the tile and its parent and children tiles
+
+        Parent and children tiles require the tile matrix infos and
+        are returned only if adjacent tile matrices have a scale ratio
+        of 2. Tiles are clipped to the tile matrix and the layer limits.
+    """
+    try:
+        row, col = int(params['TILEROW']), int(params['TILECOL'])
+    except (KeyError, ValueError):
+        return
+    layer = params.get('LAYER','')
+    tms_id, tm_id = params.get('TILEMATRIXSET',''), params.get('TILEMATRIX','')
+
+    def tile(ident, r, c):
+        return dict(params, TILEMATRIX=ident, TILEROW=str(r), TILECOL=str(c))
+
+    tms = infos.tilematrixsets.get(tms_id) if infos else None
+    tm = tms.matrices.get(tm_id) if tms else None
+    if tm is None:
+        # Tile matrix is unknown
+        for r in range(max(0, row - ring), row + ring + 1):
+            for c in range(max(0, col - ring), col + ring + 1):
+                if (r, c) != (row, col):
+                    yield tile(tm_id, r, c)
+        return
+
+    candidates = [(tm, r, c) for r in range(row - ring, row + ring + 1)
+                  for c in range(col - ring, col + ring + 1) if (r, c) != (row, col)]
+    matrices = list(tms.matrices.values())
+    index = matrices.index(tm)
+    if index > 0 and _quad_level(matrices[index - 1], tm):
+        candidates.append((matrices[index - 1], row // 2, col // 2))
+    if index + 1 < len(matrices) and _quad_level(tm, matrices[index + 1]):
+        candidates.extend((matrices[index + 1], 2 * row + dr, 2 * col + dc)
+                          for dr in (0, 1) for dc in (0, 1))
+
+    for matrix, r, c in candidates:
+        if not (0 <= r < matrix.matrix_height and 0 <= c < matrix.matrix_width):
+            continue
+        if infos.outside(layer, tms_id, matrix.identifier, r, c):
+            continue
+        yield tile(matrix.identifier, r, c)
+
+
+class Prefetcher:
+    """ Render neighbour tiles in background and measure prefetch hits
+    """
+
+    def __init__(self, url: str, token: str, maxsize: int=PREFETCH_QUEUE,
+                 tracked: int=PREFETCH_TRACKED) -> None:
+        self.renderer = Renderer(url, token, maxsize=maxsize, workers=PREFETCH_WORKERS, name='prefetch')
+        self.tracked = tracked
+        self.stats = {'misses': 0, 'submitted': 0, 'hits': 0}
+        self._prefetched = OrderedDict()
+        self._lock = threading.Lock()
+
+    def miss(self) -> None:
+        """ Count a cache miss triggering prefetching
+        """
+        with self._lock:
+            self.stats['misses'] += 1
+
+    def submit(self, project: str, params: Dict[str,str]) -> bool:
+        """ Queue tile for prefetching
+        """
+        if not self.renderer.submit(project, params):
+            return False
+        query = self.renderer.query(project, params)
+        with self._lock:
+            self.stats['submitted'] += 1
+            self._prefetched[query] = None
+            self._prefetched.move_to_end(query)
+            while len(self._prefetched) > self.tracked:
+                self._prefetched.popitem(last=False)
+        return True
+
+    def hit(self, project: str, params: Dict[str,str]) -> None:
+        """ Record a cache hit, count it if the tile has been prefetched
+        """
+        query = self.renderer.query(project, params)
+        with self._lock:
+            if query in self._prefetched:
+                del self._prefetched[query]
+                self.stats['hits'] += 1
+
+    def metrics(self) -> Dict:
+        """ Return prefetching statistics
+
+            The hit rate is the ratio of rendered prefetched
+            tiles that have been requested afterwards.
+        """
+        with self._lock:
+            stats = dict(self.stats)
+        rendered = self.renderer.stats['rendered']
+        stats.update(
+            dropped=self.renderer.stats['dropped'],
+            rendered=rendered,
+            errors=self.renderer.stats['errors'],
+            hit_rate=round(stats['hits'] / rendered, 3) if rendered else None,
+        )
+        return stats
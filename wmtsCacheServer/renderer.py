@@ -0,0 +1,195 @@
+""" Background tile rendering
+
+    Stale tiles are rendered again by requesting them from the QGIS
+    server with a refresh header: the cache filter then ignores the
+    cached tile and stores the rendered one.
+
+    The refresh header value is a token shared through the cache root
+    directory, so that clients cannot force renders.
+
+    Copyright: (C) 2019 3Liz
+"""
+import hmac
+import os
+import queue
+import secrets
+import threading
+import time
+import urllib.request
+
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+from urllib.parse import urlencode
+
+from .cachekeys import canonical_params
+
+REFRESH_HEADER = 'X-Wmts-Cache-Refresh'
+
+# File storing the refresh token in the cache root directory
+REFRESH_TOKEN_FILE = '.refresh_token'
+
+REFRESH_WORKERS = 2
+
+# Smoothing factor of render times
+EWMA_ALPHA = 0.3
+
+# Delay in seconds before rendering a degraded layer again
+PROBE_DELAY = 30
+
+
+def refresh_token(rootdir: Path) -> str:
+    """ Return the refresh token of the cache, create it if needed
+    """
+    path = rootdir / REFRESH_TOKEN_FILE
+    if not path.exists():
+        # Token is never replaced once created
+        tmp = path.with_name('%s.%d.%d' % (path.name, os.getpid(), threading.get_ident()))
+        fd = os.open(tmp.as_posix(), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            f.write(secrets.token_hex(16))
+        try:
+            os.link(tmp.as_posix(), path.as_posix())
+        except FileExistsError:
+            pass
+        finally:
+            tmp.unlink()
+    return path.read_text().strip()
+
+
+def read_refresh_token(rootdir: Path) -> Optional[str]:
+    """ Return the refresh token of the cache if it exists
+    """
+    try:
+        return (rootdir / REFRESH_TOKEN_FILE).read_text().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def is_refresh(token: Optional[str], value: Optional[str]) -> bool:
+    """ Check the refresh header value
+    """
+    return bool(token and value) and hmac.compare_digest(token, value)
+
+
+def render_tile(url: str, token: str, query: str, timeout: float) -> None:
+    """ Request the tile from QGIS server with the refresh header
+    """
+    sep = '&' if '?' in url else '?'
+    req = urllib.request.Request(url + sep + query, headers={REFRESH_HEADER: token})
+    with urllib.request.urlopen(req, timeout=timeout) as resp:
+        resp.read()
+
+
+class Renderer:
+    """ Render tiles in background
+
+        Tile requests are queued in a bounded queue, requests are
+        dropped when the queue is full.
+    """
+
+    def __init__(self, url: str, token: str, maxsize: int=256, timeout: int=60,
+                 workers: int=REFRESH_WORKERS, name: str='render') -> None:
+        self.url = url
+        self.token = token
+        self.timeout = timeout
+        self.stats = {'queued': 0, 'dropped': 0, 'rendered': 0, 'errors': 0}
+        self.last_error = None
+        self._queue = queue.Queue(maxsize)
+        self._pending = set()
+        self._lock = threading.Lock()
+        for i in range(workers):
+            t = threading.Thread(target=self._run, daemon=True, name="wmtscache-%s-%d" % (name, i))
+            t.start()
+
+    def query(self, project: str, params: Dict[str,str]) -> str:
+        """ Return the query string for rendering the tile
+        """
+        params = canonical_params(params)
+        params['MAP'] = project
+        return urlencode(params)
+
+    def submit(self, project: str, params: Dict[str,str]) -> bool:
+        """ Queue tile for rendering
+
+            Return False if the tile is already queued or
+            if the queue is full
+        """
+        query = self.query(project, params)
+        with self._lock:
+            if query in self._pending:
+                return False
+            try:
+                self._queue.put_nowait(query)
+            except queue.Full:
+                self.stats['dropped'] += 1
+                return False
+            self._pending.add(query)
+            self.stats['queued'] += 1
+        return True
+
+    def render(self, query: str) -> None:
+        """ Request the tile from QGIS server
+        """
+        render_tile(self.url, self.token, query, self.timeout)
+
+    def _run(self) -> None:
+        while True:
+            query = self._queue.get()
+            try:
+                self.render(query)
+                self.stats['rendered'] += 1
+            except Exception as e:
+                self.stats['errors'] += 1
+                self.last_error = str(e)
+            finally:
+                with self._lock:
+                    self._pending.discard(query)
+
+
+class RenderHealth:
+    """ Track render times and failures by layer
+
+        A layer is degraded when its smoothed render time exceeds
+        its render budget or when its last render failed. Degraded
+        layers are rendered again once every probe delay.
+    """
+
+    def __init__(self, probe_delay: float=PROBE_DELAY) -> None:
+        self.probe_delay = probe_delay
+        self._layers: Dict[Tuple[str,str], Tuple[Optional[float], bool, float]] = {}
+        self._lock = threading.Lock()
+
+    def record(self, key: Tuple[str,str], duration: Optional[float]) -> None:
+        """ Record render time in seconds, None for failed renders
+        """
+        with self._lock:
+            ewma, _, _ = self._layers.get(key, (None, False, 0.))
+            if duration is None:
+                self._layers[key] = (ewma, True, time.monotonic())
+                return
+            if ewma is not None:
+                duration = EWMA_ALPHA * duration + (1 - EWMA_ALPHA) * ewma
+            self._layers[key] = (duration, False, time.monotonic())
+
+    def render_time(self, key: Tuple[str,str]) -> Optional[float]:
+        """ Return the smoothed render time of the layer
+        """
+        with self._lock:
+            return self._layers.get(key, (None,))[0]
+
+    def degraded(self, key: Tuple[str,str], budget: float) -> bool:
+        """ Check if the layer must not be rendered
+        """
+        with self._lock:
+            state = self._layers.get(key)
+            if state is None:
+                return False
+            ewma, failed, checked = state
+            if not failed and (ewma is None or ewma <= budget):
+                return False
+            now = time.monotonic()
+            if now - checked >= self.probe_delay:
+                # Let this request probe the layer
+                self._layers[key] = (ewma, failed, now)
+                return False
+            return True
@@ -0,0 +1,288 @@
+""" Tile seeding
+
+    Tiles of a layer are rendered in advance for a range of zoom levels
+    and an optional bounding box. Tiles are requested from QGIS server
+    with the refresh header, as for background rendering, by a bounded
+    number of concurrent requests so that seeding never takes all
+    the server workers.
+
+    Zoom levels are the numerical tile matrix identifiers, or the index
+    of the tile matrix in the tile matrix set for other identifiers.
+
+    Copyright: (C) 2019 3Liz
+"""
+import math
+import threading
+import time
+import urllib.request
+
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+)
+from urllib.parse import urlencode
+
+from .helper import CacheHelper
+from .jobs import Job
+from .policy import FRESH, PolicyConfig
+from .renderer import render_tile
+from .tiers import TieredStorage
+from .tilematrix import Limits, TileMatrix, TileMatrixInfos, TileMatrixSet
+from .tileserver import FORMATS
+
+# Default maximum number of concurrent renders of a seeding job
+SEED_CONCURRENCY = 2
+
+BBox = Tuple[float,float,float,float]
+
+
+def seed_params(body: Any) -> Dict:
+    """ Validate seeding parameters
+
+        Raise ValueError for invalid parameters
+    """
+    if not isinstance(body, dict) or not body.get('tilematrixset'):
+        raise ValueError("Missing tile matrix set")
+    params = {
+        'tilematrixset': str(body['tilematrixset']),
+        'style': str(body.get('style') or ''),
+        'format': str(body.get('format') or 'image/png'),
+        'force': bool(body.get('force', False)),
+    }
+    if params['format'] not in FORMATS.values():
+        raise ValueError("Invalid tile format %s" % params['format'])
+    for key in ('minzoom', 'maxzoom', 'concurrency'):
+        value = body.get(key)
+        if value is not None and (isinstance(value, bool) or not isinstance(value, int) or value < 0):
+            raise ValueError("Invalid %s value: %s" % (key, value))
+        params[key] = value
+    if params['minzoom'] is not None and params['maxzoom'] is not None \
+            and params['minzoom'] > params['maxzoom']:
+        raise ValueError("Invalid zoom range")
+    if params['concurrency'] == 0:
+        raise ValueError("Invalid concurrency value: 0")
+    bbox = body.get('bbox')
+    if bbox is not None:
+        try:
+            bbox = [float(v) for v in bbox]
+        except (TypeError, ValueError):
+            raise ValueError("Invalid bbox") from None
+        if len(bbox) != 4 or bbox[0] >= bbox[2] or bbox[1] >= bbox[3]:
+            raise ValueError("Invalid bbox")
+    params['bbox'] = bbox
+    return params
+
+
+def tile_limits(tms: TileMatrixSet, tm: TileMatrix, bbox: Optional[BBox]=None,
+                limits: Optional[Limits]=None) -> Optional[Limits]:
+    """ Return the tiles of the tile matrix intersecting the bbox
+
+        The bbox is expressed as (minx, miny, maxx, maxy) in the tile
+        matrix set crs. Return None if no tile intersects.
+    """
+    minrow, maxrow, mincol, maxcol = 0, tm.matrix_height - 1, 0, tm.matrix_width - 1
+    if bbox is not None:
+        res = tm.resolution(tms.meters_per_unit())
+        x0, y0 = tms.top_left(tm)
+        width, height = tm.tile_width * res, tm.tile_height * res
+        minx, miny, maxx, maxy = bbox
+        mincol = max(mincol, math.floor((minx - x0) / width))
+        maxcol = min(maxcol, math.ceil((maxx - x0) / width) - 1)
+        minrow = max(minrow, math.floor((y0 - maxy) / height))
+        maxrow = min(maxrow, math.ceil((y0 - miny) / height) - 1)
+    if limits is not None:
+        minrow, maxrow = max(minrow, limits[0]), min(maxrow, limits[1])
+        mincol, maxcol = max(mincol, limits[2]), min(maxcol, limits[3])
+    if minrow > maxrow or mincol > maxcol:
+        return None
+    return minrow, maxrow, mincol, maxcol
+
+
+def seed_ranges(infos: TileMatrixInfos, layer: str, tilematrixset: str,
+                minzoom: Optional[int]=None, maxzoom: Optional[int]=None,
+                bbox: Optional[BBox]=None) -> List[Tuple[str, Limits]]:
+    """ Return the tile ranges to seed by tile matrix
+    """
+    tms = infos.tilematrixsets.get(tilematrixset)
+    if tms is None:
+        raise ValueError("Unknown tile matrix set %s" % tilematrixset)
+    layer_limits = infos.limits.get(layer, {}).get(tilematrixset, {})
+    ranges = []
+    for index, tm in enumerate(tms.matrices.values()):
+        z = int(tm.identifier) if tm.identifier.isdigit() else index
+        if (minzoom is not None and z < minzoom) or (maxzoom is not None and z > maxzoom):
+            continue
+        limits = tile_limits(tms, tm, bbox, layer_limits.get(tm.identifier))
+        if limits is not None:
+            ranges.append((tm.identifier, limits))
+    return ranges
+
+
+def count_tiles(ranges: Sequence[Tuple[str, Limits]]) -> int:
+    return sum((maxrow - minrow + 1) * (maxcol - mincol + 1)
+               for _, (minrow, maxrow, mincol, maxcol) in ranges)
+
+
+def iter_tiles(ranges: Sequence[Tuple[str, Limits]]) -> Iterator[Tuple[str, int, int]]:
+    """ Return tiles as (tilematrix, tilerow, tilecol)
+    """
+    for ident, (minrow, maxrow, mincol, maxcol) in ranges:
+        for row in range(minrow, maxrow + 1):
+            for col in range(mincol, maxcol + 1):
+                yield ident, row, col
+
+
+class Seeder:
+    """ Render tiles through QGIS server
+    """
+
+    def __init__(self, url: str, token: str, concurrency: int=SEED_CONCURRENCY,
+                 timeout: int=60) -> None:
+        self.url = url
+        self.token = token
+        self.concurrency = concurrency
+        self.timeout = timeout
+
+    def tilematrix_infos(self, cache: CacheHelper, project: str) -> TileMatrixInfos:
+        """ Return the tile matrix infos of the project
+
+            Infos are requested from QGIS server if they are not
+            found in the cache.
+        """
+        path = cache.get_tilematrix_path(project)
+        if path.exists():
+            return TileMatrixInfos.load(path)
+        sep = '&' if '?' in self.url else '?'
+        query = urlencode({'MAP': project, 'SERVICE': 'WMTS', 'REQUEST': 'GetCapabilities'})
+        with urllib.request.urlopen(self.url + sep + query, timeout=self.timeout) as resp:
+            return TileMatrixInfos.from_capabilities(resp.read(), 0)
+
+    def render(self, project: str, params: Dict[str,str]) -> None:
+        """ Render the tile
+        """
+        render_tile(self.url, self.token, urlencode(dict(params, MAP=project)), self.timeout)
+
+
+def tile_params(layer: str, style: str, tilematrixset: str, tilematrix: str,
+                row: int, col: int, fmt: str) -> Dict[str,str]:
+    """ Return the WMTS GetTile parameters of a tile
+    """
+    return {
+        'SERVICE': 'WMTS',
+        'REQUEST': 'GetTile',
+        'LAYER': layer,
+        'STYLE': style,
+        'TILEMATRIXSET': tilematrixset,
+        'TILEMATRIX': tilematrix,
+        'TILEROW': str(row),
+        'TILECOL': str(col),
+        'FORMAT': fmt,
+    }
+
+
+def render_tiles(seeder: Seeder, storage: TieredStorage, cache: CacheHelper, policy: PolicyConfig,
+                 tiles: Iterable[Tuple[str, Dict[str,str]]], concurrency: Optional[int]=None,
+                 force: bool=False, progress: Optional[Callable[[int, Dict], None]]=None,
+                 cancelled: Optional[Callable[[], bool]]=None) -> Dict:
+    """ Render (project, params) tiles with bounded concurrency
+
+        Fresh cached tiles and tiles not cacheable by the policy
+        are skipped, fresh tiles are rendered again if force is set.
+    """
+    concurrency = min(concurrency or seeder.concurrency, seeder.concurrency)
+    stats = {'rendered': 0, 'skipped': 0, 'errors': 0, 'last_error': None}
+    lock = threading.Lock()
+    pending = threading.BoundedSemaphore(concurrency * 2)
+
+    def render(project, params):
+        error = None
+        try:
+            seeder.render(project, params)
+        except Exception as e:
+            error = str(e)
+        with lock:
+            if error is None:
+                stats['rendered'] += 1
+            else:
+                stats['errors'] += 1
+                stats['last_error'] = error
+
+    def done(_):
+        pending.release()
+
+    def skip(project, params):
+        layer_policy = policy.resolve(project, params['LAYER'])
+        if not layer_policy.cache or not layer_policy.accept_zoom(params['TILEMATRIX']):
+            return True
+        if force:
+            return False
+        p = cache.get_tile_cache(project, params, layout=layer_policy.layout,
+                                 project_id=layer_policy.project_id)
+        _, found, st = storage.find(p)
+        return found is not None and layer_policy.tile_state(time.time() - st.st_mtime) == FRESH
+
+    count = 0
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='wmtscache-seed') as pool:
+        for project, params in tiles:
+            if cancelled and cancelled():
+                break
+            count += 1
+            if skip(project, params):
+                with lock:
+                    stats['skipped'] += 1
+            else:
+                pending.acquire()
+                pool.submit(render, project, params).add_done_callback(done)
+            if progress:
+                with lock:
+                    snapshot = dict(stats)
+                progress(count, snapshot)
+    if progress:
+        progress(count, dict(stats))
+    return stats
+
+
+def seed_tiles(seeder: Seeder, storage: TieredStorage, policy: PolicyConfig, rootdir: Path,
+               job: Job, params: Dict) -> None:
+    """ Job seeding layer tiles
+
+        Fresh cached tiles are skipped unless the 'force' parameter is set,
+        so that interrupted jobs resume where they stopped.
+    """
+    project, layer = params['project'], params['layer']
+    layer_policy = policy.resolve(project, layer)
+    if not layer_policy.cache:
+        raise ValueError("Layer %s is not cached" % layer)
+
+    cache = CacheHelper(rootdir, params['layout'], storage.shards)
+    infos = seeder.tilematrix_infos(cache, project)
+    ranges = [r for r in seed_ranges(infos, layer, params['tilematrixset'], params.get('minzoom'),
+                                     params.get('maxzoom'), params.get('bbox'))
+              if layer_policy.accept_zoom(r[0])]
+    total = count_tiles(ranges)
+
+    def tiles():
+        for tilematrix, row, col in iter_tiles(ranges):
+            yield project, tile_params(layer, params['style'], params['tilematrixset'],
+                                       tilematrix, row, col, params['format'])
+
+    def progress(count, stats):
+        job.record.update(stats)
+        job.progress(count, total)
+
+    job.progress(0, total)
+    stats = render_tiles(seeder, storage, cache, policy, tiles(), concurrency=params.get('concurrency'),
+                         force=params.get('force', False), progress=progress, cancelled=job.cancelled)
+    if stats['errors']:
+        if not stats['rendered']:
+            raise RuntimeError("All renders failed: %s" % stats['last_error'])
+        job.record['error'] = "%d renders failed: %s" % (stats['errors'], stats['last_error'])
@@ -0,0 +1,145 @@
+""" Shard tiles over multiple cache roots
+
+    Tile directories are assigned to a shard with rendezvous hashing
+    on the tile digest, so that adding a shard only moves the digests
+    assigned to the new shard.
+
+    Copyright: (C) 2019 3Liz
+"""
+import re
+import shutil
+
+from hashlib import md5
+from pathlib import Path
+from typing import Iterator, List, Optional, Sequence, Tuple
+
+# Directory names that cannot be used as readable project ids
+RESERVED_NAMES = ('blobs',)
+
+_HASH_RE = re.compile('^[0-9a-f]{32}$')
+
+
+def is_project_hash(name: str) -> bool:
+    """ Check if name is a project hash directory name
+    """
+    return _HASH_RE.match(name) is not None
+
+
+def tile_key(rel: Path) -> str:
+    """ Return the shard key of a tile path relative to its shard
+
+        Tile paths are '<project>/tiles/<layer>/<digest>/...' or
+        '<project_id>/<layer>/<tilematrixset>/<style>/...' with
+        the readable layout
+    """
+    if rel.parts[1] == 'tiles':
+        return rel.parts[3]
+    return '/'.join(rel.parts[:4])
+
+
+def parse_shards(spec: Optional[str]) -> List[Path]:
+    """ Parse shards specification as a comma separated list of paths
+    """
+    if not spec:
+        return []
+    return [Path(p.strip()) for p in spec.split(',') if p.strip()]
+
+
+def shard_for(shards: Sequence[Path], key: str) -> Path:
+    """ Return the shard assigned to key
+    """
+    if len(shards) == 1:
+        return shards[0]
+    return max(shards, key=lambda s: md5((s.as_posix() + key).encode()).digest())
+
+
+def tile_dirs(root: Path) -> Iterator[Path]:
+    """ Return all tile directories in a storage root
+
+        Tile directories are '<project>/tiles' directories
+        and readable project directories
+    """
+    if not root.is_dir():
+        return
+    for d in root.iterdir():
+        if not d.is_dir() or d.name.startswith('.') or d.name in RESERVED_NAMES:
+            continue
+        if is_project_hash(d.name):
+            if (d / 'tiles').is_dir():
+                yield d / 'tiles'
+        else:
+            yield d
+
+
+def digest_dirs(shard: Path) -> Iterator[Tuple[Path, str]]:
+    """ Return all digest directories and their shard key in shard
+
+        Digest directories are located at '<project>/tiles/<layer>/<digest>'
+        or at '<project_id>/<layer>/<tilematrixset>/<style>' with the
+        readable layout
+    """
+    for tiledir in tile_dirs(shard):
+        if tiledir.name == 'tiles' and is_project_hash(tiledir.parent.name):
+            for layer in tiledir.iterdir():
+                if not layer.is_dir():
+                    continue
+                for d in layer.iterdir():
+                    if d.is_dir():
+                        yield d, d.name
+        else:
+            for d in tiledir.glob('*/*/*'):
+                if d.is_dir():
+                    yield d, tile_key(d.relative_to(shard))
+
+
+def _merge_tree(src: Path, dst: Path) -> int:
+    """ Move files from src into dst - existing files in dst are kept
+
+        Return the number of moved files
+    """
+    moved = 0
+    for p in list(src.glob('**/*')):
+        if p.is_dir():
+            continue
+        target = dst / p.relative_to(src)
+        if not target.exists():
+            target.parent.mkdir(mode=0o750, parents=True, exist_ok=True)
+            shutil.move(p.as_posix(), target.as_posix())
+            moved += 1
+    shutil.rmtree(src.as_posix())
+    return moved
+
+
+def rebalance(shards: Sequence[Path], sources: Sequence[Path]=(),
+              dry_run: bool=False) -> Iterator[Tuple[Path, Path, int]]:
+    """ Move misplaced digest directories to their assigned shard
+
+        Directories are looked up in shards and in extra sources
+        (i.e the cache root when switching to shards).
+
+        Yield (source, destination, number of moved files) for
+        each misplaced directory.
+    """
+    for shard in list(shards) + [s for s in sources if s not in shards]:
+        if not shard.is_dir():
+            continue
+        for d, key in list(digest_dirs(shard)):
+            target = shard_for(shards, key)
+            if target == shard:
+                continue
+            dst = target / d.relative_to(shard)
+            if dry_run:
+                yield d, dst, 0
+                continue
+            if not dst.exists():
+                dst.parent.mkdir(mode=0o750, parents=True, exist_ok=True)
+                count = sum(1 for p in d.glob('**/*') if not p.is_dir())
+                shutil.move(d.as_posix(), dst.as_posix())
+            else:
+                count = _merge_tree(d, dst)
+            # Remove empty layer directory
+            try:
+                d.parent.rmdir()
+            except OSError:
+                pass
+            yield d, dst, count
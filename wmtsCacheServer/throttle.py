@@ -0,0 +1,128 @@
+""" Purge throttling
+
+    Removing large tile directories saturates the disk and delays tile
+    reads. Purges are paced to a number of files or bytes per second;
+    in adaptive mode, the pace is halved when the latency of tile
+    lookups rises above its baseline and is restored progressively
+    when it goes back down.
+
+    Copyright: (C) 2019 3Liz
+"""
+import threading
+import time
+
+from typing import Optional
+
+from .tiers import parse_size
+
+# Default maximum rate in files per second of adaptive throttles
+ADAPTIVE_RATE = 1000
+
+# Minimum rate in files per second of adaptive throttles
+MIN_RATE = 10
+
+# Delay in seconds between rate adjustments
+ADJUST_INTERVAL = 1
+
+# Lookup latency relative to the baseline above which the rate is reduced
+LATENCY_FACTOR = 2
+
+# Smoothing factor of lookup latencies
+EWMA_ALPHA = 0.1
+
+
+class PurgeThrottle:
+    """ Pace file removals
+
+        The throttle is shared by all purges of the process
+    """
+
+    def __init__(self, files: Optional[float]=None, size: Optional[int]=None,
+                 adaptive: bool=False) -> None:
+        if adaptive and not files:
+            files = ADAPTIVE_RATE
+        self.max_rate = files
+        self.rate = files
+        self.size = size
+        self.adaptive = adaptive
+        self._next = 0.
+        self._latency = None
+        self._baseline = None
+        self._adjusted = time.monotonic()
+        self._lock = threading.Lock()
+
+    def __str__(self) -> str:
+        if self.adaptive:
+            return "auto:%d files/s" % self.max_rate
+        if self.size:
+            return "%d bytes/s" % self.size
+        return "%d files/s" % self.rate
+
+    def observe(self, latency: float) -> None:
+        """ Record the latency in seconds of a tile lookup
+        """
+        if not self.adaptive:
+            return
+        with self._lock:
+            if self._latency is None:
+                self._latency = latency
+            else:
+                self._latency += EWMA_ALPHA * (latency - self._latency)
+
+    def adjust(self) -> None:
+        """ Adjust the rate from the observed lookup latency
+        """
+        latency = self._latency
+        if latency is None:
+            return
+        if self._baseline is None or latency < self._baseline:
+            self._baseline = latency
+        else:
+            # Let the baseline follow lasting changes
+            self._baseline += EWMA_ALPHA * EWMA_ALPHA * (latency - self._baseline)
+        if latency > self._baseline * LATENCY_FACTOR:
+            self.rate = max(MIN_RATE, self.rate / 2)
+        else:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 10)
+
+    def wait(self, files: int=1, size: int=0) -> None:
+        """ Wait before removing more files
+        """
+        with self._lock:
+            now = time.monotonic()
+            if self.adaptive and now - self._adjusted >= ADJUST_INTERVAL:
+                self._adjusted = now
+                self.adjust()
+            delay = 0.
+            if self.rate:
+                delay = files / self.rate
+            if self.size:
+                delay = max(delay, size / self.size)
+            self._next = max(self._next, now) + delay
+            sleep = self._next - now
+        if sleep > 0:
+            time.sleep(sleep)
+
+
+def parse_purge_rate(value: Optional[str]) -> Optional[PurgeThrottle]:
+    """ Parse purge rate
+
+        The rate is a number of files per second (i.e '500'),
+        a size per second (i.e '20M') or 'auto' with an optional
+        maximum number of files per second (i.e 'auto:2000').
+    """
+    value = (value or '').strip().lower()
+    if not value:
+        return None
+    if value.endswith('/s'):
+        value = value[:-2]
+    if value.startswith('auto'):
+        _, _, rate = value.partition(':')
+        throttle = PurgeThrottle(files=float(rate) if rate else None, adaptive=True)
+    elif value[-1].isdigit():
+        throttle = PurgeThrottle(files=float(value))
+    else:
+        throttle = PurgeThrottle(size=parse_size(value))
+    if not (throttle.rate or throttle.size) or (throttle.rate or 0) < 0:
+        raise ValueError("Invalid purge rate: %s" % value)
+    return throttle
@@ -0,0 +1,562 @@
+""" Tiered tile storage
+
+    Tile paths are computed by the cache helper relative to the
+    cache root directory and mapped to each tier root.
+
+    Copyright: (C) 2019 3Liz
+"""
+import fcntl
+import os
+import shutil
+import threading
+import time
+
+from pathlib import Path
+from typing import (
+    TYPE_CHECKING,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+)
+
+from .dedup import collect_blobs, store_blob
+from .helper import atomic_copy, atomic_write
+from .shards import shard_for, tile_dirs, tile_key
+
+if TYPE_CHECKING:
+    from .throttle import PurgeThrottle
+
+SIZE_UNITS = {'K': 1024, 'M': 1024**2, 'G': 1024**3, 'T': 1024**4}
+
+# Demote down to this ratio of the tier size bound
+LOW_WATERMARK = 0.9
+
+# Directory of retired tiles in each storage root
+RETIRED_DIR = '.retired'
+
+
+def parse_size(value: str) -> int:
+    """ Parse size with optional unit (i.e '512M', '2G')
+    """
+    value = value.strip().upper()
+    if value.endswith('B'):
+        value = value[:-1]
+    if value and value[-1] in SIZE_UNITS:
+        return int(float(value[:-1]) * SIZE_UNITS[value[-1]])
+    return int(value)
+
+
+class Tier:
+    """ Storage tier
+
+        The tier size is estimated from the last scan and the bytes
+        written since: demotion is triggered when the estimated
+        size exceeds the bound. The size is unknown until the
+        first write triggers a scan.
+    """
+
+    def __init__(self, root: Path, max_size: Optional[int]=None, write: bool=True) -> None:
+        self.root = root
+        self.max_size = max_size
+        self.write = write
+        self._size = None
+        self._written = 0
+        self._lock = threading.Lock()
+        self._demoting = False
+
+    def __repr__(self) -> str:
+        return "Tier(%s, max_size=%s, write=%s)" % (self.root, self.max_size, self.write)
+
+    def add(self, nbytes: int) -> bool:
+        """ Account written bytes
+
+            Return True if the tier needs demotion
+        """
+        if self.max_size is None:
+            return False
+        with self._lock:
+            self._written += nbytes
+            if self._demoting:
+                return False
+            if self._size is None or self._size + self._written > self.max_size:
+                self._demoting = True
+                return True
+        return False
+
+    def demoted(self, size: int) -> None:
+        """ Update size after demotion
+        """
+        with self._lock:
+            self._size = size
+            self._written = 0
+            self._demoting = False
+
+
+def parse_tiers(spec: Optional[str]) -> List[Tier]:
+    """ Parse tiers specification
+
+        Tiers are defined as a comma separated list of 'path[:max_size][:ro]'
+    """
+    tiers = []
+    if not spec:
+        return tiers
+    for entry in spec.split(','):
+        entry = entry.strip()
+        if not entry:
+            continue
+        path, *opts = entry.split(':')
+        max_size = None
+        write = True
+        for opt in opts:
+            if opt == 'ro':
+                write = False
+            elif opt:
+                max_size = parse_size(opt)
+        tiers.append(Tier(Path(path), max_size=max_size, write=write))
+    return tiers
+
+
+class TieredStorage:
+    """ Ordered storage tiers for tiles
+
+        Reads check tiers in order and promote found tiles in
+        the first writable tier, writes go to all writable tiers.
+
+        The cache root directory is always a tier: it is appended
+        as the last unbounded tier if not configured explicitely.
+
+        When shards are defined, tiles of the cache root tier are
+        stored in the shards and directory operations on paths in
+        the cache root apply to all shards.
+
+        With a grace period, discarded directories are retired and
+        their tiles can still be found until they are purged.
+
+        With a throttle, directories are removed file by file at the
+        throttle rate and discarded directories are removed in
+        background.
+    """
+
+    def __init__(self, rootdir: Path, tiers: List[Tier]=(), shards: Sequence[Path]=(),
+                 grace: int=0, throttle: Optional['PurgeThrottle']=None) -> None:
+        self.rootdir = rootdir
+        self.grace = grace
+        self.throttle = throttle
+        tiers = list(tiers)
+        if not any(t.root == rootdir for t in tiers):
+            tiers.append(Tier(rootdir))
+        self.tiers = tiers
+        self.base = next(t for t in tiers if t.root == rootdir)
+        self.shards = list(shards) or [rootdir]
+        self._purging = threading.Lock()
+
+    def relative(self, path: Path) -> Path:
+        """ Return the path relative to its shard or to the cache root
+        """
+        for base in self.shards + [self.rootdir]:
+            try:
+                return path.relative_to(base)
+            except ValueError:
+                pass
+        raise ValueError("Path %s is not in cache" % path)
+
+    def physical(self, rel: Path) -> Path:
+        """ Return the location of a relative tile path in the cache root tier
+        """
+        if len(self.shards) == 1:
+            return self.shards[0] / rel
+        return shard_for(self.shards, tile_key(rel)) / rel
+
+    def expand(self, path: Path) -> Iterator[Path]:
+        """ Map a path in the cache root to each shard
+        """
+        if self.shards == [self.rootdir]:
+            yield path
+            return
+        rel = self.relative(path)
+        for shard in self.shards:
+            yield shard / rel
+
+    def locations(self, path: Path) -> Iterator[Tuple[Tier, Path]]:
+        """ Map a tile path to each tier
+        """
+        if len(self.tiers) == 1:
+            yield self.tiers[0], path
+            return
+        rel = self.relative(path)
+        for tier in self.tiers:
+            yield tier, (path if tier is self.base else tier.root / rel)
+
+    def all_locations(self, path: Path) -> Iterator[Path]:
+        """ Map a path in the cache root to each tier and shard
+        """
+        for p in self.expand(path):
+            for _, loc in self.locations(p):
+                yield loc
+
+    def find(self, path: Path) -> Tuple[int, Optional[Path], Optional[os.stat_result]]:
+        """ Return the first tier index, the location and the status of the file
+        """
+        start = time.perf_counter()
+        found = -1, None, None
+        for i, (_, p) in enumerate(self.locations(path)):
+            try:
+                st = p.stat()
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+            found = i, p, st
+            break
+        if self.throttle:
+            self.throttle.observe(time.perf_counter() - start)
+        return found
+
+    def root_of(self, tier: Tier, path: Path) -> Path:
+        """ Return the storage root of a location in tier
+        """
+        if tier is self.base:
+            for shard in self.shards:
+                if shard in path.parents:
+                    return shard
+            return self.rootdir
+        return tier.root
+
+    def blob_roots(self) -> List[Path]:
+        """ Return all roots holding deduplicated payloads
+        """
+        return [t.root for t in self.tiers if t is not self.base] + self.shards
+
+    def _write(self, tier: Tier, path: Path, data: bytes, dedup: bool) -> None:
+        path.parent.mkdir(mode=0o750, parents=True, exist_ok=True)
+        if dedup:
+            store_blob(self.root_of(tier, path), path, data)
+        else:
+            atomic_write(path, data)
+        self._account(tier, len(data))
+
+    def promote(self, index: int, path: Path, data: bytes, dedup: bool=False) -> None:
+        """ Copy data found at tier index into the first writable tier
+        """
+        for i, (tier, p) in enumerate(self.locations(path)):
+            if i >= index:
+                break
+            if tier.write:
+                self._write(tier, p, data, dedup)
+                break
+
+    def write(self, path: Path, data: bytes, dedup: bool=False) -> Optional[os.stat_result]:
+        """ Write data to all writable tiers
+
+            If dedup is set, tiles are stored as links to
+            their payload. Return the status of the first written
+            location, None if no tier is writable.
+        """
+        st = None
+        for tier, p in self.locations(path):
+            if tier.write:
+                self._write(tier, p, data, dedup)
+                if st is None:
+                    st = p.stat()
+        return st
+
+    def unlink(self, path: Path) -> bool:
+        """ Remove file from all tiers
+        """
+        removed = False
+        for _, p in self.locations(path):
+            if p.is_file():
+                p.unlink()
+                removed = True
+        return removed
+
+    def rmtree(self, path: Path) -> bool:
+        """ Remove directory from all tiers and shards
+        """
+        removed = False
+        for p in self.all_locations(path):
+            if p.is_dir():
+                self.remove_tree(p)
+                removed = True
+        if removed:
+            self.collect_blobs()
+        return removed
+
+    def remove_tree(self, location: Path) -> None:
+        """ Remove directory at the throttle rate
+        """
+        if self.throttle:
+            for _ in self.iter_remove(location):
+                pass
+        else:
+            shutil.rmtree(location.as_posix(), ignore_errors=True)
+
+    def iter_remove(self, location: Path) -> Iterator[int]:
+        """ Remove directory file by file at the throttle rate
+
+            Yield the number of removed files for each directory
+        """
+        throttle = self.throttle
+        for root, dirs, files in os.walk(location.as_posix(), topdown=False):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    size = os.lstat(path).st_size if throttle and throttle.size else 0
+                    os.unlink(path)
+                except FileNotFoundError:
+                    continue
+                if throttle:
+                    throttle.wait(1, size)
+            for name in dirs:
+                try:
+                    os.rmdir(os.path.join(root, name))
+                except OSError:
+                    # Tiles written during removal
+                    pass
+            yield len(files)
+        try:
+            os.rmdir(location.as_posix())
+        except OSError:
+            pass
+
+    def count_files(self, path: Path) -> int:
+        """ Return the number of files of a directory in all tiers and shards
+        """
+        return sum(len(files) for p in self.all_locations(path) for _, _, files in os.walk(p.as_posix()))
+
+    def iter_rmtree(self, path: Path) -> Iterator[int]:
+        """ Remove directory from all tiers and shards
+
+            Yield the number of removed files for each directory so
+            that callers can report progress or stop the removal.
+            Unreferenced payloads are not collected.
+        """
+        for p in self.all_locations(path):
+            yield from self.iter_remove(p)
+
+    def storage_root(self, location: Path) -> Path:
+        """ Return the tier or shard root of a location
+        """
+        for root in self.shards + [t.root for t in self.tiers]:
+            if root in location.parents:
+                return root
+        return self.rootdir
+
+    def retire(self, path: Path) -> bool:
+        """ Move directory out of the cache in all tiers and shards
+
+            Retired directories are kept during the grace period
+            with their path relative to the storage root, then
+            removed in background.
+        """
+        retired = False
+        name = '%d.%d' % (time.time_ns(), os.getpid())
+        for p in self.all_locations(path):
+            root = self.storage_root(p)
+            dest = root / RETIRED_DIR / name / p.relative_to(root)
+            try:
+                dest.parent.mkdir(mode=0o750, parents=True, exist_ok=True)
+                os.rename(p.as_posix(), dest.as_posix())
+                retired = True
+            except FileNotFoundError:
+                pass
+        if retired:
+            if self.grace:
+                t = threading.Timer(self.grace, self.purge_retired)
+                t.daemon = True
+                t.start()
+            else:
+                threading.Thread(target=self.purge_retired, daemon=True, name="wmtscache-purge").start()
+        return retired
+
+    def discard(self, path: Path) -> bool:
+        """ Remove directory from all tiers and shards
+
+            Tiles are retired if a grace period or a throttle is set
+        """
+        return self.retire(path) if self.grace or self.throttle else self.rmtree(path)
+
+    def _retired(self, root: Path) -> Iterator[Tuple[int, Path]]:
+        """ Return retired directories with their retirement time in ns
+        """
+        retired = root / RETIRED_DIR
+        if not retired.is_dir():
+            return
+        for d in retired.iterdir():
+            try:
+                yield int(d.name.split('.')[0]), d
+            except ValueError:
+                # Not a retired directory
+                continue
+
+    def find_retired(self, path: Path) -> Tuple[Optional[Path], Optional[os.stat_result]]:
+        """ Return the most recently retired location of a file and its status
+        """
+        found = []
+        for _, p in self.locations(path):
+            root = self.storage_root(p)
+            rel = p.relative_to(root)
+            for ns, d in self._retired(root):
+                found.append((ns, d / rel))
+        for _, p in sorted(found, reverse=True):
+            try:
+                return p, p.stat()
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+        return None, None
+
+    def purge_retired(self, grace: Optional[int]=None) -> int:
+        """ Remove retired directories older than the grace period
+
+            Return the number of removed directories
+        """
+        grace = self.grace if grace is None else grace
+        limit = time.time_ns() - grace * 1000000000
+        count = 0
+        # Purges share the throttle rate
+        with self._purging:
+            for root in self.blob_roots():
+                for ns, d in self._retired(root):
+                    if ns <= limit:
+                        self.remove_tree(d)
+                        count += 1
+        if count:
+            self.collect_blobs()
+        return count
+
+    def collect_blobs(self) -> int:
+        """ Remove unreferenced payloads
+        """
+        return sum(collect_blobs(root) for root in self.blob_roots())
+
+    def exists(self, path: Path) -> bool:
+        """ Check if path exists in any tier or shard
+        """
+        return any(p.exists() for p in self.all_locations(path))
+
+    def iterdir(self, path: Path) -> Iterator[Path]:
+        """ Return the union of directory entries in all tiers and shards
+        """
+        seen = set()
+        for p in self.all_locations(path):
+            if not p.is_dir():
+                continue
+            for entry in p.iterdir():
+                if entry.name not in seen and entry.is_dir():
+                    seen.add(entry.name)
+                    yield path / entry.name
+
+    #
+    # Demotion
+    #
+
+    def _account(self, tier: Tier, nbytes: int) -> None:
+        if tier.add(nbytes):
+            self._start_demotion(tier)
+
+    def _start_demotion(self, tier: Tier) -> None:
+        t = threading.Thread(target=self.demote, args=(tier,), daemon=True,
+                             name="wmtscache-demote")
+        t.start()
+
+    def _tile_dirs(self, tier: Tier) -> Iterator[Tuple[Path, Path]]:
+        """ Return tile directories of tier with their root
+        """
+        roots = self.shards if tier is self.base else [tier.root]
+        for root in roots:
+            for d in tile_dirs(root):
+                yield root, d
+
+    def _next_tier(self, tier: Tier) -> Optional[Tier]:
+        index = self.tiers.index(tier)
+        for t in self.tiers[index+1:]:
+            if t.write:
+                return t
+        return None
+
+    def demote(self, tier: Tier) -> int:
+        """ Demote the least recently used tiles to the next tier
+
+            Tiles demoted from the last tier are evicted.
+            Return the size of the tier after demotion.
+        """
+        size = None
+        try:
+            tier.root.mkdir(mode=0o750, parents=True, exist_ok=True)
+            with (tier.root / '.demote.lock').open('w') as lock:
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    # Demotion is running in another process
+                    return 0
+                size = self._demote(tier)
+        finally:
+            tier.demoted(size or 0)
+        return size
+
+    def _demote(self, tier: Tier) -> int:
+        # First pass: compute the size and the access time
+        # histogram of the tier with one minute buckets
+        histogram: Dict[int, int] = {}
+        total = 0
+        for _, tiledir in self._tile_dirs(tier):
+            for dirpath, _, filenames in os.walk(tiledir.as_posix()):
+                for name in filenames:
+                    try:
+                        st = os.stat(os.path.join(dirpath, name))
+                    except FileNotFoundError:
+                        continue
+                    bucket = int(max(st.st_atime, st.st_mtime) // 60)
+                    histogram[bucket] = histogram.get(bucket, 0) + st.st_size
+                    total += st.st_size
+
+        if tier.max_size is None or total <= tier.max_size:
+            return total
+
+        # Find the access time cutoff
+        target = total - int(tier.max_size * LOW_WATERMARK)
+        freed = 0
+        cutoff = None
+        for bucket in sorted(histogram):
+            freed += histogram[bucket]
+            cutoff = (bucket + 1) * 60
+            if freed >= target:
+                break
+
+        # Second pass: demote files older than cutoff
+        dest = self._next_tier(tier)
+        demote_dest = False
+        for root, tiledir in self._tile_dirs(tier):
+            for dirpath, _, filenames in os.walk(tiledir.as_posix()):
+                for name in filenames:
+                    src = Path(dirpath, name)
+                    try:
+                        st = src.stat()
+                        if max(st.st_atime, st.st_mtime) >= cutoff:
+                            continue
+                        if dest is not None:
+                            rel = src.relative_to(root)
+                            p = self.physical(rel) if dest is self.base else dest.root / rel
+                            if not p.exists():
+                                if st.st_nlink > 1:
+                                    # Keep payload deduplicated
+                                    p.parent.mkdir(mode=0o750, parents=True, exist_ok=True)
+                                    store_blob(self.root_of(dest, p), p, src.read_bytes())
+                                else:
+                                    atomic_copy(src, p)
+                                # Only the first call that exceeds the bound returns True
+                                demote_dest = dest.add(st.st_size) or demote_dest
+                        src.unlink()
+                        total -= st.st_size
+                    except FileNotFoundError:
+                        pass
+
+        for root in (self.shards if tier is self.base else [tier.root]):
+            collect_blobs(root)
+
+        if dest is not None and (dest.add(0) or demote_dest):
+            self._start_demotion(dest)
+
+        return total
+
@@ -0,0 +1,290 @@
+""" QGIS server plugin filter - Serve cached tiles before loading the project
+
+    Cached tiles are looked up as soon as the request is ready, from
+    the MAP parameter and the WMTS parameters. On hit, the request is
+    redirected to a service that writes the cached tile, so that QGIS
+    server does not load the project. Misses are processed as usual.
+
+    Cached WMTS GetCapabilities documents are served the same way,
+    with precompressed variants when the client accepts them.
+
+    Tile aligned WMS GetMap requests may be rewritten as WMTS GetTile
+    requests so that they share the WMTS tile cache.
+
+    The filter also replaces responses of the cache filter with
+    304 responses for not modified content and with compressed
+    variants of cached documents.
+
+    Copyright: (C) 2019 3Liz
+"""
+import os
+import traceback
+
+from pathlib import Path
+from typing import Dict, NamedTuple, Optional
+
+from qgis.core import Qgis, QgsMessageLog, QgsProject
+from qgis.PyQt.QtCore import QByteArray
+from qgis.server import (
+    QgsServerFilter,
+    QgsServerInterface,
+    QgsServerRequest,
+    QgsServerResponse,
+    QgsService,
+)
+
+from .cachefilter import DOCUMENT_CONTENT_TYPE, DiskCacheFilter
+from .renderer import REFRESH_HEADER
+from .validators import not_modified
+from .wmsc import wms_tile
+
+SERVICE_NAME = 'WMTSCACHE'
+SERVICE_VERSION = '1.0.0'
+
+
+class Pending(NamedTuple):
+    content_type: str
+    location: Path
+    # None for not modified content
+    data: Optional[bytes]
+    encoding: Optional[str] = None
+
+
+class TileRequestFilter(QgsServerFilter):
+    """ Look up cached tiles before the project is loaded
+    """
+
+    def __init__(self, serverIface: 'QgsServerInterface', cachefilter: DiskCacheFilter,
+                 early_hits: bool=True, wms_tiles: bool=False) -> None:
+        super().__init__(serverIface)
+        self._iface = serverIface
+        self._cachefilter = cachefilter
+        self._early_hits = early_hits
+        self._wms_tiles = wms_tiles
+        self._pending = None
+
+    def take_pending(self) -> Optional[Pending]:
+        """ Return the pending cached content
+        """
+        pending, self._pending = self._pending, None
+        return pending
+
+    def onRequestReady(self) -> bool:
+        """ Override QgsServerFilter::onRequestReady
+        """
+        self._pending = None
+        self._cachefilter.take_not_modified()
+        self._cachefilter.take_encoded()
+        self._cachefilter.take_rendering()
+        try:
+            if self._wms_tiles:
+                self.rewrite_wms_tile()
+            if self._early_hits:
+                self.lookup()
+        except Exception as e:
+            QgsMessageLog.logMessage("WMTS Cache exception: %s\n%s" % (e,traceback.format_exc()),
+                                     "wmtsCache",Qgis.Critical)
+        return True
+
+    def requestReady(self) -> None:
+        """ Override QgsServerFilter::requestReady
+
+            Used by QGIS versions older than 3.24
+        """
+        self.onRequestReady()
+
+    def onResponseComplete(self) -> bool:
+        """ Override QgsServerFilter::onResponseComplete
+        """
+        handler = self._iface.requestHandler()
+        if self._cachefilter.take_not_modified():
+            handler.clearBody()
+            handler.setStatusCode(304)
+        encoded = self._cachefilter.take_encoded()
+        if encoded:
+            encoding, data = encoded
+            handler.clearBody()
+            handler.setResponseHeader('Content-Type', DOCUMENT_CONTENT_TYPE)
+            handler.setResponseHeader('Content-Encoding', encoding)
+            handler.appendBody(QByteArray(data))
+        if handler.exceptionRaised():
+            self.replace_failed_render()
+        else:
+            self._cachefilter.take_rendering()
+        return True
+
+    def replace_failed_render(self) -> None:
+        """ Replace the error response of a failed tile render
+            by the last good tile
+        """
+        try:
+            last_good = self._cachefilter.render_failed()
+        except Exception as e:
+            QgsMessageLog.logMessage("WMTS Cache exception: %s\n%s" % (e,traceback.format_exc()),
+                                     "wmtsCache",Qgis.Critical)
+            return
+        if last_good:
+            content_type, data = last_good
+            handler = self._iface.requestHandler()
+            handler.clearBody()
+            handler.setStatusCode(200)
+            handler.setResponseHeader('Content-Type', content_type)
+            handler.appendBody(QByteArray(data))
+
+    def responseComplete(self) -> None:
+        """ Override QgsServerFilter::responseComplete
+
+            Used by QGIS versions older than 3.24
+        """
+        self.onResponseComplete()
+
+    def project_file(self, params: Dict[str,str]) -> Optional[str]:
+        """ Return the project file of the request
+
+            Projects from storages are not returned
+        """
+        # QGIS server uses the project file from the environment
+        # before the MAP parameter
+        project = os.getenv('QGIS_PROJECT_FILE') or params.get('MAP')
+        return project if project and os.path.isfile(project) else None
+
+    def rewrite_wms_tile(self) -> None:
+        """ Rewrite tile aligned WMS GetMap requests as WMTS GetTile requests
+        """
+        handler = self._iface.requestHandler()
+        params = handler.parameterMap()
+        if params.get('SERVICE','').upper() != 'WMS' or params.get('REQUEST','').lower() != 'getmap':
+            return
+
+        project = self.project_file(params)
+        if not project:
+            return
+
+        # Grids are known from the capabilities of the current
+        # version of the project
+        infos = self._cachefilter.find_tilematrix_infos(project, os.stat(project).st_mtime_ns // 1000000)
+        if infos is None:
+            return
+
+        tile = wms_tile(params, infos)
+        if tile is None:
+            return
+
+        for name in params:
+            if name.upper() != 'MAP':
+                handler.removeParameter(name)
+        for name, value in tile.items():
+            handler.setParameter(name, value)
+
+    def lookup(self) -> None:
+        """ Redirect the request to the cached tile service on hit
+        """
+        handler = self._iface.requestHandler()
+        params = handler.parameterMap()
+        if params.get('SERVICE','').upper() != 'WMTS':
+            return
+        request = params.get('REQUEST','').lower()
+        if request not in ('gettile', 'getcapabilities'):
+            return
+
+        project = self.project_file(params)
+        if not project:
+            # Projects from storages are looked up
+            # by the cache filter
+            return
+
+        if request == 'getcapabilities':
+            # Documents are cached by access control key, which
+            # is only known once the project is loaded
+            if not self._cachefilter.keyed_documents():
+                self.lookup_document(project, params)
+            return
+
+        if self._cachefilter.is_refresh(handler.requestHeader(REFRESH_HEADER)):
+            return
+
+        generation = os.stat(project).st_mtime_ns // 1000000
+        tile = self._cachefilter.find_tile(project, params, generation=generation)
+        if not tile:
+            return
+
+        self._cachefilter.log_access(project, params, hit=True)
+
+        if tile.stale:
+            self._cachefilter.revalidate(project, params)
+
+        self._cachefilter.set_cache_headers(tile.stat, tile.policy)
+        self._cachefilter.set_debug_headers(path=tile.location)
+
+        if not_modified(tile.stat, handler.requestHeader('If-None-Match'),
+                        handler.requestHeader('If-Modified-Since')):
+            data = None
+        else:
+            data = self._cachefilter.read_tile(tile)
+
+        self._pending = Pending(params.get('FORMAT') or 'image/png', tile.location, data)
+        self.redirect()
+
+    def lookup_document(self, project: str, params: Dict[str,str]) -> None:
+        """ Redirect the request to the cached tile service
+            if the document is cached
+        """
+        handler = self._iface.requestHandler()
+        self._cachefilter.record_key(params)
+        p = self._cachefilter.find_document(project, params, os.stat(project).st_mtime)
+        doc = self._cachefilter.select_document(p, handler.requestHeader('Accept-Encoding'))
+        if not doc:
+            return
+
+        self._cachefilter.set_document_headers(doc)
+        self._cachefilter.set_debug_headers(path=p)
+
+        if not_modified(doc.stat, handler.requestHeader('If-None-Match'),
+                        handler.requestHeader('If-Modified-Since'), doc.encoding):
+            data = None
+        else:
+            data = self._cachefilter.read_document(doc)
+
+        self._pending = Pending(DOCUMENT_CONTENT_TYPE, p, data, doc.encoding)
+        self.redirect()
+
+    def redirect(self) -> None:
+        """ Redirect the request to the cached tile service
+        """
+        handler = self._iface.requestHandler()
+        handler.setParameter('SERVICE', SERVICE_NAME)
+        handler.setParameter('VERSION', SERVICE_VERSION)
+        handler.removeParameter('MAP')
+
+
+class CachedTileService(QgsService):
+    """ Write the content found by the request filter
+    """
+
+    def __init__(self, tilefilter: TileRequestFilter) -> None:
+        super().__init__()
+        self._filter = tilefilter
+
+    def name(self) -> str:
+        return SERVICE_NAME
+
+    def version(self) -> str:
+        return SERVICE_VERSION
+
+    def executeRequest(self, request: 'QgsServerRequest', response: 'QgsServerResponse',
+                       project: 'QgsProject') -> None:
+        """ Override QgsService::executeRequest
+        """
+        pending = self._filter.take_pending()
+        if pending is None:
+            # Not redirected by the filter
+            response.sendError(400, "Invalid request")
+            return
+
+        if pending.data is None:
+            response.setStatusCode(304)
+            return
+        response.setHeader('Content-Type', pending.content_type)
+        if pending.encoding:
+            response.setHeader('Content-Encoding', pending.encoding)
+        response.write(QByteArray(pending.data))
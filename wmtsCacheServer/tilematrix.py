@@ -0,0 +1,177 @@
+""" WMTS tile matrix sets and layer tile limits
+
+    Tile matrix sets and layer limits are read from the WMTS
+    GetCapabilities document of the project.
+
+    Copyright: (C) 2019 3Liz
+"""
+import json
+import xml.etree.ElementTree as ET
+
+from pathlib import Path
+from typing import Dict, NamedTuple, Optional, Tuple, Union
+
+NAMESPACES = {
+    'wmts': 'http://www.opengis.net/wmts/1.0',
+    'ows': 'http://www.opengis.net/ows/1.1',
+}
+
+# Standardized rendering pixel size (m)
+OGC_PX_M = 0.00028
+
+# Meters per degree at equator
+METERS_PER_DEGREE = 111319.49079327358
+
+Limits = Tuple[int,int,int,int]
+
+
+class TileMatrix(NamedTuple):
+    identifier: str
+    scale_denominator: float
+    top_left: Tuple[float,float]
+    tile_width: int
+    tile_height: int
+    matrix_width: int
+    matrix_height: int
+
+    def resolution(self, meters_per_unit: float=1.0) -> float:
+        """ Return the size of a pixel in crs units
+        """
+        return self.scale_denominator * OGC_PX_M / meters_per_unit
+
+
+class TileMatrixSet(NamedTuple):
+    identifier: str
+    crs: str
+    matrices: Dict[str,TileMatrix]
+
+    def meters_per_unit(self) -> float:
+        """ Geographic crs are expressed in degrees
+        """
+        crs = self.crs.upper()
+        if crs.endswith(':4326') or crs.endswith('CRS84'):
+            return METERS_PER_DEGREE
+        return 1.0
+
+    def axis_inverted(self) -> bool:
+        """ Geographic crs have latitude first axis order,
+            except CRS84
+        """
+        return self.crs.upper().endswith(':4326')
+
+    def top_left(self, tm: TileMatrix) -> Tuple[float,float]:
+        """ Return the top left corner of the tile matrix as (x, y)
+        """
+        return tm.top_left[::-1] if self.axis_inverted() else tm.top_left
+
+
+def _text(elem: ET.Element, path: str) -> Optional[str]:
+    e = elem.find(path, NAMESPACES)
+    return e.text.strip() if e is not None and e.text else None
+
+
+class TileMatrixInfos:
+    """ Tile matrix sets and layers tile limits of a project
+    """
+
+    def __init__(self, tilematrixsets: Dict[str,TileMatrixSet],
+                 limits: Dict[str,Dict[str,Dict[str,Limits]]],
+                 last_modified: int) -> None:
+        self.tilematrixsets = tilematrixsets
+        self.limits = limits
+        self.last_modified = last_modified
+
+    @classmethod
+    def from_capabilities(cls, content: Union[str,bytes], last_modified: int) -> 'TileMatrixInfos':
+        """ Read infos from WMTS GetCapabilities document
+        """
+        if isinstance(content, str):
+            # Encoding declaration is not supported with unicode strings
+            content = content.encode('utf-8')
+        root = ET.fromstring(content)
+        contents = root.find('wmts:Contents', NAMESPACES)
+        if contents is None:
+            raise ValueError("Not a WMTS capabilities document")
+
+        tilematrixsets = {}
+        for tms in contents.findall('wmts:TileMatrixSet', NAMESPACES):
+            matrices = {}
+            for tm in tms.findall('wmts:TileMatrix', NAMESPACES):
+                x, y = _text(tm, 'wmts:TopLeftCorner').split()
+                ident = _text(tm, 'ows:Identifier')
+                matrices[ident] = TileMatrix(
+                    identifier=ident,
+                    scale_denominator=float(_text(tm, 'wmts:ScaleDenominator')),
+                    top_left=(float(x), float(y)),
+                    tile_width=int(_text(tm, 'wmts:TileWidth')),
+                    tile_height=int(_text(tm, 'wmts:TileHeight')),
+                    matrix_width=int(_text(tm, 'wmts:MatrixWidth')),
+                    matrix_height=int(_text(tm, 'wmts:MatrixHeight')),
+                )
+            ident = _text(tms, 'ows:Identifier')
+            tilematrixsets[ident] = TileMatrixSet(ident, _text(tms, 'ows:SupportedCRS') or ident, matrices)
+
+        limits = {}
+        for layer in contents.findall('wmts:Layer', NAMESPACES):
+            layer_limits = limits.setdefault(_text(layer, 'ows:Identifier'), {})
+            for link in layer.findall('wmts:TileMatrixSetLink', NAMESPACES):
+                tms_limits = layer_limits.setdefault(_text(link, 'wmts:TileMatrixSet'), {})
+                for tml in link.findall('wmts:TileMatrixSetLimits/wmts:TileMatrixLimits', NAMESPACES):
+                    tms_limits[_text(tml, 'wmts:TileMatrix')] = (
+                        int(_text(tml, 'wmts:MinTileRow')),
+                        int(_text(tml, 'wmts:MaxTileRow')),
+                        int(_text(tml, 'wmts:MinTileCol')),
+                        int(_text(tml, 'wmts:MaxTileCol')),
+                    )
+
+        return cls(tilematrixsets, limits, last_modified)
+
+    @classmethod
+    def load(cls, path: Path) -> 'TileMatrixInfos':
+        """ Load infos from json file
+        """
+        data = json.loads(path.read_text())
+        tilematrixsets = {}
+        for ident, tms in data['tilematrixsets'].items():
+            matrices = {}
+            for tm in tms['matrices']:
+                tm['top_left'] = tuple(tm['top_left'])
+                matrices[tm['identifier']] = TileMatrix(**tm)
+            tilematrixsets[ident] = TileMatrixSet(ident, tms['crs'], matrices)
+        limits = {layer: {tms: {tm: tuple(lim) for tm, lim in tml.items()} for tms, tml in v.items()}
+                  for layer, v in data['limits'].items()}
+        return cls(tilematrixsets, limits, data['last_modified'])
+
+    def save(self, path: Path) -> None:
+        """ Save infos as json file
+        """
+        data = {
+            'last_modified': self.last_modified,
+            'tilematrixsets': {
+                ident: {'crs': tms.crs, 'matrices': [tm._asdict() for tm in tms.matrices.values()]}
+                for ident, tms in self.tilematrixsets.items()
+            },
+            'limits': self.limits,
+        }
+        path.write_text(json.dumps(data))
+
+    def tile_matrix(self, tms: str, matrix: str) -> Optional[TileMatrix]:
+        """ Return tile matrix definition
+        """
+        tilematrixset = self.tilematrixsets.get(tms)
+        return tilematrixset.matrices.get(matrix) if tilematrixset else None
+
+    def outside(self, layer: str, tms: str, matrix: str, row: int, col: int) -> bool:
+        """ Check if a tile is in the tile matrix but outside the layer limits
+
+            Return False if the tile is outside the tile matrix or
+            if the limits are unknown.
+        """
+        tm = self.tile_matrix(tms, matrix)
+        if tm is None or not (0 <= row < tm.matrix_height and 0 <= col < tm.matrix_width):
+            return False
+        limits = self.limits.get(layer, {}).get(tms, {}).get(matrix)
+        if limits is None:
+            return False
+        minrow, maxrow, mincol, maxcol = limits
+        return not (minrow <= row <= maxrow and mincol <= col <= maxcol)
@@ -0,0 +1,583 @@
+""" Standalone tile server
+
+    Serve cached tiles directly from the cache directories and
+    forward misses to an upstream QGIS server.
+
+    Tiles are requested with WMTS KVP requests or with the REST
+    template `/wmts/{layer}/{style}/{tilematrixset}/{tilematrix}/{tilerow}/{tilecol}.{ext}`
+    where the project is given by the `MAP` parameter.
+
+    Copyright: (C) 2019 3Liz
+"""
+import asyncio
+import os
+import signal
+import socket
+import ssl
+import sys
+import time
+import traceback
+
+from email.utils import formatdate
+from http.client import responses as http_responses
+from pathlib import Path
+from typing import Dict, List, NamedTuple, Optional, Sequence, Tuple
+from urllib.parse import parse_qsl, unquote, urlencode, urlsplit
+
+from .cachekeys import canonical_key, canonical_params
+from .generation import Generations
+from .helper import CacheHelper
+from .policy import EXPIRED, STALE, CachePolicy, PolicyConfig
+from .renderer import REFRESH_HEADER, refresh_token
+from .tiers import Tier, TieredStorage
+from .validators import cache_headers, not_modified
+
+SERVER_NAME = 'wmtscache'
+
+# Maximum size of request and response headers
+MAX_HEADER_SIZE = 65536
+
+# Hop by hop headers are not forwarded
+HOP_HEADERS = {
+    'connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization',
+    'te', 'trailer', 'transfer-encoding', 'upgrade', 'host', 'content-length',
+}
+
+# Headers of tile misses that may change the upstream response:
+# coalesced requests must have the same values
+AUTH_HEADERS = ('authorization', 'cookie')
+
+# Conditional headers are not forwarded for tile misses since
+# upstream responses are shared by coalesced requests
+CONDITIONAL_HEADERS = {'if-none-match', 'if-modified-since', 'if-match', 'if-unmodified-since', 'if-range'}
+
+FORMATS = {
+    'png': 'image/png',
+    'jpg': 'image/jpeg',
+    'jpeg': 'image/jpeg',
+}
+
+TILE_PARAMS = ('LAYER', 'TILEMATRIXSET', 'TILEMATRIX', 'TILEROW', 'TILECOL')
+
+
+class Request(NamedTuple):
+    method: str
+    target: str
+    path: str
+    query: str
+    version: str
+    headers: Dict[str,str]
+
+
+class Response(NamedTuple):
+    status: int
+    headers: List[Tuple[str,str]]
+    body: bytes
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def _parse_head(head: bytes) -> Tuple[str, List[Tuple[str,str]]]:
+    """ Return start line and headers
+    """
+    lines = head.decode('latin-1').split('\r\n')
+    headers = []
+    for line in lines[1:]:
+        if not line:
+            continue
+        name, sep, value = line.partition(':')
+        if not sep:
+            raise ProtocolError("Invalid header line")
+        headers.append((name.strip(), value.strip()))
+    return lines[0], headers
+
+
+async def read_request(reader: asyncio.StreamReader) -> Optional[Request]:
+    """ Read a request from client
+
+        Return None if the connection is closed
+    """
+    try:
+        head = await reader.readuntil(b'\r\n\r\n')
+    except asyncio.IncompleteReadError:
+        return None
+    except asyncio.LimitOverrunError:
+        raise ProtocolError("Request header too large")
+
+    line, headers = _parse_head(head)
+    try:
+        method, target, version = line.split(' ')
+    except ValueError:
+        raise ProtocolError("Invalid request line")
+
+    headers = {k.lower(): v for k, v in headers}
+    # Discard request body
+    if 'chunked' in headers.get('transfer-encoding','').lower():
+        try:
+            await _read_chunked(reader)
+        except (ValueError, asyncio.LimitOverrunError):
+            raise ProtocolError("Invalid chunked body")
+    else:
+        try:
+            length = int(headers.get('content-length') or 0)
+        except ValueError:
+            length = -1
+        if length < 0:
+            raise ProtocolError("Invalid content length")
+        if length:
+            await reader.readexactly(length)
+
+    url = urlsplit(target)
+    return Request(method.upper(), target, unquote(url.path), url.query, version, headers)
+
+
+async def _read_chunked(reader: asyncio.StreamReader) -> bytes:
+    chunks = []
+    while True:
+        line = await reader.readuntil(b'\r\n')
+        size = int(line.split(b';')[0], 16)
+        if size == 0:
+            # Skip trailers
+            while (await reader.readuntil(b'\r\n')) != b'\r\n':
+                pass
+            break
+        chunks.append(await reader.readexactly(size))
+        await reader.readexactly(2)
+    return b''.join(chunks)
+
+
+async def read_response(reader: asyncio.StreamReader, method: str) -> Tuple[Response, bool]:
+    """ Read a response from upstream
+
+        Return the response and whether the connection may be reused
+    """
+    head = await reader.readuntil(b'\r\n\r\n')
+    line, headers = _parse_head(head)
+    version, status, *_ = line.split(' ', 2)
+    status = int(status)
+
+    h = {k.lower(): v for k, v in headers}
+    keep_alive = version == 'HTTP/1.1' and h.get('connection','').lower() != 'close'
+    if method == 'HEAD' or status in (204, 304) or status < 200:
+        body = b''
+    elif 'chunked' in h.get('transfer-encoding','').lower():
+        body = await _read_chunked(reader)
+    elif 'content-length' in h:
+        body = await reader.readexactly(int(h['content-length']))
+    else:
+        body = await reader.read()
+        keep_alive = False
+
+    headers = [(k, v) for k, v in headers if k.lower() not in HOP_HEADERS]
+    return Response(status, headers, body), keep_alive
+
+
+class UpstreamPool:
+    """ Pool of persistent connections to the upstream server
+
+        The number of concurrent upstream requests is bounded
+        by the size of the pool.
+    """
+
+    def __init__(self, url: str, size: int=8, timeout: float=60.) -> None:
+        u = urlsplit(url)
+        if u.scheme not in ('http', 'https'):
+            raise ValueError("Invalid upstream url %s" % url)
+        self.host = u.hostname
+        self.port = u.port or (443 if u.scheme == 'https' else 80)
+        self.path = u.path or '/'
+        self.netloc = u.netloc
+        self.size = size
+        self.timeout = timeout
+        self._ssl = ssl.create_default_context() if u.scheme == 'https' else None
+        self._idle = []
+        self._slots = None
+
+    def target(self, query: str) -> str:
+        """ Return the upstream request target for query
+        """
+        return "%s?%s" % (self.path, query) if query else self.path
+
+    async def _connect(self) -> Tuple[Tuple[asyncio.StreamReader, asyncio.StreamWriter], bool]:
+        while self._idle:
+            conn = self._idle.pop()
+            if not conn[0].at_eof():
+                return conn, True
+            conn[1].close()
+        conn = await asyncio.wait_for(asyncio.open_connection(self.host, self.port, ssl=self._ssl,
+                                                              limit=MAX_HEADER_SIZE),
+                                      self.timeout)
+        return conn, False
+
+    async def request(self, method: str, target: str,
+                      headers: Sequence[Tuple[str,str]]=()) -> Response:
+        """ Send a request to upstream
+        """
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.size)
+
+        head = ["%s %s HTTP/1.1" % (method, target), "Host: %s" % self.netloc]
+        head.extend("%s: %s" % h for h in headers)
+        data = ('\r\n'.join(head) + '\r\n\r\n').encode('latin-1')
+
+        async with self._slots:
+            while True:
+                (reader, writer), reused = await self._connect()
+                try:
+                    writer.write(data)
+                    await writer.drain()
+                    resp, keep_alive = await asyncio.wait_for(read_response(reader, method),
+                                                              self.timeout)
+                except (ConnectionError, asyncio.IncompleteReadError):
+                    writer.close()
+                    if reused:
+                        # Stale connection: retry with another one
+                        continue
+                    raise
+                except BaseException:
+                    writer.close()
+                    raise
+                if keep_alive:
+                    self._idle.append((reader, writer))
+                else:
+                    writer.close()
+                return resp
+
+    def close(self) -> None:
+        for _, writer in self._idle:
+            writer.close()
+        self._idle.clear()
+
+
+def tile_params(req: Request, default_project: Optional[str]=None) -> Optional[Dict[str,str]]:
+    """ Decode WMTS tile parameters from KVP or REST request
+
+        Return None if the request is not a tile request
+    """
+    params = {k.upper(): v for k, v in parse_qsl(req.query, keep_blank_values=True)}
+    if req.path.startswith('/wmts/'):
+        parts = req.path[len('/wmts/'):].split('/')
+        if len(parts) != 6:
+            return None
+        col, _, ext = parts[5].rpartition('.')
+        fmt = FORMATS.get(ext.lower())
+        if fmt is None:
+            return None
+        params.update(SERVICE='WMTS', VERSION='1.0.0', REQUEST='GetTile', FORMAT=fmt,
+                      LAYER=parts[0], STYLE=parts[1], TILEMATRIXSET=parts[2],
+                      TILEMATRIX=parts[3], TILEROW=parts[4], TILECOL=col)
+    elif params.get('SERVICE','').upper() != 'WMTS' or params.get('REQUEST','').lower() != 'gettile':
+        return None
+
+    if not all(params.get(k) for k in TILE_PARAMS):
+        return None
+    if not (params['TILEROW'].isdigit() and params['TILECOL'].isdigit()):
+        return None
+    if default_project:
+        # QGIS server uses the project file from the environment
+        # before the MAP parameter
+        params['MAP'] = default_project
+    if not params.get('MAP'):
+        return None
+    params.setdefault('STYLE', '')
+    params.setdefault('FORMAT', 'image/png')
+    return params
+
+
+class TileServer:
+    """ Serve cached tiles and forward misses to upstream
+
+        Concurrent misses for the same tile are coalesced into
+        a single upstream request. Stale tiles are served and
+        rendered again in background. The last good tile is served
+        when upstream fails to render a tile.
+    """
+
+    def __init__(self, rootdir: Path, upstream: str, layout: str='tc',
+                 tiers: Sequence[Tier]=(), shards: Sequence[Path]=(),
+                 policy: Optional[PolicyConfig]=None, concurrency: int=8,
+                 project: Optional[str]=None) -> None:
+        self.storage = TieredStorage(rootdir, tiers, shards)
+        self.cache = CacheHelper(rootdir, layout, self.storage.shards)
+        self.generations = Generations(self.cache, self.storage)
+        self.policy = policy or PolicyConfig()
+        self.upstream = UpstreamPool(upstream, size=concurrency)
+        self.project = project
+        self.stats = {'hits': 0, 'misses': 0, 'coalesced': 0, 'errors': 0, 'stale': 0,
+                      'last_good': 0}
+        self.refresh_limit = concurrency
+        self._token = refresh_token(rootdir)
+        self._inflight = {}
+        self._refreshing = set()
+
+    def lookup(self, params: Dict[str,str]) -> Optional[Tuple[Path, os.stat_result, CachePolicy, str]]:
+        """ Return the location, the status, the policy and the state of the cached tile
+        """
+        policy = self.policy.resolve(params['MAP'], params['LAYER'])
+        if not policy.cache or not policy.accept_zoom(params['TILEMATRIX']):
+            return None
+        try:
+            # Retire tiles of older versions of local projects
+            generation = os.stat(params['MAP']).st_mtime_ns // 1000000
+        except FileNotFoundError:
+            pass
+        else:
+            if not self.generations.validate(params['MAP'], generation):
+                return None
+        try:
+            p = self.cache.get_tile_cache(params['MAP'], params, layout=policy.layout,
+                                          project_id=policy.project_id)
+        except ValueError:
+            # Unsupported format
+            return None
+        _, found, st = self.storage.find(p)
+        if found is None:
+            return None
+        state = policy.tile_state(time.time() - st.st_mtime)
+        if state == EXPIRED:
+            return None
+        return found, st, policy, state
+
+    def last_good(self, params: Dict[str,str]) -> Optional[Tuple[Path, CachePolicy]]:
+        """ Return the location and the policy of the last good tile,
+            even if expired or retired
+        """
+        policy = self.policy.resolve(params['MAP'], params['LAYER'])
+        try:
+            p = self.cache.get_tile_cache(params['MAP'], params, layout=policy.layout,
+                                          project_id=policy.project_id)
+        except ValueError:
+            return None
+        _, found, _ = self.storage.find(p)
+        if found is None:
+            found, _ = self.storage.find_retired(p)
+            if found is None:
+                return None
+        return found, policy
+
+    def refresh(self, params: Dict[str,str]) -> None:
+        """ Render tile again in background
+
+            The number of concurrent renders is bounded, requests
+            are dropped when the bound is reached.
+        """
+        key = (params['MAP'], canonical_key(canonical_params(params)))
+        if key in self._refreshing or len(self._refreshing) >= self.refresh_limit:
+            return
+
+        async def render():
+            try:
+                await self.upstream.request('GET', self.upstream.target(urlencode(params)),
+                                            [(REFRESH_HEADER, self._token)])
+            except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, ValueError) as e:
+                self.stats['errors'] += 1
+                print("Upstream error: %s" % e, file=sys.stderr)
+            finally:
+                self._refreshing.discard(key)
+
+        self._refreshing.add(key)
+        asyncio.ensure_future(render())
+
+    async def forward(self, req: Request, params: Optional[Dict[str,str]]) -> Response:
+        """ Forward request to upstream
+
+            Tile requests are coalesced on their canonical parameters
+            and their credentials
+        """
+        headers = [(k, v) for k, v in req.headers.items() if k not in HOP_HEADERS]
+        if params is None:
+            return await self.upstream.request(req.method, self.upstream.target(req.query), headers)
+
+        headers = [(k, v) for k, v in headers if k not in CONDITIONAL_HEADERS]
+        key = (req.method, params['MAP'], canonical_key(canonical_params(params)),
+               tuple(req.headers.get(h) for h in AUTH_HEADERS))
+        fut = self._inflight.get(key)
+        if fut is not None:
+            self.stats['coalesced'] += 1
+        else:
+            query = urlencode(params) if req.path.startswith('/wmts/') else req.query
+            fut = asyncio.ensure_future(self.upstream.request(req.method, self.upstream.target(query),
+                                                              headers))
+            self._inflight[key] = fut
+            fut.add_done_callback(lambda _: self._inflight.pop(key, None))
+        # Do not cancel the shared request if the client disconnects
+        return await asyncio.shield(fut)
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        """ Handle client connection
+        """
+        try:
+            while True:
+                try:
+                    req = await read_request(reader)
+                except ProtocolError as e:
+                    await self.send(writer, Response(400, [], str(e).encode()), False)
+                    break
+                if req is None:
+                    break
+                keep_alive = req.headers.get('connection','').lower() != 'close' \
+                    and (req.version == 'HTTP/1.1' or req.headers.get('connection','').lower() == 'keep-alive')
+                await self.process(req, writer, keep_alive)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def process(self, req: Request, writer: asyncio.StreamWriter, keep_alive: bool) -> None:
+        """ Process a single request
+        """
+        if req.method not in ('GET', 'HEAD'):
+            await self.send(writer, Response(405, [('Allow', 'GET, HEAD')], b''), keep_alive)
+            return
+
+        params = tile_params(req, self.project)
+        if params is not None:
+            tile = self.lookup(params)
+            if tile is not None:
+                found, st, policy, state = tile
+                if state == STALE:
+                    self.stats['stale'] += 1
+                    self.refresh(params)
+                    status = 'STALE'
+                else:
+                    status = 'HIT'
+                if not_modified(st, req.headers.get('if-none-match'), req.headers.get('if-modified-since')):
+                    self.stats['hits'] += 1
+                    headers = cache_headers(st, policy.cache_control) + [('X-Qgis-Cache-Status', status)]
+                    await self.send(writer, Response(304, headers, b''), keep_alive)
+                    return
+                try:
+                    f = found.open('rb')
+                except FileNotFoundError:
+                    pass
+                else:
+                    with f:
+                        self.stats['hits'] += 1
+                        await self.send_file(writer, f, params['FORMAT'], policy, req.method == 'HEAD',
+                                             keep_alive, status)
+                    return
+            self.stats['misses'] += 1
+
+        try:
+            resp = await self.forward(req, params)
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, ValueError) as e:
+            self.stats['errors'] += 1
+            print("Upstream error: %s" % e, file=sys.stderr)
+            resp = Response(502, [('Content-Type', 'text/plain')], b'Bad gateway')
+        else:
+            if params is not None:
+                resp = resp._replace(headers=resp.headers + [('X-Qgis-Cache-Status', 'MISS')])
+        if params is not None and resp.status >= 500:
+            last_good = self.last_good(params)
+            if last_good is not None:
+                found, policy = last_good
+                try:
+                    f = found.open('rb')
+                except FileNotFoundError:
+                    pass
+                else:
+                    with f:
+                        self.stats['last_good'] += 1
+                        await self.send_file(writer, f, params['FORMAT'], policy, req.method == 'HEAD',
+                                             keep_alive, 'STALE')
+                    return
+        await self.send(writer, resp, keep_alive, head=req.method == 'HEAD')
+
+    def _head(self, status: int, headers: List[Tuple[str,str]], length: Optional[int],
+              keep_alive: bool) -> bytes:
+        head = ["HTTP/1.1 %d %s" % (status, http_responses.get(status, 'Unknown')),
+                "Server: %s" % SERVER_NAME,
+                "Date: %s" % formatdate(usegmt=True),
+                "Connection: %s" % ('keep-alive' if keep_alive else 'close')]
+        if length is not None:
+            head.append("Content-Length: %d" % length)
+        head.extend("%s: %s" % h for h in headers if h[0].lower() not in ('server', 'date'))
+        return ('\r\n'.join(head) + '\r\n\r\n').encode('latin-1')
+
+    async def send(self, writer: asyncio.StreamWriter, resp: Response, keep_alive: bool,
+                   head: bool=False) -> None:
+        length = len(resp.body) if resp.status != 304 else None
+        writer.write(self._head(resp.status, resp.headers, length, keep_alive))
+        if not head:
+            writer.write(resp.body)
+        await writer.drain()
+
+    async def send_file(self, writer: asyncio.StreamWriter, f, fmt: str, policy: CachePolicy,
+                        head: bool, keep_alive: bool, status: str='HIT') -> None:
+        st = os.fstat(f.fileno())
+        headers = [('Content-Type', fmt)] + cache_headers(st, policy.cache_control) \
+            + [('X-Qgis-Cache-Status', status)]
+        writer.write(self._head(200, headers, st.st_size, keep_alive))
+        await writer.drain()
+        if not head:
+            await asyncio.get_event_loop().sendfile(writer.transport, f, 0, st.st_size)
+
+    async def start(self, host: str='127.0.0.1', port: int=0,
+                    sock: Optional[socket.socket]=None) -> asyncio.AbstractServer:
+        """ Start serving
+        """
+        if sock is not None:
+            return await asyncio.start_server(self.handle, sock=sock, limit=MAX_HEADER_SIZE)
+        return await asyncio.start_server(self.handle, host, port, limit=MAX_HEADER_SIZE)
+
+    def close(self) -> None:
+        self.upstream.close()
+
+
+async def _serve(server: TileServer, sock: socket.socket) -> None:
+    srv = await server.start(sock=sock)
+    loop = asyncio.get_event_loop()
+    stop = loop.create_future()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, lambda: stop.done() or stop.set_result(None))
+    async with srv:
+        await stop
+    server.close()
+
+
+def run(factory, host: str, port: int, workers: int=1) -> None:
+    """ Run tile servers in worker processes
+
+        Workers share the listening socket, each worker has
+        its own event loop and upstream connection pool.
+    """
+    sock = socket.socket(socket.AF_INET6 if ':' in host else socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(1024)
+    sock.setblocking(False)
+
+    print("Serving tiles on %s:%d with %d worker(s)" % (host, port, workers), file=sys.stderr)
+    if workers <= 1:
+        asyncio.run(_serve(factory(), sock))
+        return
+
+    children = []
+    for _ in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                asyncio.run(_serve(factory(), sock))
+            except Exception:
+                traceback.print_exc()
+                code = 1
+            finally:
+                os._exit(code)
+        children.append(pid)
+
+    def terminate(signum, frame):
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGINT, terminate)
+    signal.signal(signal.SIGTERM, terminate)
+    for pid in children:
+        os.waitpid(pid, 0)
@@ -0,0 +1,52 @@
+""" HTTP validators for cached content
+
+    Validators are computed from the status of cached files
+    so that conditional requests never read the content.
+
+    Copyright: (C) 2019 3Liz
+"""
+import os
+
+from email.utils import formatdate, parsedate_to_datetime
+from typing import List, Optional, Tuple
+
+
+def etag(st: os.stat_result, encoding: Optional[str]=None) -> str:
+    """ Return entity tag from file modification time and size
+
+        Compressed variants have distinct tags
+    """
+    if encoding:
+        return '"%x-%x-%s"' % (st.st_mtime_ns, st.st_size, encoding)
+    return '"%x-%x"' % (st.st_mtime_ns, st.st_size)
+
+
+def cache_headers(st: os.stat_result, cache_control: Optional[str]=None,
+                  encoding: Optional[str]=None) -> List[Tuple[str,str]]:
+    """ Return validators and cache control headers
+    """
+    headers = [
+        ('ETag', etag(st, encoding)),
+        ('Last-Modified', formatdate(st.st_mtime, usegmt=True)),
+    ]
+    if cache_control:
+        headers.append(('Cache-Control', cache_control))
+    return headers
+
+
+def not_modified(st: os.stat_result, if_none_match: Optional[str],
+                 if_modified_since: Optional[str], encoding: Optional[str]=None) -> bool:
+    """ Check conditional request headers
+
+        If-None-Match takes precedence over If-Modified-Since
+    """
+    if if_none_match:
+        tag = etag(st, encoding)
+        return any(t.strip() in ('*', tag, 'W/' + tag) for t in if_none_match.split(','))
+    if if_modified_since:
+        try:
+            since = parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError, IndexError):
+            return False
+        return int(st.st_mtime) <= since
+    return False
@@ -0,0 +1,111 @@
+""" Tile aligned WMS GetMap requests
+
+    WMS GetMap requests matching a tile of the WMTS tile matrix sets
+    of the project (WMS-C style requests) are mapped to WMTS GetTile
+    requests so that both protocols share the same cached tiles.
+
+    Copyright: (C) 2019 3Liz
+"""
+from typing import Dict, Optional, Tuple
+
+from .tilematrix import TileMatrix, TileMatrixInfos, TileMatrixSet
+
+# Parameters of tile aligned requests, other
+# parameters may change the rendering
+WMS_TILE_PARAMETERS = (
+    'SERVICE', 'REQUEST', 'VERSION', 'LAYERS', 'STYLES', 'CRS', 'SRS', 'BBOX',
+    'WIDTH', 'HEIGHT', 'FORMAT', 'TRANSPARENT', 'MAP', 'EXCEPTIONS',
+)
+
+# Relative tolerance on resolutions
+RESOLUTION_TOLERANCE = 1e-6
+
+# Tolerance on tile origin in pixels
+PIXEL_TOLERANCE = 0.01
+
+
+def wms_tile(params: Dict[str,str], infos: TileMatrixInfos) -> Optional[Dict[str,str]]:
+    """ Return WMTS GetTile parameters for a tile aligned WMS GetMap request
+
+        Return None if the request does not match a tile of a
+        tile matrix set of the layer
+    """
+    params = {k.upper(): v for k, v in params.items()}
+    if params.get('SERVICE','').upper() != 'WMS' or params.get('REQUEST','').lower() != 'getmap':
+        return None
+
+    # Parameters starting with '_' are used for cache busting
+    if any(k not in WMS_TILE_PARAMETERS and not k.startswith('_') for k in params):
+        return None
+
+    layer, style = params.get('LAYERS',''), params.get('STYLES','')
+    if not layer or ',' in layer or ',' in style:
+        return None
+
+    fmt = params.get('FORMAT','').lower()
+    if fmt.startswith('image/png'):
+        # WMTS png tiles are rendered with transparency
+        if params.get('TRANSPARENT','').lower() != 'true':
+            return None
+    elif not fmt.startswith('image/jpeg'):
+        return None
+
+    try:
+        minx, miny, maxx, maxy = (float(v) for v in params.get('BBOX','').split(','))
+        width, height = int(params['WIDTH']), int(params['HEIGHT'])
+    except (KeyError, ValueError):
+        return None
+
+    version = params.get('VERSION','1.3.0')
+    crs = (params.get('CRS') if version == '1.3.0' else params.get('SRS')) or ''
+
+    for tms_id in infos.limits.get(layer, {}):
+        tms = infos.tilematrixsets.get(tms_id)
+        if tms is None or tms.crs.upper() != crs.upper():
+            continue
+        if version == '1.3.0' and tms.axis_inverted():
+            bbox = (miny, minx, maxy, maxx)
+        else:
+            bbox = (minx, miny, maxx, maxy)
+        tile = _tile_index(tms, bbox, width, height)
+        if tile is not None:
+            tm, tilerow, tilecol = tile
+            return {
+                'SERVICE': 'WMTS',
+                'VERSION': '1.0.0',
+                'REQUEST': 'GetTile',
+                'LAYER': layer,
+                'STYLE': style,
+                'TILEMATRIXSET': tms_id,
+                'TILEMATRIX': tm.identifier,
+                'TILEROW': str(tilerow),
+                'TILECOL': str(tilecol),
+                'FORMAT': params['FORMAT'],
+            }
+
+    return None
+
+
+def _tile_index(tms: TileMatrixSet, bbox: Tuple[float,float,float,float],
+                width: int, height: int) -> Optional[Tuple[TileMatrix,int,int]]:
+    """ Return the tile matrix, row and column of the tile matching bbox
+    """
+    minx, miny, maxx, maxy = bbox
+    mpu = tms.meters_per_unit()
+    for tm in tms.matrices.values():
+        if (width, height) != (tm.tile_width, tm.tile_height):
+            continue
+        res = tm.resolution(mpu)
+        if abs((maxx - minx) / width - res) > res * RESOLUTION_TOLERANCE or \
+           abs((maxy - miny) / height - res) > res * RESOLUTION_TOLERANCE:
+            continue
+        left, top = tms.top_left(tm)
+        col = (minx - left) / res / width
+        row = (top - maxy) / res / height
+        tilecol, tilerow = round(col), round(row)
+        if abs(col - tilecol) * width > PIXEL_TOLERANCE or abs(row - tilerow) * height > PIXEL_TOLERANCE:
+            return None
+        if not (0 <= tilerow < tm.matrix_height and 0 <= tilecol < tm.matrix_width):
+            return None
+        return tm, tilerow, tilecol
+    return None
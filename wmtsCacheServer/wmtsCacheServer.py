@@ -12,8 +12,21 @@ from pathlib import Path
 from qgis.core import Qgis, QgsMessageLog
 from qgis.server import QgsServerInterface
 
+from .accesslog import AccessLog
 from .cachefilter import DiskCacheFilter
+from .cachekeys import KeyStats
 from .cachemngrapi import init_cache_api
+from .dedup import PayloadCache
+from .heatmap import HeatMap
+from .jobs import JOB_POLL_INTERVAL, JobQueue
+from .policy import load_policy
+from .prefetch import Prefetcher
+from .renderer import Renderer, refresh_token
+from .seeder import SEED_CONCURRENCY, Seeder
+from .shards import parse_shards
+from .throttle import parse_purge_rate
+from .tiers import TieredStorage, parse_size, parse_tiers
+from .tilefilter import CachedTileService, TileRequestFilter
 
 
 class wmtsCacheServer:
@@ -35,20 +48,142 @@ class wmtsCacheServer:
 
         QgsMessageLog.logMessage('Cache directory set to %s' % rootpathstr,'wmtsCache',Qgis.Info)
 
+        # Storage tiers
+        tiers = parse_tiers(os.getenv('QGIS_WMTS_CACHE_TIERS'))
+        for tier in tiers:
+            tier.root.mkdir(mode=0o750, parents=True, exist_ok=True)
+            QgsMessageLog.logMessage('Cache tier: %s' % tier,'wmtsCache',Qgis.Info)
+
+        # Shards
+        shards = parse_shards(os.getenv('QGIS_WMTS_CACHE_SHARDS'))
+        for shard in shards:
+            shard.mkdir(mode=0o750, parents=True, exist_ok=True)
+            QgsMessageLog.logMessage('Cache shard: %s' % shard,'wmtsCache',Qgis.Info)
+
+        # Grace period of discarded tiles
+        grace = int(os.getenv('QGIS_WMTS_CACHE_GRACE', '0'))
+
+        # Rate of tile removals
+        throttle = parse_purge_rate(os.getenv('QGIS_WMTS_CACHE_PURGE_RATE'))
+        if throttle:
+            QgsMessageLog.logMessage('Purge rate: %s' % throttle,'wmtsCache',Qgis.Info)
+
+        self.storage = TieredStorage(self.rootpath, tiers, shards, grace=grace, throttle=throttle)
+
+        # In memory cache for deduplicated payloads
+        self.payloads = PayloadCache(parse_size(os.getenv('QGIS_WMTS_CACHE_DEDUP_MEMORY', '16M')))
+
+        # Statistics of canonical cache keys
+        self.keystats = KeyStats()
+
         # Get tile layout
         layout = os.getenv('QGIS_WMTS_CACHE_LAYOUT', 'tc')
 
         # Debug headers
         debug_headers = os.getenv('QGIS_WMTS_CACHE_DEBUG_HEADERS', '').lower() in ('1','yes','y','true')
 
-        serverIface.registerServerCache( DiskCacheFilter(serverIface, self.rootpath, layout,
-                                         debug=debug_headers), 50 )
+        # Services with cached documents
+        self.documents = tuple(s.strip().upper() for s in
+                               os.getenv('QGIS_WMTS_CACHE_DOCUMENTS', 'WMTS').split(',') if s.strip())
+        QgsMessageLog.logMessage('Caching documents for %s' % ','.join(self.documents),'wmtsCache',Qgis.Info)
+
+        # Cache policies
+        policypath = os.getenv('QGIS_WMTS_CACHE_POLICY')
+        if policypath:
+            QgsMessageLog.logMessage('Reading cache policy from %s' % policypath,'wmtsCache',Qgis.Info)
+            policypath = Path(policypath)
+        self.policy = load_policy(policypath)
+
+        # Token of background render requests
+        refresh_url = os.getenv('QGIS_WMTS_CACHE_REFRESH_URL')
+        seed_url = os.getenv('QGIS_WMTS_CACHE_SEED_URL', refresh_url)
+        self.token = refresh_token(self.rootpath) if refresh_url or seed_url else None
+
+        # Background rendering of stale tiles
+        self.renderer = None
+        if refresh_url:
+            QgsMessageLog.logMessage('Rendering stale tiles with %s' % refresh_url,'wmtsCache',Qgis.Info)
+            self.renderer = Renderer(refresh_url, self.token,
+                                     maxsize=int(os.getenv('QGIS_WMTS_CACHE_REFRESH_QUEUE', '256')))
+
+        # Log of requested tiles
+        self.accesslog = None
+        accesslog_size = os.getenv('QGIS_WMTS_CACHE_ACCESS_LOG')
+        if accesslog_size:
+            QgsMessageLog.logMessage('Logging tile requests (max size: %s)' % accesslog_size,'wmtsCache',Qgis.Info)
+            self.accesslog = AccessLog(self.rootpath, parse_size(accesslog_size))
+
+        # Heatmaps of tile requests
+        self.heatmap = None
+        if os.getenv('QGIS_WMTS_CACHE_HEATMAP', 'no').lower() in ('1','yes','y','true'):
+            QgsMessageLog.logMessage('Counting tile requests in heatmaps','wmtsCache',Qgis.Info)
+            self.heatmap = HeatMap(self.rootpath)
+
+        # Prefetch neighbour tiles on cache misses
+        self.prefetcher = None
+        if os.getenv('QGIS_WMTS_CACHE_PREFETCH', 'no').lower() in ('1','yes','y','true'):
+            if refresh_url:
+                QgsMessageLog.logMessage('Prefetching neighbour tiles','wmtsCache',Qgis.Info)
+                self.prefetcher = Prefetcher(refresh_url, self.token,
+                                             maxsize=int(os.getenv('QGIS_WMTS_CACHE_PREFETCH_QUEUE', '64')))
+            else:
+                QgsMessageLog.logMessage('Prefetching requires QGIS_WMTS_CACHE_REFRESH_URL','wmtsCache',Qgis.Warning)
+
+        cachefilter = DiskCacheFilter(serverIface, self.rootpath, layout,
+                                      debug=debug_headers, policy=self.policy,
+                                      storage=self.storage, payloads=self.payloads,
+                                      keystats=self.keystats, documents=self.documents,
+                                      renderer=self.renderer, accesslog=self.accesslog,
+                                      heatmap=self.heatmap, prefetcher=self.prefetcher,
+                                      token=self.token)
+        serverIface.registerServerCache( cachefilter, 50 )
+
+        # Serve cached tiles before loading projects
+        early_hits = os.getenv('QGIS_WMTS_CACHE_EARLY_HITS', 'yes').lower() in ('1','yes','y','true')
+        if early_hits:
+            QgsMessageLog.logMessage('Serving cached tiles before loading projects','wmtsCache',Qgis.Info)
+
+        # Map tile aligned WMS requests to WMTS tiles
+        wms_tiles = os.getenv('QGIS_WMTS_CACHE_WMS_TILES', 'no').lower() in ('1','yes','y','true')
+        if wms_tiles:
+            QgsMessageLog.logMessage('Caching tile aligned WMS requests','wmtsCache',Qgis.Info)
+
+        # The request filter also handles not modified responses
+        self.tilefilter = TileRequestFilter(serverIface, cachefilter, early_hits=early_hits,
+                                            wms_tiles=wms_tiles)
+        self.tileservice = CachedTileService(self.tilefilter)
+        # Run after other plugins request filters
+        serverIface.registerFilter( self.tilefilter, 1000 )
+        serverIface.serviceRegistry().registerService( self.tileservice )
+
+        # Background jobs of the cache manager API
+        self.jobs = JobQueue(self.rootpath, workers=int(os.getenv('QGIS_WMTS_CACHE_JOB_WORKERS', '1')))
+        if grace:
+            # Purge tiles retired before a restart, timers of retired tiles
+            # are lost when the process stops
+            self.jobs.schedule(self.storage.purge_retired, max(grace, JOB_POLL_INTERVAL))
+
+        # Seeding jobs
+        seeder = None
+        if seed_url:
+            concurrency = int(os.getenv('QGIS_WMTS_CACHE_SEED_CONCURRENCY', str(SEED_CONCURRENCY)))
+            QgsMessageLog.logMessage('Seeding tiles with %s (concurrency: %d)' % (seed_url, concurrency),
+                                     'wmtsCache',Qgis.Info)
+            seeder = Seeder(seed_url, self.token, concurrency=concurrency)
 
         # Cache Manager API
-        init_cache_api(serverIface, self.rootpath)
+        init_cache_api(serverIface, self.rootpath, self.storage, keystats=self.keystats,
+                       jobs=self.jobs, policy=self.policy, seeder=seeder, heatmap=self.heatmap,
+                       prefetcher=self.prefetcher)
+        self.jobs.start()
 
     def create_filter(self, layout: str=None) -> DiskCacheFilter:
         """ Create a new filter instance
         """
-        return DiskCacheFilter(self.serverIface, self.rootpath, layout or 'tc')
+        return DiskCacheFilter(self.serverIface, self.rootpath, layout or 'tc', policy=self.policy,
+                               storage=self.storage, payloads=self.payloads,
+                               keystats=self.keystats, documents=self.documents,
+                               renderer=self.renderer, accesslog=self.accesslog,
+                               heatmap=self.heatmap, prefetcher=self.prefetcher,
+                               token=self.token)
 